@@ -0,0 +1,186 @@
+"""
+benchmark mysticlib over synthetic mystics of different formats, sizes and password slot counts
+usage: python -m benchmarks.mystic_bench [-f FORMAT...] [-n ENTRIES...] [-s SLOTS...] [-o results.json] [-c baseline.json]
+every measurement records the best time of its repeats, and the peak memory allocated during one more (traced) run.
+The results are written as json, and can be compared against the results of an earlier run.
+"""
+from typing import Callable, Dict, List, Any
+from io import BytesIO
+from json import dumps, dump, load
+import argparse
+import datetime
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import mysticlib
+from mysticlib import Mystic
+from mysticlib.__util import enc, dec, derive_key, DEFAULT_ITER, AES_GCM
+
+PASSWORD = 'benchmark password'
+DEFAULT_FORMATS = ('scm', 'scmt', 'ecm', 'ecmi', 'dcm', 'jcm', 'stm', 'shm')
+DEFAULT_SIZES = (10, 1_000, 100_000)
+DEFAULT_SLOTS = (1, 32)
+
+
+def make_pairs(n) -> Dict[str, str]:
+    return {f'https://site{i}.example.com/login': f'user{i}@example.com:{i:08}' for i in range(n)}
+
+
+def make_mystic(format_, pairs, slots) -> bytes:
+    """
+    create a mystic with the pairs and a number of password slots, the benchmark password is the last slot
+    """
+    myst = Mystic.new_from_format(format_)
+    myst.mutable = True
+    myst.password_callback = lambda *args: PASSWORD
+    passwords = [f'other password {i}' for i in range(slots - 1)] + [PASSWORD]
+    myst.add_password(new_password=passwords[0])
+    for password in passwords[1:]:
+        myst.add_password(passwords[0], password)
+    for k, v in pairs.items():
+        myst[k] = v
+    buffer = BytesIO()
+    myst.to_stream(buffer)
+    return buffer.getvalue()
+
+
+def load_mystic(source: bytes, mutable) -> Mystic:
+    myst = Mystic.from_stream(BytesIO(source))
+    myst.password_callback = lambda *args: PASSWORD
+    myst.mutable = mutable
+    return myst
+
+
+def measure(func: Callable[[Any], Any], setup: Callable[[], Any] = lambda: None, repeat=3) -> Dict[str, float]:
+    """
+    time func(setup()), setup is not timed
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        arg = setup()
+        start = time.perf_counter()
+        func(arg)
+        best = min(best, time.perf_counter() - start)
+    arg = setup()
+    tracemalloc.start()
+    try:
+        func(arg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': best, 'peak_bytes': peak}
+
+
+def bench_crypto(sizes, repeat) -> List[dict]:
+    results = [dict(bench='kdf', iterations=DEFAULT_ITER,
+                    **measure(lambda _: derive_key(PASSWORD, b'\0' * 16, DEFAULT_ITER), repeat=repeat))]
+    salt = b'\0' * 16
+    key = derive_key(PASSWORD, salt, DEFAULT_ITER)
+    for n in sizes:
+        plaintext = bytes(dumps(make_pairs(n)), 'utf-8')
+        for cipher_name, cipher in (('fernet', None), ('aes_gcm', AES_GCM)):
+            cypher = enc(plaintext, None, DEFAULT_ITER, salt, key=key, cipher=cipher)
+            for bench, func in (('enc', lambda _: enc(plaintext, None, DEFAULT_ITER, salt, key=key, cipher=cipher)),
+                                ('dec', lambda _: dec(cypher, None, key=key))):
+                result = measure(func, repeat=repeat)
+                result['mb_per_s'] = len(plaintext) / result['seconds'] / 1_000_000
+                results.append(dict(bench=bench, cipher=cipher_name, entries=n,
+                                    bytes=len(plaintext), **result))
+    return results
+
+
+def bench_mystic(format_, n, slots, repeat) -> List[dict]:
+    pairs = make_pairs(n)
+    source = make_mystic(format_, pairs, slots)
+    some_key = next(iter(pairs)) if pairs else 'missing'
+    base = dict(format=format_, entries=n, slots=slots)
+
+    def loaded(mutable):
+        def ret():
+            myst = load_mystic(source, mutable)
+            # unlock, so that only the measured access is timed
+            myst.get(some_key)
+            return myst
+
+        return ret
+
+    def changed():
+        myst = loaded(True)()
+        myst[some_key] = 'changed'
+        return myst
+
+    benches = [
+        ('open', lambda _: load_mystic(source, False).get(some_key), lambda: None),
+        ('get_mutable', lambda myst: myst.get(some_key), loaded(True)),
+        ('get_immutable', lambda myst: myst.get(some_key), loaded(False)),
+        ('items', lambda myst: sum(1 for _ in myst.items()), loaded(True)),
+        ('save_one_change', lambda myst: myst.to_stream(BytesIO()), changed),
+    ]
+    results = [dict(bench='size', bytes=len(source), **base)]
+    for bench, func, setup in benches:
+        results.append(dict(bench=bench, **base, **measure(func, setup, repeat)))
+    return results
+
+
+def _result_key(result: dict):
+    return tuple((k, v) for (k, v) in result.items() if k not in ('seconds', 'peak_bytes', 'mb_per_s', 'bytes'))
+
+
+def compare(results: List[dict], baseline: List[dict], threshold=1.2):
+    """
+    print the measurements that are slower than the baseline by more than threshold
+    """
+    baseline = {_result_key(r): r for r in baseline}
+    for result in results:
+        base = baseline.get(_result_key(result))
+        if not base or 'seconds' not in result:
+            continue
+        ratio = result['seconds'] / base['seconds']
+        if ratio > threshold:
+            print(f'regression: {dict(_result_key(result))} {base["seconds"]:.4f}s -> {result["seconds"]:.4f}s'
+                  f' ({ratio:.2f}x)')
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='benchmark mysticlib')
+    parser.add_argument('-f', dest='formats', nargs='+', default=DEFAULT_FORMATS, help='the formats to benchmark')
+    parser.add_argument('-n', dest='sizes', nargs='+', type=int, default=DEFAULT_SIZES,
+                        help='the numbers of entries to benchmark')
+    parser.add_argument('-s', dest='slots', nargs='+', type=int, default=DEFAULT_SLOTS,
+                        help='the numbers of password slots to benchmark')
+    parser.add_argument('-r', dest='repeat', type=int, default=3, help='the repeats of every measurement')
+    parser.add_argument('-o', dest='output', default=None, help='the path to write the json results to')
+    parser.add_argument('-c', dest='baseline', default=None, help='the path of earlier json results to compare to')
+    args = parser.parse_args(args)
+
+    results = bench_crypto(args.sizes, args.repeat)
+    for format_ in args.formats:
+        for n in args.sizes:
+            for slots in args.slots:
+                for result in bench_mystic(format_, n, slots, args.repeat):
+                    results.append(result)
+                    print(result, flush=True)
+    report = {
+        'meta': {
+            'mysticlib': mysticlib.__version__,
+            'python': sys.version,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': datetime.datetime.now().isoformat(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as w:
+            dump(report, w, indent=1)
+    if args.baseline:
+        with open(args.baseline) as r:
+            compare(results, load(r)['results'])
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+compare the json and binary record encodings of a mystic's plaintext
+usage: python -m benchmarks.records_bench [sizes...]
+"""
+from timeit import Timer
+from json import dumps, loads
+import sys
+
+from mysticlib.records import encode_binary_records, iter_binary_records, decode_binary_records
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+
+
+def make_pairs(n):
+    return {f'account {i}@example.com': f'password {i} שלום' for i in range(n)}
+
+
+def best_of(func, repeat=5):
+    timer = Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def bench(n):
+    d = make_pairs(n)
+    json_coded = bytes(dumps(d), 'utf-8')
+    binary_coded = encode_binary_records(d.items())
+    assert loads(json_coded) == decode_binary_records(binary_coded)
+    return {
+        'json': (
+            best_of(lambda: bytes(dumps(d), 'utf-8')),
+            best_of(lambda: loads(json_coded)),
+            None,
+            len(json_coded)),
+        'binary': (
+            best_of(lambda: encode_binary_records(d.items())),
+            best_of(lambda: decode_binary_records(binary_coded)),
+            best_of(lambda: [k for (k, _) in iter_binary_records(binary_coded, values=False)]),
+            len(binary_coded)),
+    }
+
+
+def main(sizes):
+    print(f'{"entries":>8} {"format":>7} {"encode MB/s":>12} {"decode MB/s":>12} {"keys only MB/s":>15} {"size":>10}')
+    for n in sizes:
+        results = bench(n)
+        # throughput is measured against the size of the json plaintext, so the formats are comparable
+        plain_mb = results['json'][3] / 1_000_000
+        for name, (encode, decode, keys_only, size) in results.items():
+            keys_only = f'{plain_mb / keys_only:15.1f}' if keys_only else f'{"-":>15}'
+            print(f'{n:>8} {name:>7} {plain_mb / encode:12.1f} {plain_mb / decode:12.1f} {keys_only} {size:>10}')
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or DEFAULT_SIZES)
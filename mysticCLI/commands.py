@@ -5,6 +5,7 @@ from typing import Dict, Type
 import re
 import textwrap
 import os.path
+import shutil
 
 import cryptography
 
@@ -19,6 +20,7 @@ except ImportError:
     tk = None
 
 from mysticlib import Mystic
+from mysticlib.instrumentation import Counters, timed
 import mysticlib
 
 from mysticCLI.resettable_timer import ResettableTimer
@@ -72,10 +74,12 @@ def get(key, *, myst: Mystic, **kwargs):
 
 def _search(myst, pattern):
     p = re.compile(pattern)
+    # values are only read for matching keys, formats that encrypt values separately won't decrypt the rest
+    snapshot = myst.snapshot()
     results = []
-    for k, v in myst.items():
+    for k in snapshot:
         if p.search(k):
-            results.append((k, v))
+            results.append((k, snapshot[k]))
     if len(results) == 0:
         return 'no results found matching pattern'
     if len(results) == 1:
@@ -113,7 +117,8 @@ def search(pattern, *, myst: Mystic, **kwargs):
 
 
 def _lookup(myst, auto_display_thresh=10, start=''):
-    orig_cands = set(myst.items())
+    snapshot = myst.snapshot()
+    orig_cands = set(snapshot)
     candidates = set(orig_cands)
     pattern = start
     while True:
@@ -123,11 +128,12 @@ def _lookup(myst, auto_display_thresh=10, start=''):
             response = input(f'no valid candidates for pattern {pattern}, go back one? [y/n]\n').lower()
             if response == 'y':
                 pattern = pattern[:-1]
-                candidates = {(k, v) for (k, v) in orig_cands if (pattern in k)}  # todo fuzzy search
+                candidates = {k for k in orig_cands if (pattern in k)}  # todo fuzzy search
                 continue
             return 'lookup cancelled'
         if len(candidates) == 1:
-            return next(iter(candidates))
+            k = next(iter(candidates))
+            return k, snapshot[k]
 
         next_letters = None
         if len(candidates) < auto_display_thresh:
@@ -146,8 +152,8 @@ def _lookup(myst, auto_display_thresh=10, start=''):
         if disp:
             assert next_letters is None
             print('query: ' + pattern)
-            c = sorted(candidates, key=lambda x: x[0])
-            for i, (k, _) in enumerate(c):
+            c = sorted(candidates)
+            for i, k in enumerate(c):
                 print(f'#{i}\t{k}')
             while next_letters is None:
                 response = input(
@@ -158,7 +164,7 @@ def _lookup(myst, auto_display_thresh=10, start=''):
                     response = response[1:]
                     try:
                         ret = int(response)
-                        return c[ret]
+                        return c[ret], snapshot[c[ret]]
                     except ValueError:
                         print('could not parse number ' + response)
                     except IndexError:
@@ -167,9 +173,9 @@ def _lookup(myst, auto_display_thresh=10, start=''):
 
         assert next_letters is not None
         pattern += next_letters
-        for k, _ in list(candidates):
+        for k in list(candidates):
             if pattern not in k:  # todo fuzzy search
-                candidates.remove((k, _))
+                candidates.remove(k)
 
 
 @Command
@@ -311,8 +317,20 @@ def save(path=None, *, myst: Mystic, timer: ResettableTimer, source_path=None, *
         path = source_path
         if path is None:
             return 'A path must be entered for newly created files'
-    with open(path, 'wb') as dst:
-        myst.to_stream(dst)
+    appended = False
+    if path == source_path and os.path.exists(path):
+        # formats that support it only append their changes to the file they were loaded from
+        with open(path, 'r+b') as dst, timed('write'):
+            appended = myst.append_to_stream(dst)
+    if not appended:
+        # the mystic might still be reading from a memory map of the file, so it is not overwritten in place (the file is
+        # only mapped where a mapped file can be replaced, see read_source)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as dst, timed('write'):
+            myst.to_stream(dst)
+        if os.path.exists(path):
+            shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
     timer.reset()
     return f'saved to {path}, timer reset.'
 
@@ -328,6 +346,30 @@ def enable_write(*, myst: Mystic, **kwargs):
     return 'myst in write mode'
 
 
+@Command
+def lock(*, myst: Mystic, **kwargs):
+    """
+    Forget the master key if the mystic is kept unlocked (see the -k argument), the password will be prompted again on the next access.
+    """
+    myst.lock()
+    return 'mystic locked'
+
+
+@Command
+def stats(clear=None, *, counters: Counters = None, **kwargs):
+    """
+    Display the number of calls, and the time spent in, the expensive operations of this session (key derivations, encryptions, decryptions, writes...). Times include the operations called within, and get_master includes the time spent typing the password. Enter "stats clear" to reset the counters.
+    """
+    if counters is None:
+        return 'statistics are not being collected'
+    ret = counters.report()
+    if clear == 'clear':
+        counters.clear()
+    elif clear is not None:
+        return f'unrecognized argument {clear}'
+    return ret
+
+
 @Command
 def help(command=None, *, commands: Type[Command], **kwargs):
     """
@@ -354,10 +396,11 @@ def dump(pattern='', separator=': ', *, myst: Mystic, **kwargs):
     Display all the entries in the myst. Accepts an optional pattern and an optional separator. Only keys matching the pattern will be returned, and the separator will be between every key and value.
     """
     p = re.compile(pattern)
+    snapshot = myst.snapshot()
     ret = []
-    for k, v in myst.items():
+    for k in snapshot:
         if p.search(k):
-            ret.append(f'{k}{separator}{v}')
+            ret.append(f'{k}{separator}{snapshot[k]}')
     return '\n'.join(ret)
 
 
@@ -526,10 +569,11 @@ if pyperclip:
         Get all the entries in the myst and copy thm to clipboard. Accepts an optional pattern and an optional separator. Only keys matching the pattern will be returned, and the separator will be between every key and value.  This command will only be present if pyperclip is installed.
         """
         p = re.compile(pattern)
+        snapshot = myst.snapshot()
         ret = []
-        for k, v in myst.items():
+        for k in snapshot:
             if p.search(k):
-                ret.append(f'{k}{separator}{v}')
+                ret.append(f'{k}{separator}{snapshot[k]}')
         pyperclip.copy('\n'.join(ret))
         return 'dump copied to clipboard'
 
@@ -3,9 +3,11 @@ from functools import partial
 import argparse
 import sys
 import os
+import mmap
 import warnings
 
-from mysticlib import Mystic
+from mysticlib import Mystic, calibrate_kdf, ZLIB, LZMA, AES_GCM, CHACHA20_POLY1305
+from mysticlib.instrumentation import Counters, set_sink
 
 from mysticCLI.resettable_timer import ResettableTimer
 from mysticCLI.commands import Command
@@ -18,15 +20,32 @@ try:
 except ImportError:
     tk = None
 
+compressions = {'none': None, 'zlib': ZLIB, 'lzma': LZMA}
+ciphers = {'fernet': None, 'aes-gcm': AES_GCM, 'chacha20-poly1305': CHACHA20_POLY1305}
+
 parser = argparse.ArgumentParser(description='A CLI tool for mystic files')
 parser.add_argument('source', action='store', type=str, default=':', nargs='?',
-                    help='the source mystic to load. * denotes a new file, a format can be specified after the *.'
+                    help='the source mystic to load. * denotes a new file, a format can be specified after the *,'
+                         ' and options for the format after a colon (*shm:64 for a sharded file with 64 buckets). '
                          'Default is to ask for prompt. : to ask for prompt.'
                          f'{" ? for a pop-up dialog" if tk else ""}')
 parser.add_argument('-t', action='store', type=float, default=30, required=False, dest='timeout',
                     help='time, in minutes, before the program automatically shuts down, -1 to disable this feature.')
 parser.add_argument('-w', action='store', type=bool_or_ellipsis, default=..., required=False, dest='write',
                     help='whether to set the file to be writeable or not, default is to try, but not exit when failing')
+parser.add_argument('-k', action='store', type=float, default=0, required=False, dest='unlock_time',
+                    help='time, in minutes, to keep the mystic unlocked after a password is entered, so that it is not'
+                         ' prompted again. 0 (default) to prompt on every access.')
+parser.add_argument('-l', action='store', type=float, default=250, required=False, dest='kdf_time',
+                    help='time, in milliseconds, the key derivation of a password should take on this machine, for'
+                         ' passwords of new files. The strongest key derivation that fits is chosen. 0 to use the'
+                         ' default of the format.')
+parser.add_argument('-z', action='store', choices=compressions, default=None, required=False, dest='compression',
+                    help='the compression of the data when it is saved, for formats that compress their data. Default'
+                         ' is to keep the compression of the loaded file (none for new files).')
+parser.add_argument('-c', action='store', choices=ciphers, default=None, required=False, dest='cipher',
+                    help='the cipher of the data and of new passwords when they are saved. Default is to keep the'
+                         ' cipher of the loaded file (fernet for new files).')
 parser.add_argument('--nsecure', action='store_true', default=False, required=False, dest='nsecure',
                     help='set the application to use a non-secure input method, in case the secure one is not supported')
 parser.add_argument('--throw', action='store_true', default=False, required=False, dest='throw',
@@ -34,6 +53,18 @@ parser.add_argument('--throw', action='store_true', default=False, required=Fals
 parser.add_argument('--version', action='version', version=__version__)
 
 
+def read_source(path):
+    """
+    read the source mystic file. Where a mapped file can be replaced when it is saved (not on windows), the file is
+    mapped, and the mystic reads directly from the mapping (the mapping outlives the file object). Elsewhere, and for
+    empty files (which can't be mapped), the file is read into memory.
+    """
+    with open(path, mode='br') as source:
+        if os.name == 'nt' or os.fstat(source.fileno()).st_size == 0:
+            return source.read()
+        return mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+
+
 def handle_line(line: str, *, throw, **kwargs) -> bool:
     if not line or line.isspace():
         return True
@@ -97,10 +128,20 @@ def main(args=None):
         if form == '':
             form = 'scm'
         myst = Mystic.new_from_format(form)
+        if args.kdf_time > 0 and hasattr(myst, 'kdf'):
+            myst.kdf = calibrate_kdf(args.kdf_time / 1000)
     else:
         kwargs['source_path'] = args.source
-        with open(args.source, mode='br') as source:
-            myst = Mystic.from_stream(source)
+        myst = Mystic.from_buffer(read_source(args.source))
+
+    if args.compression is not None:
+        if not hasattr(myst, 'compression'):
+            raise ValueError(f'the {myst.format} format does not support compression')
+        myst.compression = compressions[args.compression]
+    if args.cipher is not None:
+        if not hasattr(myst, 'cipher'):
+            raise ValueError(f'the {myst.format} format does not support other ciphers')
+        myst.cipher = ciphers[args.cipher]
 
     if args.timeout < 0:
         timer = GreyHole()
@@ -109,6 +150,11 @@ def main(args=None):
 
     kwargs['commands'] = Command
 
+    # the counters are cheap next to the operations they time, so they are always kept for the stats command
+    counters = Counters()
+    set_sink(counters)
+    kwargs['counters'] = counters
+
     if args.nsecure:
         myst.password_callback = input
     else:
@@ -125,6 +171,12 @@ def main(args=None):
             else:
                 raise
 
+    if args.unlock_time > 0:
+        try:
+            myst.enable_key_cache(ttl=args.unlock_time * 60, idle=None)
+        except Exception as e:
+            warnings.warn('could not keep the mystic unlocked, reason: ' + str(e))
+
     timer.start()
 
     print(
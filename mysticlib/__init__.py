@@ -1,10 +1,25 @@
 # mystic types:
-# each entry is encrypted todo
-# whole file is encrypted and each entry is encrypted todo
+# whole file is encrypted (SingleCodedMystic)
+# each entry is encrypted (EntryCodedMystic)
+# each entry is encrypted, with a blind index of the keys (IndexedEntryCodedMystic)
+# whole file is encrypted and each entry is encrypted (DoubleCodedMystic)
+# whole file is encrypted, changes are appended as encrypted records (JournaledMystic)
+# whole file is encrypted as a stream of chunks (StreamCodedMystic)
+# pairs are split between buckets, each bucket is encrypted (ShardedMystic)
 
 __version__ = '0.5.1'
 __author__ = 'Ben Avrahami'
 
 from mysticlib.mystic import Mystic
 from mysticlib.single_coded_mystic import SingleCodedMystic
+from mysticlib.tagged_single_coded_mystic import TaggedSingleCodedMystic
+from mysticlib.entry_coded_mystic import EntryCodedMystic
+from mysticlib.indexed_entry_coded_mystic import IndexedEntryCodedMystic
+from mysticlib.double_coded_mystic import DoubleCodedMystic
+from mysticlib.journaled_mystic import JournaledMystic
+from mysticlib.stream_coded_mystic import StreamCodedMystic
+from mysticlib.sharded_mystic import ShardedMystic
 from mysticlib.exceptions import BadKey
+from mysticlib.async_mystic import AsyncMystic
+from mysticlib.records import JSON_RECORDS, BINARY_RECORDS
+from mysticlib.__util import ZLIB, LZMA, AES_GCM, CHACHA20_POLY1305, ScryptProfile, calibrate_kdf
@@ -1,13 +1,35 @@
+from typing import Tuple, NamedTuple, Union
+
 import os
 import base64
+import zlib
+import lzma
+import time
 
-from cryptography.fernet import Fernet
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+from mysticlib.instrumentation import instrumented
 
 ITER_LEN = 8  # maximum iterations 256^8
 DEFAULT_ITER = 100_000
+LEN_LEN = 4  # the length prefix of variable-length tokens in mystic files
+MIN_ITER = 10_000  # calibration never picks less PBKDF2 iterations than this
+
+# compression methods of the plaintext, a compressed token is prefixed with a zero byte, a 'c', and the method (Fernet
+# tokens never start with a zero byte, so tokens without the prefix are uncompressed)
+ZLIB = b'z'
+LZMA = b'x'
+_COMPRESSION_PREFIX = b'\0c'
+_compressors = {
+    ZLIB: (zlib.compress, zlib.decompress),
+    LZMA: (lzma.compress, lzma.decompress),
+}
 
 
 def _num_code(n: int):
@@ -18,30 +40,291 @@ def _num_decode(s: bytes):
     return int.from_bytes(s[:ITER_LEN], 'big', signed=False), s[ITER_LEN:]
 
 
+class BufferReader:
+    """
+    A read-only stream over a bytes-like object (bytes, memoryview, mmap...), reads return views of the buffer instead
+    of copies
+    """
+
+    def __init__(self, buffer):
+        view = memoryview(buffer)
+        if view.format != 'B':
+            view = view.cast('B')
+        self._view = view
+        self._pos = 0
+
+    def read(self, n=-1) -> memoryview:
+        start = self._pos
+        if n is None or n < 0:
+            end = len(self._view)
+        else:
+            end = min(start + n, len(self._view))
+        self._pos = end
+        return self._view[start:end]
+
+    def readline(self) -> bytes:
+        view = self._view
+        end = self._pos
+        while end < len(view) and view[end] != ord('\n'):
+            end += 1
+        # lines are only used for headers, so copying them is fine
+        return bytes(self.read(end + 1 - self._pos))
+
+    def tell(self):
+        return self._pos
+
+
+def _compress(src: bytes, compression) -> Tuple[bytes, bytes]:
+    """
+    compress src, returning the prefix of the token and the compressed data
+    """
+    if compression is None:
+        return b'', src
+    if compression not in _compressors:
+        raise ValueError(f'unrecognized compression {compression}')
+    compress, _ = _compressors[compression]
+    return _COMPRESSION_PREFIX + compression, compress(src)
+
+
+def _split_compression(token) -> Tuple[bytes, memoryview]:
+    """
+    split a token into its compression method (or None) and the Fernet token
+    """
+    token = memoryview(token)
+    if token[:2] != _COMPRESSION_PREFIX:
+        return None, token
+    compression = bytes(token[2:3])
+    if compression not in _compressors:
+        raise ValueError(f'unrecognized compression {compression}')
+    return compression, token[3:]
+
+
+def _decompress(src: bytes, compression) -> bytes:
+    if compression is None:
+        return src
+    _, decompress = _compressors[compression]
+    return decompress(src)
+
+
+# ciphers a token can be encrypted with, None means Fernet. A token of any other cipher is written as a zero byte, an
+# 'a', the cipher, a nonce, and the raw (not base64 encoded) cyphertext and tag. The key is the same (decoded) Fernet
+# key, so the cipher is independent of the key derivation.
+AES_GCM = b'g'
+CHACHA20_POLY1305 = b'p'
+_AEAD_PREFIX = b'\0a'
+_AEAD_NONCE_LEN = 12
+_aeads = {
+    AES_GCM: AESGCM,
+    CHACHA20_POLY1305: ChaCha20Poly1305,
+}
+
+
+def _encrypt(src: bytes, key: bytes, cipher) -> bytes:
+    if cipher is None:
+        return Fernet(key).encrypt(src)
+    if cipher not in _aeads:
+        raise ValueError(f'unrecognized cipher {cipher}')
+    nonce = os.urandom(_AEAD_NONCE_LEN)
+    aead = _aeads[cipher](base64.urlsafe_b64decode(key))
+    return _AEAD_PREFIX + cipher + nonce + aead.encrypt(nonce, src, None)
+
+
+def _decrypt(token, key: bytes) -> bytes:
+    token = memoryview(token)
+    if token[:2] != _AEAD_PREFIX:
+        return Fernet(key).decrypt(bytes(token))
+    cipher = bytes(token[2:3])
+    if cipher not in _aeads:
+        raise ValueError(f'unrecognized cipher {cipher}')
+    nonce_end = 3 + _AEAD_NONCE_LEN
+    aead = _aeads[cipher](base64.urlsafe_b64decode(key))
+    try:
+        return aead.decrypt(bytes(token[3:nonce_end]), bytes(token[nonce_end:]), None)
+    except InvalidTag as e:
+        # raise the same error as Fernet does, so a wrong key is handled the same for all ciphers
+        raise InvalidToken() from e
+
+
+def _token_format(token) -> Tuple[bytes, bytes]:
+    """
+    get the compression and the cipher (None for no compression and for Fernet) of a token produced by seal, or of the
+    token of a cyphertext produced by enc (see parse_envelope), without decrypting it
+    """
+    compression, token = _split_compression(token)
+    if token[:2] != _AEAD_PREFIX:
+        return compression, None
+    return compression, bytes(token[2:3])
+
+
+def _read_token(src) -> bytes:
+    l = int.from_bytes(src.read(LEN_LEN), 'big', signed=False)
+    ret = src.read(l)
+    if len(ret) != l:
+        raise EOFError('mystic ended in the middle of a token')
+    return ret
+
+
+def _write_token(dst, token: bytes) -> int:
+    dst.write(len(token).to_bytes(LEN_LEN, 'big', signed=False))
+    dst.write(token)
+    return LEN_LEN + len(token)
+
+
+class ScryptProfile(NamedTuple):
+    """
+    the parameters of an scrypt key derivation, n is 2**n_log2
+    """
+    n_log2: int
+    r: int = 8
+    p: int = 1
+
+    @property
+    def memory(self):
+        return 128 * self.r * (2 ** self.n_log2)
+
+
+# a KDF profile is either a number of PBKDF2-SHA256 iterations, or the parameters of scrypt
+KdfProfile = Union[int, ScryptProfile]
+
+_SCRYPT_ID = b's'
+# profiles read from a file are checked against this, so a file can't make a reader allocate too much memory
+MAX_SCRYPT_MEMORY = 1024 * 2 ** 20
+DEFAULT_SCRYPT_MEMORY = 64 * 2 ** 20
+
+
+def _profile_code(profile: KdfProfile) -> bytes:
+    """
+    code a KDF profile as it follows the iteration flag of an envelope
+    """
+    if isinstance(profile, ScryptProfile):
+        return b'\0\2' + _SCRYPT_ID + bytes(profile)
+    return b'\0\1' + _num_code(profile)
+
+
+def _profile_decode(flag: int, src: memoryview) -> Tuple[KdfProfile, memoryview]:
+    if flag == 1:
+        return _num_decode(src)
+    if flag != 2:
+        raise ValueError(f'unrecognized iteration flag {flag}')
+    kdf_id = bytes(src[:1])
+    if kdf_id != _SCRYPT_ID:
+        raise ValueError(f'unrecognized key derivation {kdf_id}')
+    profile = ScryptProfile(*src[1:4])
+    if profile.memory > MAX_SCRYPT_MEMORY:
+        raise ValueError(f'the key derivation requires too much memory ({profile.memory} bytes)')
+    return profile, src[4:]
+
+
+@instrumented('derive_key')
+def derive_key(pw, salt: bytes, hash_iterations: KdfProfile = DEFAULT_ITER) -> bytes:
+    """
+    run the (expensive) key derivation of a password, returning a key usable by Fernet
+    hash_iterations is a KDF profile, a number of PBKDF2 iterations or an ScryptProfile
+    """
+    if not isinstance(pw, bytes):
+        pw = bytes(pw, 'utf-8')
+    if isinstance(hash_iterations, ScryptProfile):
+        kdf = Scrypt(
+            salt=salt,
+            length=32,
+            n=2 ** hash_iterations.n_log2,
+            r=hash_iterations.r,
+            p=hash_iterations.p,
+            backend=default_backend())
+    else:
+        kdf = PBKDF2HMAC(
+            algorithm=hashes.SHA256(),
+            salt=salt,
+            length=32,
+            iterations=hash_iterations,
+            backend=default_backend())
+    return base64.urlsafe_b64encode(kdf.derive(pw))
+
+
+def _time_kdf(profile: KdfProfile) -> float:
+    start = time.perf_counter()
+    derive_key(b'calibration', b'\0' * 16, profile)
+    return time.perf_counter() - start
+
+
+def calibrate_kdf(target_seconds=0.25, max_memory=DEFAULT_SCRYPT_MEMORY, allow_scrypt=True) -> KdfProfile:
+    """
+    find the strongest KDF profile that takes about target_seconds on this machine. scrypt is preferred if it fits the
+    time and max_memory at its minimal recommended strength (n=2**14, r=8), otherwise PBKDF2 is used.
+    """
+    if allow_scrypt:
+        profile = ScryptProfile(14)
+        if profile.memory <= max_memory:
+            elapsed = _time_kdf(profile)
+            if elapsed <= target_seconds:
+                # scrypt's time is linear in n
+                while elapsed * 2 <= target_seconds:
+                    stronger = profile._replace(n_log2=profile.n_log2 + 1)
+                    if stronger.memory > max_memory:
+                        break
+                    profile = stronger
+                    elapsed *= 2
+                return profile
+    sample = MIN_ITER
+    elapsed = _time_kdf(sample)
+    iterations = int(sample * target_seconds / elapsed) // 1000 * 1000
+    return max(iterations, MIN_ITER)
+
+
+def parse_envelope(src: bytes, salt: bytes = None, hash_iterations: KdfProfile = None) \
+        -> Tuple[bytes, KdfProfile, memoryview]:
+    """
+    split a cyphertext produced by enc into its salt, KDF profile, and token (a Fernet or AEAD token, possibly prefixed
+    with its compression)
+    """
+    # slicing a memoryview doesn't copy the cyphertext
+    src = memoryview(src)
+    saltbit = bool(src[1])
+    src = src[2:]
+    if saltbit:
+        salt = bytes(src[:16])
+        src = src[16:]
+    iter_flag = src[1]
+    src = src[2:]
+    if iter_flag:
+        hash_iterations, src = _profile_decode(iter_flag, src)
+
+    if None in (hash_iterations, salt):
+        raise Exception(
+            f'a value is not supplied by the caller or the cyphertext {[a is None for a in (hash_iterations, salt)]}')
+    return salt, hash_iterations, src
+
+
+def _out_size(ret, *args, **kwargs):
+    return len(ret)
+
+
+@instrumented('enc', _out_size)
 def enc(src: str, pw: str, hash_iterations=DEFAULT_ITER, salt: bytes = None,
-        add_salt=True, add_iter=True) -> bytes:
+        add_salt=True, add_iter=True, key: bytes = None, compression: bytes = None, cipher: bytes = None) -> bytes:
+    """
+    if key is supplied, it must be the output of derive_key for salt and hash_iterations, and the derivation is skipped
+    if compression is supplied (ZLIB or LZMA), the plaintext is compressed before it is encrypted
+    if cipher is supplied (AES_GCM or CHACHA20_POLY1305), it is used instead of Fernet
+    hash_iterations is a KDF profile, a number of PBKDF2 iterations or an ScryptProfile
+    """
     if not isinstance(src, bytes):
         src = bytes(src, 'utf-8')
-    if not isinstance(pw, bytes):
-        pw = bytes(pw, 'utf-8')
+    compression_prefix, src = _compress(src, compression)
+    if key is not None and salt is None:
+        raise ValueError('a salt must be supplied alongside a pre-derived key')
     if salt is None:
         if not add_salt:
             salt = b'\0' * 16
         else:
             salt = os.urandom(16)
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        salt=salt,
-        length=32,
-        iterations=hash_iterations,
-        backend=default_backend())
-    key = base64.urlsafe_b64encode(kdf.derive(pw))
-    fern = Fernet(key)
-    ret = fern.encrypt(src)
+    if key is None:
+        key = derive_key(pw, salt, hash_iterations)
+    ret = compression_prefix + _encrypt(src, key, cipher)
     # encode doesn't like it if the byte length isn't divisible by 4, so we add a padding zero to both yes and no flags,
     # if we add more flags we might change this
     if add_iter:
-        ret = b'\0\1' + _num_code(hash_iterations) + ret
+        ret = _profile_code(hash_iterations) + ret
     else:
         ret = b'\0\0' + ret
     if add_salt:
@@ -52,34 +335,37 @@ def enc(src: str, pw: str, hash_iterations=DEFAULT_ITER, salt: bytes = None,
     return ret
 
 
-def dec(src: bytes, pw: str, salt: bytes = None, hash_iterations: int = None):
-    if not isinstance(pw, bytes):
-        pw = bytes(pw, 'utf-8')
+@instrumented('dec', _out_size)
+def dec(src: bytes, pw: str, salt: bytes = None, hash_iterations: int = None, key: bytes = None):
+    """
+    if key is supplied, it must be the output of derive_key for the cyphertext's salt and iterations, and the
+    derivation is skipped
+    """
     # src = bytes(src, 'base64')
     # src = base64.urlsafe_b64decode(src)
-    saltbit = bool(src[1])
-    src = src[2:]
-    if saltbit:
-        salt = src[:16]
-        src = src[16:]
-    iter_bit = bool(src[1])
-    src = src[2:]
-    if iter_bit:
-        hash_iterations, src = _num_decode(src)
+    salt, hash_iterations, token = parse_envelope(src, salt, hash_iterations)
+    compression, token = _split_compression(token)
+    if key is None:
+        key = derive_key(pw, salt, hash_iterations)
+    return _decompress(_decrypt(token, key), compression)
+
+
+@instrumented('seal', _out_size)
+def seal(src, master: bytes, compression: bytes = None, cipher: bytes = None) -> bytes:
+    """
+    encrypt src directly under a master key, without any key derivation
+    """
+    if not isinstance(src, bytes):
+        src = bytes(src, 'utf-8')
+    compression_prefix, src = _compress(src, compression)
+    return compression_prefix + _encrypt(src, master, cipher)
 
-    if None in (hash_iterations, salt):
-        raise Exception(
-            f'a value is not supplied by the caller or the cyphertext {[a is None for a in (hash_iterations, salt)]}')
 
-    kdf = PBKDF2HMAC(
-        algorithm=hashes.SHA256(),
-        salt=salt,
-        length=32,
-        iterations=hash_iterations,
-        backend=default_backend())
-    key = base64.urlsafe_b64encode(kdf.derive(pw))
-    fern = Fernet(key)
-    return fern.decrypt(src)
+@instrumented('unseal', _out_size)
+def unseal(src: bytes, master: bytes) -> bytes:
+    compression, token = _split_compression(src)
+    return _decompress(_decrypt(token, master), compression)
 
 
-__all__ = ['enc', 'dec', 'DEFAULT_ITER']
+__all__ = ['enc', 'dec', 'seal', 'unseal', 'derive_key', 'parse_envelope', 'calibrate_kdf', 'ScryptProfile',
+           'DEFAULT_ITER', 'ZLIB', 'LZMA', 'AES_GCM', 'CHACHA20_POLY1305']
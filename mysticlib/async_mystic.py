@@ -0,0 +1,70 @@
+from typing import Mapping, Optional
+from concurrent.futures import Executor
+from functools import partial
+from io import BytesIO
+import asyncio
+
+from mysticlib.mystic import Mystic
+
+
+class AsyncMystic:
+    """
+    An asyncio facade over a mystic, that runs its blocking operations (key derivation, decryption, serialization) on
+    an executor, so that they don't block the event loop. Operations on the same mystic are run one at a time, since
+    mystics are not thread safe, but any number of mystics can be worked on at once.
+    The executor is a thread pool by default (the key derivation and ciphers release the GIL). To also move the key
+    derivation of password slots to other processes, set the mystic's slot_executor to a process pool.
+    Password callbacks are called on the executor, so passwords are best passed as the minor arguments.
+    """
+
+    def __init__(self, mystic: Mystic, executor: Optional[Executor] = None):
+        self.mystic = mystic
+        self.executor = executor
+        # created on first use, so that it belongs to the running loop
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+
+    @classmethod
+    async def afrom_stream(cls, src: BytesIO, executor: Optional[Executor] = None) -> 'AsyncMystic':
+        loop = asyncio.get_running_loop()
+        mystic = await loop.run_in_executor(executor, Mystic.from_stream, src)
+        return cls(mystic, executor)
+
+    @classmethod
+    async def afrom_buffer(cls, buffer, executor: Optional[Executor] = None) -> 'AsyncMystic':
+        loop = asyncio.get_running_loop()
+        mystic = await loop.run_in_executor(executor, Mystic.from_buffer, buffer)
+        return cls(mystic, executor)
+
+    async def aload(self, minor=None) -> dict:
+        """
+        get a copy of all the pairs of the mystic
+        """
+        return await self._run(lambda: dict(self.mystic.snapshot(minor)))
+
+    async def asnapshot(self, minor=None) -> Mapping[str, str]:
+        return await self._run(self.mystic.snapshot, minor)
+
+    async def aget(self, key, default=None, minor=None):
+        return await self._run(self.mystic.get, key, default, minor=minor)
+
+    async def aset(self, key, value, minor=None):
+        return await self._run(self.mystic.__setitem__, key, value, minor)
+
+    async def adel(self, key, minor=None):
+        return await self._run(self.mystic.__delitem__, key, minor)
+
+    async def ato_stream(self, dst: BytesIO, minor=None):
+        return await self._run(self.mystic.to_stream, dst, minor)
+
+    async def aadd_password(self, old_password=None, new_password=None):
+        return await self._run(self.mystic.add_password, old_password, new_password)
+
+    async def adel_password(self, minor=None):
+        return await self._run(self.mystic.del_password, minor)
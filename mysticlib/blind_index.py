@@ -0,0 +1,31 @@
+import base64
+import hmac
+import hashlib
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+BLIND_TAG_LEN = 16
+
+
+def index_key(master: bytes) -> bytes:
+    """
+    derive the key of a blind index from a (Fernet) master key
+    """
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b'mystic blind index',
+        backend=default_backend()).derive(base64.urlsafe_b64decode(master))
+
+
+def blind_tag(key: bytes, name: str) -> bytes:
+    """
+    get the blind index tag of a mystic key, it can only be computed (or matched to the key) with the index key
+    """
+    return hmac.new(key, bytes(name, 'utf-8', 'surrogatepass'), hashlib.sha256).digest()[:BLIND_TAG_LEN]
+
+
+__all__ = ['BLIND_TAG_LEN', 'index_key', 'blind_tag']
@@ -0,0 +1,188 @@
+from typing import Dict, Optional, Tuple, Union, Mapping
+from io import BytesIO
+
+from json import dumps, loads
+import hashlib
+import hmac
+
+from mysticlib.slotted_mystic import SlottedMystic
+from mysticlib.snapshot import LazySnapshot
+from mysticlib.instrumentation import instrumented
+from mysticlib.__util import *
+from mysticlib.__util import LEN_LEN
+
+# an entry in the index is either the offset, length and digest of a value already in the coded values, or a newly
+# encrypted value
+_Ref = Union[Tuple[int, int, str], bytes]
+
+
+class DoubleCodedMystic(SlottedMystic):
+    """
+    A mystic with an encrypted index of all its keys, and every value encrypted on its own. Opening the mystic and
+    listing its keys only decrypts the index, values are decrypted as they are read.
+    format:
+    <header><newline>
+    <number_of_passwords (1 byte)><len of pass1(1 byte)><pass1><len of pass2(1 byte)>...
+    <len of enc_index (4 bytes)><enc_index><enc value1><enc value2>...
+    the index is a json dict, mapping each key to the offset, length, and hex sha256 of its encrypted value, the offset
+    is relative to the end of the index. Every value is the json [<key>, <value>], so values can't be moved between
+    keys, and the digest makes sure a value is the one the index was written with, and not an older one.
+    """
+    header = b'!myst_double_coded'
+    format = 'dcm'
+
+    def __init__(self):
+        super().__init__()
+        self.cache = False
+        self.coded_index: Optional[bytes] = None
+        self.coded_values = b''
+        self._index: Optional[Dict[str, _Ref]] = None
+        self._index_changed = False
+        self._master = None
+
+    @property
+    def mutable(self):
+        return self.cache
+
+    @mutable.setter
+    def mutable(self, v: bool):
+        self.cache = v
+        if not v:
+            self._master = None
+            if not self._index_changed:
+                self._index = None
+
+    def lock(self):
+        super().lock()
+        self._master = None
+        if not self._index_changed:
+            self._index = None
+
+    def _unlock_master(self, minor=None) -> bytes:
+        master = self._master
+        if master is None:
+            master = self._get_master(minor)
+            if self.cache:
+                self._master = master
+        return master
+
+    def _get_index(self, master) -> Dict[str, _Ref]:
+        index = self._index
+        if index is None:
+            if self.coded_index is None:
+                index = {}
+            else:
+                index = {k: tuple(v) for (k, v) in loads(unseal(self.coded_index, master)).items()}
+            if self.cache:
+                self._index = index
+        return index
+
+    @staticmethod
+    def _token(ref: _Ref, coded_values: bytes) -> bytes:
+        if isinstance(ref, bytes):
+            return ref
+        offset, length, _ = ref
+        return coded_values[offset: offset + length]
+
+    @classmethod
+    def _open_value(cls, key, ref: _Ref, coded_values: bytes, master) -> str:
+        token = cls._token(ref, coded_values)
+        if not isinstance(ref, bytes) and not hmac.compare_digest(hashlib.sha256(token).hexdigest(), ref[2]):
+            raise ValueError(f'the value of {key!r} does not match the index')
+        sealed_key, value = loads(unseal(token, master))
+        if sealed_key != key:
+            raise ValueError(f'the value of {key!r} belongs to another key')
+        return value
+
+    @instrumented('commit', lambda ret, self, *args, **kwargs: len(self.coded_index) + len(self.coded_values))
+    def _commit(self, minor=None):
+        master = self._unlock_master(minor)
+        index = {}
+        values = BytesIO()
+        for k, ref in self._index.items():
+            token = self._token(ref, self.coded_values)
+            if isinstance(ref, bytes):
+                digest = hashlib.sha256(token).hexdigest()
+            else:
+                digest = ref[2]
+            index[k] = (values.tell(), len(token), digest)
+            values.write(token)
+        self.coded_values = values.getvalue()
+        self.coded_index = seal(dumps(index), master, cipher=self.cipher)
+        self._index = index if self.cache else None
+        self._index_changed = False
+
+    @classmethod
+    def from_stream(cls, src: BytesIO, check_header=True) -> 'DoubleCodedMystic':
+        cls._read_header(src, check_header)
+        self = cls()
+        self._read_slots(src)
+        l = int.from_bytes(src.read(LEN_LEN), 'big', signed=False)
+        self.coded_index = src.read(l)
+        if len(self.coded_index) != l:
+            raise EOFError('mystic ended in the middle of the index')
+        self.coded_values = src.read()
+        return self
+
+    def to_stream(self, dst: BytesIO, minor=None):
+        if not self.encrypted_passwords:
+            raise Exception(
+                'this mystic has no passwords set, it will be inaccessible unless at least one passwords is added')
+        dst.write(self.header + b'\n')
+        self._write_slots(dst)
+        if self._index_changed or self.coded_index is None:
+            if self._index is None:
+                self._index = {}
+            self._commit(minor)
+        dst.write(len(self.coded_index).to_bytes(LEN_LEN, 'big', signed=False))
+        dst.write(self.coded_index)
+        dst.write(self.coded_values)
+        self._changed = False
+
+    def snapshot(self, minor=None) -> Mapping[str, str]:
+        master = self._unlock_master(minor)
+        # the coded values are replaced on commit, so the snapshot holds on to the current ones
+        coded_values = self.coded_values
+        return LazySnapshot({k: (k, ref) for (k, ref) in self._get_index(master).items()},
+                            lambda entry: self._open_value(*entry, coded_values, master))
+
+    def __getitem__(self, item, minor=None):
+        master = self._unlock_master(minor)
+        return self._open_value(item, self._get_index(master)[item], self.coded_values, master)
+
+    def __contains__(self, key):
+        return key in self._get_index(self._unlock_master())
+
+    def __setitem__(self, key, value, minor=None):
+        master = self._unlock_master(minor)
+        index = self._get_index(master)
+        index[key] = seal(dumps([key, value]), master, cipher=self.cipher)
+        self._index = index
+        self._index_changed = self._changed = True
+
+    def __delitem__(self, key, minor=None):
+        index = self._get_index(self._unlock_master(minor))
+        del index[key]
+        self._index = index
+        self._index_changed = self._changed = True
+
+    def __len__(self):
+        return len(self._get_index(self._unlock_master()))
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self, minor=None):
+        return self._get_index(self._unlock_master(minor)).keys()
+
+    def items(self, minor=None):
+        return self.snapshot(minor).items()
+
+    def values(self, minor=None):
+        return self.snapshot(minor).values()
+
+    def get(self, key, default=None, minor=None):
+        try:
+            return self.__getitem__(key, minor)
+        except KeyError:
+            return default
@@ -0,0 +1,209 @@
+from typing import Dict, List, Optional, Tuple, Mapping
+from io import BytesIO
+from json import dumps, loads
+import hashlib
+import hmac
+
+from mysticlib.slotted_mystic import SlottedMystic
+from mysticlib.snapshot import LazySnapshot
+from mysticlib.__util import *
+from mysticlib.__util import LEN_LEN, _read_token, _write_token
+
+
+class EntryCodedMystic(SlottedMystic):
+    """
+    A mystic where every key and every value is encrypted on its own under the master key, so reading a value only
+    decrypts that value, and saving only encrypts the entries that were changed.
+    Finding a key still means decrypting the keys until it is found (half of them on average, all of them for a missing
+    key), since nothing about a key can be learned from its encryption. The keys are decrypted once in mutable mode, or
+    use IndexedEntryCodedMystic, whose blind tags find a key with a single decryption.
+    Every value is encrypted along with its key, so values can't be moved between keys, and an encrypted manifest holds
+    the number of entries and a digest of all of them, so entries can't be dropped, added or replaced with old ones.
+    format:
+    <header><newline>
+    <number_of_passwords (1 byte)><len of pass1(1 byte)><pass1><len of pass2(1 byte)>...
+    <len of enc manifest (4 bytes)><enc manifest>
+    <number_of_entries (4 bytes)><len of key1 (4 bytes)><enc key1><len of value1 (4 bytes)><enc value1><len of key2>...
+    the manifest is the json {"entries": <number of entries>, "digest": <hex sha256 of the entries>}, every value is
+    the json [<key>, <value>]
+    """
+    header = b'!myst_entry_coded'
+    format = 'ecm'
+
+    def __init__(self):
+        super().__init__()
+        self.cache = False
+        # the (encrypted key, encrypted value) pairs, as read from the source
+        self.coded_entries: List[Tuple[bytes, bytes]] = []
+        self.coded_manifest: Optional[bytes] = None
+        # whether coded_entries were checked against the manifest
+        self._verified = True
+        # maps every decrypted key to its encrypted entry, only kept in mutable mode or when there are unsaved changes
+        self._index: Optional[Dict[str, Tuple[bytes, bytes]]] = None
+        self._master = None
+
+    @property
+    def mutable(self):
+        return self.cache
+
+    @mutable.setter
+    def mutable(self, v: bool):
+        self.cache = v
+        if not v:
+            self._master = None
+            if not self._changed:
+                self._index = None
+
+    def lock(self):
+        super().lock()
+        self._master = None
+        if not self._changed:
+            self._index = None
+
+    def _unlock_master(self, minor=None) -> bytes:
+        master = self._master
+        if master is None:
+            master = self._get_master(minor)
+            if self.cache:
+                self._master = master
+        if not self._verified:
+            self._verify(master)
+        return master
+
+    def _entries_digest(self) -> str:
+        digest = hashlib.sha256()
+        for ek, ev in self.coded_entries:
+            for token in (ek, ev):
+                digest.update(len(token).to_bytes(LEN_LEN, 'big', signed=False))
+                digest.update(token)
+        return digest.hexdigest()
+
+    def _verify(self, master):
+        if self.coded_manifest is None:
+            raise ValueError('the mystic has no manifest')
+        manifest = loads(unseal(self.coded_manifest, master))
+        if manifest['entries'] != len(self.coded_entries):
+            raise ValueError(f'the mystic has {len(self.coded_entries)} entries, its manifest lists'
+                             f' {manifest["entries"]}')
+        if not hmac.compare_digest(manifest['digest'], self._entries_digest()):
+            raise ValueError('the entries of the mystic do not match its manifest')
+        self._verified = True
+
+    @staticmethod
+    def _open_value(key, ev, master) -> str:
+        sealed_key, value = loads(unseal(ev, master))
+        if sealed_key != key:
+            raise ValueError(f'the value of {key!r} belongs to another key')
+        return value
+
+    def _get_index(self, master) -> Dict[str, Tuple[bytes, bytes]]:
+        index = self._index
+        if index is None:
+            index = {str(unseal(ek, master), 'utf-8'): (ek, ev) for (ek, ev) in self.coded_entries}
+            if self.cache:
+                self._index = index
+        return index
+
+    def _find(self, key, minor=None) -> Tuple[bytes, Optional[Tuple[bytes, bytes]]]:
+        """
+        get the master key, and the encrypted entry of key (or None if the key is not in the mystic)
+        """
+        master = self._unlock_master(minor)
+        if self._index is not None or self.cache:
+            return master, self._get_index(master).get(key)
+        # without an index, decrypt keys only until the requested one is found, this is linear in the number of
+        # entries, see IndexedEntryCodedMystic for constant time lookups
+        for ek, ev in self.coded_entries:
+            if str(unseal(ek, master), 'utf-8') == key:
+                return master, (ek, ev)
+        return master, None
+
+    def _seal_entry(self, master, key, value) -> Tuple[bytes, bytes]:
+        return seal(key, master, cipher=self.cipher), seal(dumps([key, value]), master, cipher=self.cipher)
+
+    def _read_entries(self, src: BytesIO):
+        num_of_entries = int.from_bytes(src.read(LEN_LEN), 'big', signed=False)
+        self.coded_entries = [(_read_token(src), _read_token(src)) for _ in range(num_of_entries)]
+
+    def _write_entries(self, dst: BytesIO):
+        dst.write(len(self.coded_entries).to_bytes(LEN_LEN, 'big', signed=False))
+        for ek, ev in self.coded_entries:
+            _write_token(dst, ek)
+            _write_token(dst, ev)
+
+    @classmethod
+    def from_stream(cls, src: BytesIO, check_header=True) -> 'EntryCodedMystic':
+        cls._read_header(src, check_header)
+        self = cls()
+        self._read_slots(src)
+        self.coded_manifest = _read_token(src)
+        self._read_entries(src)
+        self._verified = False
+        return self
+
+    def to_stream(self, dst: BytesIO, minor=None):
+        if not self.encrypted_passwords:
+            raise Exception(
+                'this mystic has no passwords set, it will be inaccessible unless at least one passwords is added')
+        dst.write(self.header + b'\n')
+        self._write_slots(dst)
+        if self._index is not None:
+            self.coded_entries = list(self._index.values())
+        if self._changed or self.coded_manifest is None:
+            master = self._unlock_master(minor)
+            manifest = {'entries': len(self.coded_entries), 'digest': self._entries_digest()}
+            self.coded_manifest = seal(dumps(manifest), master, cipher=self.cipher)
+        _write_token(dst, self.coded_manifest)
+        self._write_entries(dst)
+        self._changed = False
+
+    def __getitem__(self, item, minor=None):
+        master, entry = self._find(item, minor)
+        if entry is None:
+            raise KeyError(item)
+        return self._open_value(item, entry[1], master)
+
+    def __contains__(self, key):
+        _, entry = self._find(key)
+        return entry is not None
+
+    def __setitem__(self, key, value, minor=None):
+        master = self._unlock_master(minor)
+        index = self._get_index(master)
+        index[key] = self._seal_entry(master, key, value)
+        self._index = index
+        self._changed = True
+
+    def __delitem__(self, key, minor=None):
+        index = self._get_index(self._unlock_master(minor))
+        del index[key]
+        self._index = index
+        self._changed = True
+
+    def __len__(self):
+        if self._index is not None:
+            return len(self._index)
+        return len(self.coded_entries)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self, minor=None):
+        return self._get_index(self._unlock_master(minor)).keys()
+
+    def snapshot(self, minor=None) -> Mapping[str, str]:
+        master = self._unlock_master(minor)
+        return LazySnapshot({k: (k, ev) for (k, (_, ev)) in self._get_index(master).items()},
+                            lambda entry: self._open_value(*entry, master))
+
+    def items(self, minor=None):
+        return self.snapshot(minor).items()
+
+    def values(self, minor=None):
+        return self.snapshot(minor).values()
+
+    def get(self, key, default=None, minor=None):
+        try:
+            return self.__getitem__(key, minor)
+        except KeyError:
+            return default
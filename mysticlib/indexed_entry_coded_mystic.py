@@ -0,0 +1,81 @@
+from typing import Dict, Optional, Tuple
+from io import BytesIO
+import hashlib
+
+from mysticlib.entry_coded_mystic import EntryCodedMystic
+from mysticlib.blind_index import *
+from mysticlib.__util import *
+from mysticlib.__util import LEN_LEN, _read_token, _write_token
+
+
+class IndexedEntryCodedMystic(EntryCodedMystic):
+    """
+    An entry coded mystic where every entry also carries a blind index tag of its key, an HMAC of the key under a key
+    derived from the master key. An exact lookup computes the tag and jumps to its entry, without decrypting any other
+    key. The tags reveal nothing about the keys without the master key.
+    format:
+    <header><newline>
+    <number_of_passwords (1 byte)><len of pass1(1 byte)><pass1><len of pass2(1 byte)>...
+    <len of enc manifest (4 bytes)><enc manifest>
+    <number_of_entries (4 bytes)><tag of key1 (16 bytes)><len of key1 (4 bytes)><enc key1><len of value1 (4 bytes)>
+    <enc value1><tag of key2 (16 bytes)>...
+    """
+    header = b'!myst_entry_coded_indexed'
+    format = 'ecmi'
+
+    def __init__(self):
+        super().__init__()
+        # maps every encrypted key to the tag of its key
+        self._entry_tags: Dict[bytes, bytes] = {}
+        # maps every tag to the position of its entry in coded_entries, built on the first lookup
+        self._tag_positions: Optional[Dict[bytes, int]] = None
+
+    def _find(self, key, minor=None) -> Tuple[bytes, Optional[Tuple[bytes, bytes]]]:
+        master = self._unlock_master(minor)
+        if self._index is not None:
+            return master, self._index.get(key)
+        if self._tag_positions is None:
+            self._tag_positions = {self._entry_tags[ek]: i for (i, (ek, _)) in enumerate(self.coded_entries)}
+        i = self._tag_positions.get(blind_tag(index_key(master), key))
+        if i is None:
+            return master, None
+        entry = self.coded_entries[i]
+        # the tags are truncated, so make sure the entry is really the key's
+        if str(unseal(entry[0], master), 'utf-8') != key:
+            return master, None
+        return master, entry
+
+    def _entries_digest(self) -> str:
+        # the tags are covered as well, a tag that was changed would hide its entry from lookups
+        digest = hashlib.sha256(super()._entries_digest().encode('ascii'))
+        for ek, _ in self.coded_entries:
+            digest.update(self._entry_tags[ek])
+        return digest.hexdigest()
+
+    def _seal_entry(self, master, key, value) -> Tuple[bytes, bytes]:
+        ek, ev = super()._seal_entry(master, key, value)
+        self._entry_tags[ek] = blind_tag(index_key(master), key)
+        return ek, ev
+
+    def _read_entries(self, src: BytesIO):
+        num_of_entries = int.from_bytes(src.read(LEN_LEN), 'big', signed=False)
+        self.coded_entries = []
+        self._entry_tags = {}
+        for _ in range(num_of_entries):
+            tag = bytes(src.read(BLIND_TAG_LEN))
+            # the encrypted keys are copied, since views of a writable buffer can't be hashed
+            ek = bytes(_read_token(src))
+            ev = _read_token(src)
+            self.coded_entries.append((ek, ev))
+            self._entry_tags[ek] = tag
+        self._tag_positions = None
+
+    def _write_entries(self, dst: BytesIO):
+        # drop the tags of entries that were removed
+        self._entry_tags = {ek: self._entry_tags[ek] for (ek, _) in self.coded_entries}
+        self._tag_positions = None
+        dst.write(len(self.coded_entries).to_bytes(LEN_LEN, 'big', signed=False))
+        for ek, ev in self.coded_entries:
+            dst.write(self._entry_tags[ek])
+            _write_token(dst, ek)
+            _write_token(dst, ev)
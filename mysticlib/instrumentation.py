@@ -0,0 +1,95 @@
+"""
+timing and counting hooks around the expensive operations of mysticlib. By default no sink is set, and the hooks only
+check for one before calling through. Times are inclusive, an operation's time includes the operations it calls.
+"""
+from typing import Callable, Dict, Optional, Tuple
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+import time
+
+# a sink is called with the name of the operation, the seconds it took, and the bytes it processed (or None)
+Sink = Callable[[str, float, Optional[int]], None]
+
+_sink: Optional[Sink] = None
+
+
+def set_sink(sink: Optional[Sink]) -> Optional[Sink]:
+    """
+    set the sink operations are reported to, None to disable reporting. Returns the previous sink.
+    """
+    global _sink
+    ret = _sink
+    _sink = sink
+    return ret
+
+
+def get_sink() -> Optional[Sink]:
+    return _sink
+
+
+def instrumented(name: str, size: Callable[..., Optional[int]] = None):
+    """
+    a decorator to report every call of a function as an operation, size is called with the return value and the
+    arguments of the function, and should return the number of bytes processed
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            sink = _sink
+            if sink is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            ret = func(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            sink(name, elapsed, size(ret, *args, **kwargs) if size else None)
+            return ret
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def timed(name: str, size: Optional[int] = None):
+    """
+    report the body of a with statement as an operation
+    """
+    sink = _sink
+    if sink is None:
+        yield
+        return
+    start = time.perf_counter()
+    yield
+    sink(name, time.perf_counter() - start, size)
+
+
+class Counters:
+    """
+    A sink that tallies the number of calls, total time and total bytes of every operation
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.counters: Dict[str, Tuple[int, float, int]] = {}
+
+    def __call__(self, name: str, seconds: float, size: Optional[int]):
+        with self._lock:
+            calls, total, total_size = self.counters.get(name, (0, 0.0, 0))
+            self.counters[name] = (calls + 1, total + seconds, total_size + (size or 0))
+
+    def clear(self):
+        with self._lock:
+            self.counters.clear()
+
+    def report(self) -> str:
+        with self._lock:
+            counters = sorted(self.counters.items(), key=lambda p: -p[1][1])
+        lines = [f'{"operation":<16}{"calls":>8}{"total ms":>12}{"mean ms":>12}{"bytes":>14}']
+        for name, (calls, total, total_size) in counters:
+            lines.append(f'{name:<16}{calls:>8}{total * 1000:>12.2f}{total * 1000 / calls:>12.3f}{total_size:>14}')
+        return '\n'.join(lines)
+
+
+__all__ = ['set_sink', 'get_sink', 'instrumented', 'timed', 'Counters']
@@ -0,0 +1,162 @@
+from typing import Dict, List, Optional, Tuple
+from io import BytesIO, SEEK_END
+
+from json import dumps, loads
+
+from mysticlib.single_coded_mystic import SingleCodedMystic
+from mysticlib.__util import *
+from mysticlib.__util import LEN_LEN, _read_token, _write_token
+
+# the number of trailing bytes compared to make sure a stream is the one the mystic was last synced with
+SYNC_TAIL_LEN = 32
+
+
+class JournaledMystic(SingleCodedMystic):
+    """
+    A single coded mystic that saves changes by appending encrypted change records (a journal) to its file, instead of
+    re-encrypting all its pairs. Once the journal grows past compact_ratio times the size of the encrypted dict, the
+    next full save folds it back into the dict.
+    The old value of a key that is deleted or overwritten stays in the file (in the dict or in an older record) until
+    the journal is folded into the dict, so with scrub_overwritten (the default), such changes are not appended, and the
+    next save folds the journal instead.
+    format:
+    <header><newline>
+    <number_of_passwords (1 byte)><len of pass1(1 byte)><pass1><len of pass2(1 byte)>...
+    <len of enc_json_dict (4 bytes)><enc_json_dict><len of record1 (4 bytes)><enc record1><len of record2>...
+    each record is a json dict, with the keys "set" (a dict of the pairs set) and "del" (a list of the keys deleted)
+    """
+    header = b'!myst_journaled'
+    format = 'jcm'
+
+    def __init__(self):
+        super().__init__()
+        self.compact_ratio = 1.0
+        self.scrub_overwritten = True
+        # whether a key was deleted or overwritten since the journal was last folded into the dict
+        self._overwritten = False
+        self.coded_journal: List[bytes] = []
+        # changes not yet sealed into a record, a value of None marks a deleted key
+        self._pending: Dict[str, Optional[str]] = {}
+        self._slots_changed = False
+        # the length of the stream the mystic was last read from or written to, its last bytes, and the number of
+        # records in it
+        self._sync_point: Optional[Tuple[int, bytes, int]] = None
+
+    def _decode_dict(self, master) -> dict:
+        ret = super()._decode_dict(master)
+        for record in self.coded_journal:
+            record = loads(unseal(record, master))
+            ret.update(record['set'])
+            for k in record['del']:
+                ret.pop(k, None)
+        return ret
+
+    def _add_slot(self, master, new_password):
+        super()._add_slot(master, new_password)
+        self._slots_changed = True
+
+    def _del_slot(self, index):
+        super()._del_slot(index)
+        self._slots_changed = True
+
+    def _flush_pending(self, minor=None):
+        """
+        seal the pending changes into a new journal record
+        """
+        if not self._pending:
+            return
+        record = {
+            'set': {k: v for (k, v) in self._pending.items() if v is not None},
+            'del': [k for (k, v) in self._pending.items() if v is None]
+        }
+        self.coded_journal.append(seal(dumps(record), self._get_master(minor), self.compression, self.cipher))
+        self._pending.clear()
+
+    def _needs_compaction(self):
+        if self.coded_dict is None or self._payload_outdated() or (self.scrub_overwritten and self._overwritten):
+            return True
+        return sum(len(r) for r in self.coded_journal) > self.compact_ratio * len(self.coded_dict)
+
+    def _compact(self, minor=None):
+        master = self._get_master(minor)
+        d = self._get_dict(minor)
+        self.coded_journal = []
+        self.coded_dict = self._encode_dict(d, master)
+        self._overwritten = False
+
+    @classmethod
+    def from_stream(cls, src: BytesIO, check_header=True) -> 'JournaledMystic':
+        cls._read_header(src, check_header)
+        self = cls()
+        self._read_slots(src)
+        self.coded_dict = _read_token(src)
+        self._read_compression()
+        while True:
+            l = src.read(LEN_LEN)
+            if not l:
+                break
+            if len(l) != LEN_LEN:
+                raise EOFError('mystic ended in the middle of a journal record')
+            record = src.read(int.from_bytes(l, 'big', signed=False))
+            self.coded_journal.append(record)
+        slots = BytesIO()
+        self._write_slots(slots)
+        length = len(self.header) + 1 + len(slots.getvalue()) + LEN_LEN + len(self.coded_dict) \
+                 + sum(LEN_LEN + len(r) for r in self.coded_journal)
+        self._set_sync_point(length)
+        return self
+
+    def _set_sync_point(self, length):
+        tail = self.coded_journal[-1] if self.coded_journal else self.coded_dict
+        self._sync_point = (length, tail[-SYNC_TAIL_LEN:], len(self.coded_journal))
+
+    def to_stream(self, dst: BytesIO, minor=None):
+        if not self.encrypted_passwords:
+            raise Exception(
+                'this mystic has no passwords set, it will be inaccessible unless at least one passwords is added')
+        self._flush_pending(minor)
+        if self._needs_compaction():
+            self._compact(minor)
+        slots = BytesIO()
+        self._write_slots(slots)
+        dst.write(self.header + b'\n')
+        dst.write(slots.getvalue())
+        length = len(self.header) + 1 + len(slots.getvalue()) + _write_token(dst, self.coded_dict)
+        for record in self.coded_journal:
+            length += _write_token(dst, record)
+        self._set_sync_point(length)
+        self._slots_changed = self._changed = False
+
+    def append_to_stream(self, dst: BytesIO, minor=None) -> bool:
+        if self._sync_point is None or self._slots_changed:
+            return False
+        length, tail, synced_records = self._sync_point
+        dst.seek(0, SEEK_END)
+        if dst.tell() != length:
+            return False
+        dst.seek(length - len(tail))
+        if dst.read(len(tail)) != tail:
+            return False
+        self._flush_pending(minor)
+        if self._needs_compaction():
+            return False
+        dst.seek(0, SEEK_END)
+        for record in self.coded_journal[synced_records:]:
+            length += _write_token(dst, record)
+        self._set_sync_point(length)
+        self._changed = False
+        return True
+
+    def __setitem__(self, key, value, minor=None):
+        # look the dict up once, each lookup decrypts the vault when it isn't cached
+        d = self._get_dict(minor)
+        if key in d:
+            self._overwritten = True
+        d[key] = value
+        self._changed = True
+        self._pending[key] = value
+
+    def __delitem__(self, key, minor=None):
+        super().__delitem__(key, minor)
+        self._pending[key] = None
+        self._overwritten = True
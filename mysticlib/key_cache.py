@@ -0,0 +1,119 @@
+from typing import Optional, Dict, Tuple
+from threading import RLock, Timer
+import time
+
+
+class KeyCache:
+    """
+    holds the master key of an unlocked mystic (and the keys derived from it), so that repeated accesses need not run
+    the key derivation again. The keys are wiped after ttl seconds since unlocking, or after idle seconds without use,
+    whichever comes first. None disables the respective timeout.
+    """
+
+    def __init__(self, ttl: Optional[float] = 300, idle: Optional[float] = 60):
+        self.ttl = ttl
+        self.idle = idle
+        self._lock = RLock()
+        self._master: Optional[bytearray] = None
+        self._derived: Dict[Tuple[bytes, int], bytearray] = {}
+        self._unlocked_at = None
+        self._last_used = None
+        self._timer: Optional[Timer] = None
+
+    def _deadline(self):
+        deadlines = []
+        if self.ttl is not None:
+            deadlines.append(self._unlocked_at + self.ttl)
+        if self.idle is not None:
+            deadlines.append(self._last_used + self.idle)
+        if not deadlines:
+            return None
+        return min(deadlines)
+
+    def _schedule(self):
+        # a single timer is kept, when it fires it re-schedules itself if the key was used in the meantime
+        deadline = self._deadline()
+        if deadline is None or self._timer is not None:
+            return
+        self._timer = Timer(max(deadline - time.monotonic(), 0), self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _expire(self) -> bool:
+        """
+        lock the cache if it has expired, return whether it is now locked
+        """
+        if self._master is None:
+            return True
+        deadline = self._deadline()
+        if deadline is not None and time.monotonic() >= deadline:
+            self.lock()
+            return True
+        return False
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            if not self._expire():
+                self._schedule()
+
+    def _touch(self) -> bool:
+        """
+        mark the keys as used, return whether they are still available
+        """
+        if self._expire():
+            return False
+        self._last_used = time.monotonic()
+        return True
+
+    @property
+    def unlocked(self) -> bool:
+        with self._lock:
+            return not self._expire()
+
+    def get_master(self) -> Optional[bytes]:
+        with self._lock:
+            if not self._touch():
+                return None
+            return bytes(self._master)
+
+    def set_master(self, master: bytes):
+        with self._lock:
+            if self._master is not None and self._master == master:
+                self._touch()
+                return
+            self.lock()
+            self._master = bytearray(master)
+            self._unlocked_at = self._last_used = time.monotonic()
+            self._schedule()
+
+    def get_derived(self, salt: bytes, hash_iterations: int) -> Optional[bytes]:
+        with self._lock:
+            if not self._touch():
+                return None
+            ret = self._derived.get((bytes(salt), hash_iterations))
+            if ret is None:
+                return None
+            return bytes(ret)
+
+    def set_derived(self, salt: bytes, hash_iterations: int, key: bytes):
+        with self._lock:
+            if self._master is None:
+                return
+            self._derived[bytes(salt), hash_iterations] = bytearray(key)
+
+    def lock(self):
+        with self._lock:
+            if self._master is not None:
+                self._master[:] = bytes(len(self._master))
+                self._master = None
+            for v in self._derived.values():
+                v[:] = bytes(len(v))
+            self._derived.clear()
+            self._unlocked_at = self._last_used = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+
+__all__ = ['KeyCache']
@@ -1,8 +1,11 @@
 #from __future__ import annotations
 
-from typing import Callable, Optional, Type, Dict
+from typing import Callable, Optional, Type, Dict, Mapping
 from abc import ABC, abstractmethod
 from io import BytesIO
+from types import MappingProxyType
+
+from mysticlib.__util import BufferReader
 
 from typing import MutableMapping
 
@@ -19,15 +22,28 @@ class Mystic(ABC, MutableMapping[str, str]):
     formats: Dict[str, Type['Mystic']] = {}
 
     def __init_subclass__(cls):
-        cls.headers[cls.header] = cls
-        cls.formats[cls.format] = cls
+        # abstract intermediate classes don't declare a header of their own, and aren't registered
+        if 'header' in cls.__dict__:
+            cls.headers[cls.header] = cls
+        if 'format' in cls.__dict__:
+            cls.formats[cls.format] = cls
 
     @classmethod
     def new_from_format(cls, format_: str)->'Mystic':
+        """
+        create a new mystic of a format, options for the format can follow it after a colon (e.g. shm:64)
+        """
+        format_, _, options = format_.partition(':')
         subclass = cls.formats.get(format_, None)
         if subclass is None:
             raise ValueError(f'unrecognized format {format_}')
-        return subclass()
+        ret = subclass()
+        if options:
+            ret.set_format_options(options)
+        return ret
+
+    def set_format_options(self, options: str):
+        raise ValueError(f'the {self.format} format takes no options')
 
     @abstractmethod
     def __getitem__(self, item: str) -> str:
@@ -43,6 +59,14 @@ class Mystic(ABC, MutableMapping[str, str]):
             raise ValueError(f'unrecognised file header {header}')
         return subclass.from_stream(src,check_header=False)
 
+    @classmethod
+    def from_buffer(cls, buffer, check_header=True) -> 'Mystic':
+        """
+        read a mystic from a bytes-like object (bytes, memoryview, mmap...). The mystic keeps views of the buffer
+        rather than copies, so the buffer must not change while the mystic is in use.
+        """
+        return cls.from_stream(BufferReader(buffer), check_header)
+
     @abstractmethod
     def __delitem__(self, item: str) -> str:
         pass
@@ -55,6 +79,14 @@ class Mystic(ABC, MutableMapping[str, str]):
     def to_stream(self, dst: BytesIO, minor=None):
         pass
 
+    def append_to_stream(self, dst: BytesIO, minor=None) -> bool:
+        """
+        write only the changes made since the mystic was last read from or written to dst, dst must be readable and
+        seekable. Returns False (after writing nothing) if the mystic cannot save this way, or dst is not the stream
+        the mystic was last synced with.
+        """
+        return False
+
     @property
     @abstractmethod
     def mutable(self) -> bool:
@@ -76,3 +108,18 @@ class Mystic(ABC, MutableMapping[str, str]):
     @abstractmethod
     def changed(self)->bool:
         pass
+
+    def snapshot(self, minor=None) -> Mapping[str, str]:
+        """
+        get a read-only copy of all the mystic's pairs, decrypting the mystic only once
+        """
+        return MappingProxyType(dict(self.items()))
+
+    def enable_key_cache(self, ttl=300, idle=60):
+        raise TypeError(f'{type(self).__name__} does not support caching its key')
+
+    def lock(self):
+        """
+        forget any unlocked key the mystic holds, so that the next access requires a password
+        """
+        pass
@@ -0,0 +1,171 @@
+from typing import Iterable, Iterator, Tuple, List, Optional, Sequence, Dict
+from array import array
+from itertools import accumulate, islice
+import struct
+import sys
+
+from json import dumps, loads
+
+JSON_RECORDS = b'j'
+BINARY_RECORDS = b'b'
+
+
+def dump_json_records(items: Iterable[Tuple[str, str]]) -> Iterator[bytes]:
+    """
+    encode pairs as json lines, one line per pair
+    """
+    for k, v in items:
+        # json escapes newlines inside strings, so a newline always ends a record
+        yield bytes(dumps([k, v]), 'utf-8') + b'\n'
+
+
+class JsonRecordParser:
+    """
+    An incremental parser of json line records, data can be fed in pieces of any size
+    """
+
+    def __init__(self):
+        self._rest = b''
+
+    def feed(self, data: bytes) -> List[Tuple[str, str]]:
+        *lines, self._rest = (self._rest + data).split(b'\n')
+        ret = []
+        for line in lines:
+            k, v = loads(line)
+            ret.append((k, v))
+        return ret
+
+    def close(self):
+        if self._rest:
+            raise ValueError('record stream ended in the middle of a record')
+
+
+# binary records are written in blocks:
+# <number of records (4 bytes)><len of data (4 bytes)><len of key1 (4 bytes)><len of value1 (4 bytes)><len of key2>...
+# <data>
+# where data is all the keys and values, concatenated and encoded in utf-8. The lengths are in characters, so the data
+# is decoded in one go and then sliced. All numbers are little-endian.
+BLOCK_LEN = 1024
+_block_header = struct.Struct('<II')
+_LEN_CODE = 'I' if array('I').itemsize == 4 else 'L'
+
+
+def _lengths_to_bytes(lengths: array) -> bytes:
+    if sys.byteorder != 'little':
+        lengths.byteswap()
+    return lengths.tobytes()
+
+
+def _lengths_from_bytes(b) -> array:
+    ret = array(_LEN_CODE)
+    ret.frombytes(b)
+    if sys.byteorder != 'little':
+        ret.byteswap()
+    return ret
+
+
+def encode_binary_block(items: Sequence[Tuple[str, str]]) -> bytes:
+    strings = [s for pair in items for s in pair]
+    lengths = array(_LEN_CODE, map(len, strings))
+    data = ''.join(strings).encode('utf-8', 'surrogatepass')
+    return _block_header.pack(len(items), len(data)) + _lengths_to_bytes(lengths) + data
+
+
+def dump_binary_records(items: Iterable[Tuple[str, str]], block_len=BLOCK_LEN) -> Iterator[bytes]:
+    """
+    encode pairs as binary record blocks, of up to block_len pairs each
+    """
+    items = iter(items)
+    while True:
+        block = list(islice(items, block_len))
+        if not block:
+            return
+        yield encode_binary_block(block)
+
+
+def encode_binary_records(items: Iterable[Tuple[str, str]], block_len=BLOCK_LEN) -> bytes:
+    return b''.join(dump_binary_records(items, block_len))
+
+
+def _block_size(buffer, offset=0) -> Optional[int]:
+    """
+    get the size of the block starting at offset, or None if the buffer doesn't hold the block's header
+    """
+    if len(buffer) - offset < _block_header.size:
+        return None
+    count, data_len = _block_header.unpack_from(buffer, offset)
+    return _block_header.size + 8 * count + data_len
+
+
+def _decode_block(buffer, offset, values) -> Iterator[Tuple[str, Optional[str]]]:
+    count, data_len = _block_header.unpack_from(buffer, offset)
+    offset += _block_header.size
+    lengths = _lengths_from_bytes(buffer[offset: offset + 8 * count])
+    offset += 8 * count
+    data = str(buffer[offset: offset + data_len], 'utf-8', 'surrogatepass')
+    bounds = [0]
+    bounds.extend(accumulate(lengths))
+    strings = map(data.__getitem__, map(slice, bounds, islice(bounds, 1, None)))
+    if values:
+        return zip(strings, strings)
+    return ((k, None) for k in islice(strings, 0, None, 2))
+
+
+def _blocks(buffer, values) -> Iterator[Iterator[Tuple[str, Optional[str]]]]:
+    buffer = memoryview(buffer)
+    offset = 0
+    while offset < len(buffer):
+        size = _block_size(buffer, offset)
+        if size is None or offset + size > len(buffer):
+            raise ValueError('record buffer ended in the middle of a block')
+        yield _decode_block(buffer, offset, values)
+        offset += size
+
+
+def iter_binary_records(buffer, values=True) -> Iterator[Tuple[str, Optional[str]]]:
+    """
+    decode binary records from a bytes-like object, one block at a time, so a caller that stops iterating early doesn't
+    pay for the rest of the records. If values is False, the values are yielded as None.
+    """
+    for block in _blocks(buffer, values):
+        yield from block
+
+
+def decode_binary_records(buffer) -> Dict[str, str]:
+    ret = {}
+    for block in _blocks(buffer, True):
+        ret.update(block)
+    return ret
+
+
+class BinaryRecordParser:
+    """
+    An incremental parser of binary records, data can be fed in pieces of any size
+    """
+
+    def __init__(self):
+        self._rest = bytearray()
+
+    def feed(self, data: bytes) -> List[Tuple[str, str]]:
+        self._rest += data
+        ret = []
+        offset = 0
+        while True:
+            size = _block_size(self._rest, offset)
+            if size is None or offset + size > len(self._rest):
+                break
+            ret.extend(_decode_block(self._rest, offset, True))
+            offset += size
+        del self._rest[:offset]
+        return ret
+
+    def close(self):
+        if self._rest:
+            raise ValueError('record stream ended in the middle of a block')
+
+
+record_dumpers = {JSON_RECORDS: dump_json_records, BINARY_RECORDS: dump_binary_records}
+record_parsers = {JSON_RECORDS: JsonRecordParser, BINARY_RECORDS: BinaryRecordParser}
+
+__all__ = ['JSON_RECORDS', 'BINARY_RECORDS', 'dump_json_records', 'JsonRecordParser', 'dump_binary_records',
+           'encode_binary_records', 'iter_binary_records', 'decode_binary_records', 'BinaryRecordParser', 'record_dumpers', 'record_parsers']
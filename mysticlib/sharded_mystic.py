@@ -0,0 +1,219 @@
+from typing import Dict, Iterator, List, Optional, Set
+from io import BytesIO
+
+from json import dumps, loads
+import hashlib
+import hmac
+
+from mysticlib.slotted_mystic import SlottedMystic
+from mysticlib.blind_index import *
+from mysticlib.__util import *
+from mysticlib.__util import LEN_LEN, _read_token, _write_token
+
+DEFAULT_BUCKETS = 16
+
+
+class ShardedMystic(SlottedMystic):
+    """
+    A mystic whose pairs are split between buckets by a keyed hash of their key, every bucket encrypted on its own as a
+    json dict, so reading or writing a key only decrypts (and re-encrypts) one bucket. The bucket count, the number
+    of pairs, and a digest of every encrypted bucket are stored in an encrypted manifest, so buckets that were dropped,
+    swapped, or replaced with older ones are detected when they are read.
+    format:
+    <header><newline>
+    <number_of_passwords (1 byte)><len of pass1(1 byte)><pass1><len of pass2(1 byte)>...
+    <len of enc manifest (4 bytes)><enc manifest><len of enc bucket0 (4 bytes)><enc bucket0><len of enc bucket1>...
+    the manifest is the json {"buckets": <number of buckets>, "entries": <number of pairs>, "digests": [<hex sha256 of
+    enc bucket0>, ...]}
+    """
+    header = b'!myst_sharded'
+    format = 'shm'
+
+    def __init__(self):
+        super().__init__()
+        self.cache = False
+        # the bucket count of a new mystic, an existing mystic keeps the count of its manifest
+        self.bucket_count = DEFAULT_BUCKETS
+        self.coded_manifest: Optional[bytes] = None
+        self.coded_buckets: List[bytes] = []
+        self._manifest: Optional[dict] = None
+        # the decrypted buckets, only kept in mutable mode or when they have unsaved changes
+        self._buckets: Dict[int, Dict[str, str]] = {}
+        self._changed_buckets: Set[int] = set()
+        self._master = None
+
+    def set_format_options(self, options: str):
+        """
+        options: the bucket count
+        """
+        try:
+            bucket_count = int(options)
+        except ValueError as e:
+            raise ValueError(f'bucket count must be a number, got {options}') from e
+        if bucket_count <= 0:
+            raise ValueError(f'bucket count must be positive, got {bucket_count}')
+        self.bucket_count = bucket_count
+
+    @property
+    def mutable(self):
+        return self.cache
+
+    @mutable.setter
+    def mutable(self, v: bool):
+        self.cache = v
+        if not v:
+            self._master = None
+            self._drop_unchanged_buckets()
+
+    def lock(self):
+        super().lock()
+        self._master = None
+        self._drop_unchanged_buckets()
+
+    def _drop_unchanged_buckets(self):
+        self._buckets = {i: b for (i, b) in self._buckets.items() if i in self._changed_buckets}
+
+    def _unlock_master(self, minor=None) -> bytes:
+        master = self._master
+        if master is None:
+            master = self._get_master(minor)
+            if self.cache:
+                self._master = master
+        return master
+
+    def _get_manifest(self, master) -> dict:
+        if self._manifest is None:
+            if self.coded_manifest is None:
+                self._manifest = {'buckets': self.bucket_count, 'entries': 0, 'digests': []}
+            else:
+                manifest = loads(unseal(self.coded_manifest, master))
+                # the manifest is authenticated, the bucket list isn't, so missing or extra buckets are caught here
+                if len(self.coded_buckets) != manifest['buckets'] or len(manifest['digests']) != manifest['buckets']:
+                    raise ValueError(f'the mystic has {len(self.coded_buckets)} buckets, its manifest lists'
+                                     f' {manifest["buckets"]}')
+                self._manifest = manifest
+        return self._manifest
+
+    def _bucket_of(self, master, key) -> int:
+        return int.from_bytes(blind_tag(index_key(master), key), 'big') % self._get_manifest(master)['buckets']
+
+    def _get_bucket(self, master, i) -> Dict[str, str]:
+        bucket = self._buckets.get(i)
+        if bucket is None:
+            if i < len(self.coded_buckets):
+                # every bucket is checked against the manifest as it is read, so a bucket can't be moved or rolled back
+                digest = hashlib.sha256(self.coded_buckets[i]).hexdigest()
+                if not hmac.compare_digest(digest, self._get_manifest(master)['digests'][i]):
+                    raise ValueError(f'bucket {i} does not match the manifest')
+                bucket = loads(unseal(self.coded_buckets[i], master))
+            elif self.coded_manifest is None:
+                # a bucket of a new mystic, that was never saved
+                bucket = {}
+            else:
+                raise ValueError(f'bucket {i} is missing')
+            if self.cache:
+                self._buckets[i] = bucket
+        return bucket
+
+    def _iter_buckets(self, minor=None) -> Iterator[Dict[str, str]]:
+        master = self._unlock_master(minor)
+        for i in range(self._get_manifest(master)['buckets']):
+            yield self._get_bucket(master, i)
+
+    @classmethod
+    def from_stream(cls, src: BytesIO, check_header=True) -> 'ShardedMystic':
+        cls._read_header(src, check_header)
+        self = cls()
+        self._read_slots(src)
+        self.coded_manifest = _read_token(src)
+        while True:
+            l = src.read(LEN_LEN)
+            if not l:
+                break
+            if len(l) != LEN_LEN:
+                raise EOFError('mystic ended in the middle of a bucket')
+            bucket_len = int.from_bytes(l, 'big', signed=False)
+            bucket = src.read(bucket_len)
+            if len(bucket) != bucket_len:
+                raise EOFError('mystic ended in the middle of a bucket')
+            self.coded_buckets.append(bucket)
+        return self
+
+    def to_stream(self, dst: BytesIO, minor=None):
+        if not self.encrypted_passwords:
+            raise Exception(
+                'this mystic has no passwords set, it will be inaccessible unless at least one passwords is added')
+        dst.write(self.header + b'\n')
+        self._write_slots(dst)
+        if self._changed or self.coded_manifest is None:
+            master = self._unlock_master(minor)
+            manifest = self._get_manifest(master)
+            coded_buckets = list(self.coded_buckets)
+            while len(coded_buckets) < manifest['buckets']:
+                coded_buckets.append(None)
+            digests = list(manifest['digests'])
+            digests += [None] * (manifest['buckets'] - len(digests))
+            for i, coded in enumerate(coded_buckets):
+                if i in self._changed_buckets or coded is None:
+                    coded_buckets[i] = seal(dumps(self._get_bucket(master, i)), master, cipher=self.cipher)
+                    digests[i] = hashlib.sha256(coded_buckets[i]).hexdigest()
+            manifest['digests'] = digests
+            self.coded_buckets = coded_buckets
+            self.coded_manifest = seal(dumps(manifest), master, cipher=self.cipher)
+            self._changed_buckets.clear()
+            if not self.cache:
+                self._buckets.clear()
+        _write_token(dst, self.coded_manifest)
+        for bucket in self.coded_buckets:
+            _write_token(dst, bucket)
+        self._changed = False
+
+    def __getitem__(self, item, minor=None):
+        master = self._unlock_master(minor)
+        return self._get_bucket(master, self._bucket_of(master, item))[item]
+
+    def __contains__(self, key):
+        master = self._unlock_master()
+        return key in self._get_bucket(master, self._bucket_of(master, key))
+
+    def __setitem__(self, key, value, minor=None):
+        master = self._unlock_master(minor)
+        i = self._bucket_of(master, key)
+        bucket = self._get_bucket(master, i)
+        if key not in bucket:
+            self._get_manifest(master)['entries'] += 1
+        bucket[key] = value
+        self._buckets[i] = bucket
+        self._changed_buckets.add(i)
+        self._changed = True
+
+    def __delitem__(self, key, minor=None):
+        master = self._unlock_master(minor)
+        i = self._bucket_of(master, key)
+        bucket = self._get_bucket(master, i)
+        del bucket[key]
+        self._get_manifest(master)['entries'] -= 1
+        self._buckets[i] = bucket
+        self._changed_buckets.add(i)
+        self._changed = True
+
+    def __len__(self):
+        return self._get_manifest(self._unlock_master())['entries']
+
+    def __iter__(self):
+        for bucket in self._iter_buckets():
+            yield from bucket
+
+    def items(self, minor=None):
+        for bucket in self._iter_buckets(minor):
+            yield from bucket.items()
+
+    def values(self, minor=None):
+        for bucket in self._iter_buckets(minor):
+            yield from bucket.values()
+
+    def get(self, key, default=None, minor=None):
+        try:
+            return self.__getitem__(key, minor)
+        except KeyError:
+            return default
@@ -1,63 +1,119 @@
-from typing import MutableSequence
+from typing import Mapping
+from types import MappingProxyType
 from io import BytesIO
 
 from json import dumps, loads
 
-from cryptography.fernet import InvalidToken, Fernet
-
-from mysticlib.mystic import Mystic
-from mysticlib.exceptions import BadKey
+from mysticlib.slotted_mystic import SlottedMystic
+from mysticlib.instrumentation import instrumented
+from mysticlib.records import JSON_RECORDS, BINARY_RECORDS, encode_binary_records, decode_binary_records
 from mysticlib.__util import *
+from mysticlib.__util import _token_format
+
+# a binary payload starts with a zero byte followed by its record format, a json payload always starts with "{"
+_BINARY_PREFIX = b'\0' + BINARY_RECORDS
+# the PBKDF2 iterations of the body key. The body is encrypted under the master key, which is random (not a password),
+# so stretching it adds nothing, and a single iteration is an HMAC of the master key. The profile is recorded in the
+# cyphertext, so bodies written with other profiles are still read.
+BODY_ITER = 1
 
 
-class SingleCodedMystic(Mystic):
+class SingleCodedMystic(SlottedMystic):
     """
     format:
     <header><newline>
     <number_of_passwords (1 byte)><len of pass1(1 byte)><pass1><len of pass2(1 byte)>...<enc_json_dict>
     # note, last line does NOT have newline terminator
+    if record_format is BINARY_RECORDS, the encrypted dict is instead a zero byte, the format byte, and binary records
     """
     header = b'!myst_single_coded'
     format = 'scm'
 
     def __init__(self):
         super().__init__()
-        self.encrypted_passwords: MutableSequence[bytes] = []
         self.cache = False
         self.coded_dict = None
         self.cached_dict = None
-        self._changed = False
-
-    def _get_master(self, minor=None, prompt='enter password\n'):
-        # todo cache the produced derived key
-        if not self.encrypted_passwords:
-            return Fernet.generate_key()
-        if minor is None:
-            minor = self.password_callback(prompt)
-        for ep in self.encrypted_passwords:
-            try:
-                return dec(ep, minor)
-            except InvalidToken:
-                pass
-        raise BadKey('bad key')
-
+        # the record format to write the dict in, None to keep the format it was read in (json for new mystics)
+        self.record_format = None
+        self._payload_format = None
+        # the compression of the encrypted dict (ZLIB or LZMA), it is recorded in the cyphertext, so reading doesn't
+        # depend on it, a mystic that is read keeps the compression of its dict
+        self.compression = None
+        self._payload_compression = None
+
+    def _read_compression(self):
+        if self.coded_dict:
+            _, _, token = parse_envelope(self.coded_dict)
+            self.compression, _ = _token_format(token)
+            self._payload_compression = self.compression
+
+    def _payload_outdated(self):
+        """
+        whether the encrypted dict should be re-encrypted, since its record format or compression were changed
+        """
+        return (self.record_format is not None and self.record_format != self._payload_format) \
+            or self.compression != self._payload_compression
+
+    def _body_key(self, master, salt, hash_iterations):
+        if self.key_cache is None:
+            return derive_key(master, salt, hash_iterations)
+        key = self.key_cache.get_derived(salt, hash_iterations)
+        if key is None:
+            key = derive_key(master, salt, hash_iterations)
+            self.key_cache.set_derived(salt, hash_iterations, key)
+        return key
+
+    def _encode_dict(self, d, master) -> bytes:
+        record_format = self.record_format or self._payload_format or JSON_RECORDS
+        if record_format == BINARY_RECORDS:
+            plaintext = _BINARY_PREFIX + encode_binary_records(d.items())
+        elif record_format == JSON_RECORDS:
+            plaintext = dumps(d)
+        else:
+            raise ValueError(f'unrecognized record format {record_format}')
+        self._payload_format = record_format
+        self._payload_compression = self.compression
+        if self.key_cache is not None and self.coded_dict is not None:
+            # re-use the previous salt so the cached derived key stays valid, Fernet adds its own random IV
+            salt, hash_iterations, _ = parse_envelope(self.coded_dict)
+            return enc(plaintext, None, hash_iterations, salt, key=self._body_key(master, salt, hash_iterations),
+                       compression=self.compression, cipher=self.cipher)
+        return enc(plaintext, master, BODY_ITER, compression=self.compression, cipher=self.cipher)
+
+    def _decode_dict(self, master) -> dict:
+        if self.coded_dict is None:
+            plain = '{}'
+        else:
+            salt, hash_iterations, _ = parse_envelope(self.coded_dict)
+            plain = dec(self.coded_dict, None, key=self._body_key(master, salt, hash_iterations))
+        if plain[:1] == b'\0':
+            if plain[:2] != _BINARY_PREFIX:
+                raise ValueError(f'unrecognized record format {plain[1:2]}')
+            self._payload_format = BINARY_RECORDS
+            return decode_binary_records(memoryview(plain)[2:])
+        self._payload_format = JSON_RECORDS
+        return loads(plain)
+
+    @instrumented('commit', lambda ret, self, *args, **kwargs: len(self.coded_dict))
     def _commit(self, minor=None):
         if self.cached_dict is None and self.coded_dict is None:
             self.cached_dict = {}
-        assert self.cached_dict is not None
-        plaintext = dumps(self.cached_dict)
-        self.coded_dict = enc(plaintext, self._get_master(minor))
+        master = self._get_master(minor)
+        if self.cached_dict is not None:
+            d = self.cached_dict
+        else:
+            # only the record format or compression changed
+            assert not self._changed
+            d = self._decode_dict(master)
+        self.coded_dict = self._encode_dict(d, master)
         self._changed = False
 
+    @instrumented('get_dict')
     def _get_dict(self, minor=None):
         if self.cached_dict is not None:
             return self.cached_dict
-        master = self._get_master(minor)
-        if self.coded_dict is None:
-            plain = '{}'
-        else:
-            plain = dec(self.coded_dict, master)
-        ret = loads(plain)
+        ret = self._decode_dict(self._get_master(minor))
         if self.cache:
             self.cached_dict = ret
         return ret
@@ -65,21 +121,20 @@ class SingleCodedMystic(Mystic):
     def load(self, minor=None):
         return self._get_dict(minor)
 
+    def snapshot(self, minor=None) -> Mapping[str, str]:
+        ret = self._get_dict(minor)
+        if ret is self.cached_dict:
+            ret = dict(ret)
+        return MappingProxyType(ret)
+
     @classmethod
     def from_stream(cls, src: BytesIO, check_header=True) -> 'SingleCodedMystic':
-        if check_header:
-            header = src.readline().rstrip()  # next(src).rstrip()
-            if header != cls.header:
-                raise ValueError(f'header mismatch, expected {cls.header}, got {header}')
-        num_of_passwords = int(src.read(1)[0])
-        self = SingleCodedMystic()
-        self.encrypted_passwords = []
-        for _ in range(num_of_passwords):
-            l = int(src.read(1)[0])
-            ep = src.read(l)
-            self.encrypted_passwords.append(ep)
+        cls._read_header(src, check_header)
+        self = cls()
+        self._read_slots(src)
         self.coded_dict = src.read()
         assert self.coded_dict[-1] != b'\n'
+        self._read_compression()
         return self
 
     def to_stream(self, dst: BytesIO, minor=None):
@@ -87,26 +142,11 @@ class SingleCodedMystic(Mystic):
             raise Exception(
                 'this mystic has no passwords set, it will be inaccessible unless at least one passwords is added')
         dst.write(self.header + b'\n')
-        if len(self.encrypted_passwords) >= 256:
-            raise Exception('too many passwords in singe coded mystic')
-        dst.write(bytes([len(self.encrypted_passwords)]))
-        for ep in self.encrypted_passwords:
-            if len(ep) > 256:
-                raise Exception(f'password too long: {ep}')
-            dst.write(bytes([len(ep)]))
-            dst.write(ep)
-        if self._changed:
+        self._write_slots(dst)
+        if self._changed or self._payload_outdated():
             self._commit(minor)
         dst.write(self.coded_dict)
 
-    def add_password(self, old_password=None, new_password=None):
-        master = self._get_master(old_password, prompt='enter old password\n')
-        if new_password is None:
-            new_password = self.password_callback('enter new password\n')
-        new_minor = enc(master, new_password)
-        self.encrypted_passwords.append(new_minor)
-        self._changed = True
-
     def __getitem__(self, item, minor=None):
         return self._get_dict(minor)[item]
 
@@ -129,32 +169,24 @@ class SingleCodedMystic(Mystic):
         del self._get_dict(minor)[key]
         self._changed = True
 
-    def del_password(self, minor=None):
-        if len(self.encrypted_passwords) == 1:
-            raise Exception('cannot delete the last password of a mystic')
-        if minor is None:
-            minor = self.password_callback()
-        for ep in self.encrypted_passwords:
-            try:
-                dec(ep, minor)
-            except InvalidToken:
-                pass
-            else:
-                self.encrypted_passwords.remove(ep)
-                self._changed = True
-                return
-        raise BadKey
-
     def __len__(self):
         return len(self._get_dict())
 
     def __iter__(self):
         return iter(self._get_dict())
 
+    # the default implementations of these access the mystic once per key, which means one decryption per key when not
+    # in mutable mode
+    def keys(self):
+        return self._get_dict().keys()
+
+    def items(self):
+        return self._get_dict().items()
+
+    def values(self):
+        return self._get_dict().values()
+
     def get(self, *args, minor=None, **kwargs):
         if minor is None:
             return super().get(*args, **kwargs)
         return self.load(minor=minor).get(*args, **kwargs)
-
-    def changed(self):
-        return self._changed
@@ -0,0 +1,178 @@
+from typing import MutableSequence, Optional, Tuple, Sequence
+from io import BytesIO
+from concurrent.futures import Executor, ThreadPoolExecutor, as_completed
+from threading import Lock
+
+from cryptography.fernet import InvalidToken, Fernet
+
+from mysticlib.mystic import Mystic
+from mysticlib.exceptions import BadKey
+from mysticlib.key_cache import KeyCache
+from mysticlib.instrumentation import instrumented
+from mysticlib.__util import *
+from mysticlib.__util import _token_format
+
+_slot_executor: Optional[Executor] = None
+_slot_executor_lock = Lock()
+
+
+def _default_slot_executor() -> Executor:
+    global _slot_executor
+    with _slot_executor_lock:
+        if _slot_executor is None:
+            _slot_executor = ThreadPoolExecutor(thread_name_prefix='mystic_slot')
+        return _slot_executor
+
+
+def _try_slot(ep: bytes, minor) -> Optional[bytes]:
+    # module-level so it can be sent to a process pool
+    try:
+        return dec(ep, minor)
+    except InvalidToken:
+        return None
+
+
+class SlottedMystic(Mystic):
+    """
+    A base class for mystics whose data is encrypted under a random master key, with the master key encrypted once
+    for every master password (each such encryption is a password slot)
+    slots format:
+    <number_of_passwords (1 byte)><len of pass1(1 byte)><pass1><len of pass2(1 byte)>...
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.encrypted_passwords: MutableSequence[bytes] = []
+        self._changed = False
+        self.key_cache: Optional[KeyCache] = None
+        # the executor password slots are tried on concurrently, None to use a shared thread pool
+        self.slot_executor: Optional[Executor] = None
+        # the master key of a mystic that has no passwords yet
+        self._new_master = None
+        # the cipher new slots and data are encrypted with (AES_GCM or CHACHA20_POLY1305), None for Fernet. Every token
+        # records its cipher, so reading doesn't depend on it, a mystic that is read keeps the cipher of its first slot
+        self.cipher = None
+        # the KDF profile of new slots (see calibrate_kdf), None for DEFAULT_ITER PBKDF2 iterations. Every slot records
+        # its profile, so reading doesn't depend on it
+        self.kdf = None
+
+    @classmethod
+    def _read_header(cls, src: BytesIO, check_header):
+        if check_header:
+            header = src.readline().rstrip()  # next(src).rstrip()
+            if header != cls.header:
+                raise ValueError(f'header mismatch, expected {cls.header}, got {header}')
+
+    def enable_key_cache(self, ttl=300, idle=60):
+        """
+        keep the master key (and the key derived from it for the body) in memory after the first unlock, so that
+        further accesses don't run the key derivation again. The keys are wiped after ttl seconds, or after idle seconds
+        of not being used, or when lock is called.
+        """
+        self.lock()
+        self.key_cache = KeyCache(ttl, idle)
+
+    def lock(self):
+        if self.key_cache is not None:
+            self.key_cache.lock()
+
+    @instrumented('get_master')
+    def _get_master(self, minor=None, prompt='enter password\n', use_cache=True):
+        if use_cache and self.key_cache is not None:
+            master = self.key_cache.get_master()
+            if master is not None:
+                return master
+        if not self.encrypted_passwords:
+            if self._new_master is None:
+                self._new_master = Fernet.generate_key()
+            return self._new_master
+        if minor is None:
+            minor = self.password_callback(prompt)
+        _, master = self._find_slot(minor)
+        if self.key_cache is not None:
+            self.key_cache.set_master(master)
+        return master
+
+    def _find_slot(self, minor) -> Tuple[int, bytes]:
+        """
+        find the index of the password slot that minor unlocks, along with the master key stored in it
+        """
+        candidates = self._slot_candidates(minor)
+        # a single slot is tried in the calling thread, unless an executor was set (to move the key derivation to other
+        # processes)
+        if len(candidates) == 1 and self.slot_executor is None:
+            i, = candidates
+            master = _try_slot(self.encrypted_passwords[i], minor)
+            if master is None:
+                raise BadKey('bad key')
+            return i, master
+        # the key derivation releases the GIL, so all the slots can be tried at once
+        executor = self.slot_executor or _default_slot_executor()
+        futures = {executor.submit(_try_slot, self.encrypted_passwords[i], minor): i for i in candidates}
+        try:
+            for future in as_completed(futures):
+                master = future.result()
+                if master is not None:
+                    return futures[future], master
+        finally:
+            for future in futures:
+                future.cancel()
+        raise BadKey('bad key')
+
+    def _slot_candidates(self, minor) -> Sequence[int]:
+        """
+        get the indices of the password slots that minor might unlock
+        """
+        return range(len(self.encrypted_passwords))
+
+    def _add_slot(self, master, new_password):
+        self.encrypted_passwords.append(enc(master, new_password, self.kdf or DEFAULT_ITER, cipher=self.cipher))
+
+    def _del_slot(self, index):
+        del self.encrypted_passwords[index]
+
+    def _read_slots(self, src: BytesIO):
+        num_of_passwords = int(src.read(1)[0])
+        self.encrypted_passwords = []
+        for _ in range(num_of_passwords):
+            l = int(src.read(1)[0])
+            ep = bytes(src.read(l))
+            self.encrypted_passwords.append(ep)
+        self._read_cipher()
+
+    def _read_cipher(self):
+        if self.encrypted_passwords:
+            _, _, token = parse_envelope(self.encrypted_passwords[0])
+            _, self.cipher = _token_format(token)
+
+    def _write_slots(self, dst: BytesIO):
+        if len(self.encrypted_passwords) >= 256:
+            raise Exception('too many passwords in singe coded mystic')
+        dst.write(bytes([len(self.encrypted_passwords)]))
+        for ep in self.encrypted_passwords:
+            if len(ep) > 255:
+                raise Exception(f'password too long: {ep}')
+            dst.write(bytes([len(ep)]))
+            dst.write(ep)
+
+    def add_password(self, old_password=None, new_password=None):
+        # adding a password always requires the old one, even if the mystic is unlocked
+        master = self._get_master(old_password, prompt='enter old password\n', use_cache=False)
+        if self.key_cache is not None:
+            self.key_cache.set_master(master)
+        if new_password is None:
+            new_password = self.password_callback('enter new password\n')
+        self._add_slot(master, new_password)
+        self._changed = True
+
+    def del_password(self, minor=None):
+        if len(self.encrypted_passwords) == 1:
+            raise Exception('cannot delete the last password of a mystic')
+        if minor is None:
+            minor = self.password_callback()
+        i, _ = self._find_slot(minor)
+        self._del_slot(i)
+        self._changed = True
+
+    def changed(self):
+        return self._changed
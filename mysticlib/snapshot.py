@@ -0,0 +1,26 @@
+from typing import Mapping, Callable, TypeVar, Iterator
+
+T = TypeVar('T')
+
+
+class LazySnapshot(Mapping[str, str]):
+    """
+    A read-only view of an unlocked mystic, that only decrypts the values that are accessed
+    """
+    __slots__ = '_entries', '_decrypt'
+
+    def __init__(self, entries: Mapping[str, T], decrypt: Callable[[T], str]):
+        self._entries = entries
+        self._decrypt = decrypt
+
+    def __getitem__(self, item: str) -> str:
+        return self._decrypt(self._entries[item])
+
+    def __contains__(self, item):
+        return item in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,89 @@
+from typing import Iterable, Iterator, Tuple
+import base64
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from mysticlib.__util import _read_token, _write_token
+
+CHUNK_SIZE = 64 * 1024
+NONCE_LEN = 12
+
+
+def stream_key(master: bytes, salt: bytes) -> bytes:
+    """
+    derive the key of a chunk stream from a (Fernet) master key, the salt must be unique for every stream encrypted
+    """
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=salt,
+        info=b'mystic chunk stream',
+        backend=default_backend()).derive(base64.urlsafe_b64decode(master))
+
+
+def _nonce(index: int, last: bool) -> bytes:
+    # the last-chunk flag is part of the nonce, so a stream cannot be truncated at a chunk boundary undetected
+    return index.to_bytes(NONCE_LEN - 1, 'big', signed=False) + (b'\1' if last else b'\0')
+
+
+class ChunkEncryptor:
+    """
+    Encrypts written data into dst as a sequence of authenticated chunks of at most chunk_size bytes of plaintext,
+    every chunk is written as:
+    <last chunk flag (1 byte)><len of enc chunk (4 bytes)><enc chunk>
+    close must be called to write the last chunk
+    """
+
+    def __init__(self, dst, key: bytes, chunk_size=CHUNK_SIZE):
+        self.dst = dst
+        self.chunk_size = chunk_size
+        self._aead = AESGCM(key)
+        self._buffer = bytearray()
+        self._index = 0
+
+    def _emit(self, chunk: bytes, last: bool):
+        dst = self.dst
+        dst.write(b'\1' if last else b'\0')
+        _write_token(dst, self._aead.encrypt(_nonce(self._index, last), chunk, None))
+        self._index += 1
+
+    def write(self, data: bytes):
+        self._buffer += data
+        # a full chunk is held back until more data arrives, since it might turn out to be the last one
+        while len(self._buffer) > self.chunk_size:
+            self._emit(bytes(self._buffer[:self.chunk_size]), False)
+            del self._buffer[:self.chunk_size]
+
+    def close(self):
+        self._emit(bytes(self._buffer), True)
+        self._buffer = bytearray()
+
+
+def read_chunks(src) -> Iterator[Tuple[bool, bytes]]:
+    """
+    read encrypted chunks, as written by ChunkEncryptor, from src, up to and including the last chunk
+    """
+    while True:
+        flag = src.read(1)
+        if not flag:
+            raise EOFError('chunk stream ended before its last chunk')
+        last = flag != b'\0'
+        yield last, _read_token(src)
+        if last:
+            return
+
+
+def decrypt_chunks(chunks: Iterable[Tuple[bool, bytes]], key: bytes) -> Iterator[bytes]:
+    aead = AESGCM(key)
+    for i, (last, chunk) in enumerate(chunks):
+        try:
+            yield aead.decrypt(_nonce(i, last), chunk, None)
+        except InvalidTag as e:
+            raise ValueError('the mystic is corrupted') from e
+
+
+__all__ = ['CHUNK_SIZE', 'stream_key', 'ChunkEncryptor', 'read_chunks', 'decrypt_chunks']
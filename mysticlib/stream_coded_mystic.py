@@ -0,0 +1,173 @@
+from typing import Iterable, List, Optional, Tuple, Mapping
+from types import MappingProxyType
+from io import BytesIO
+import os
+
+from mysticlib.slotted_mystic import SlottedMystic
+from mysticlib.instrumentation import instrumented
+from mysticlib.stream import *
+from mysticlib.records import *
+from mysticlib.__util import _write_token
+
+
+class StreamCodedMystic(SlottedMystic):
+    """
+    A mystic whose pairs are encrypted as a stream of authenticated chunks, so that it is encrypted and decrypted
+    incrementally, and the entire plaintext never has to be in memory at once.
+    format:
+    <header><newline>
+    <number_of_passwords (1 byte)><len of pass1(1 byte)><pass1><len of pass2(1 byte)>...
+    <record format (1 byte)><body salt (16 bytes)>
+    <last chunk flag (1 byte)><len of enc chunk1 (4 bytes)><enc chunk1><last chunk flag (1 byte)>...
+    the chunks are encrypted with AES-GCM under a key derived from the master key and the body salt, the plaintext
+    they make up is a sequence of records in the record format, json lines or blocks of binary records.
+    """
+    header = b'!myst_stream_coded'
+    format = 'stm'
+
+    def __init__(self):
+        super().__init__()
+        self.cache = False
+        self.chunk_size = CHUNK_SIZE
+        # the record format to write the pairs in, None to keep the format they were read in (json for new mystics)
+        self.record_format = None
+        self._chunks_format = None
+        self.body_salt: Optional[bytes] = None
+        self.coded_chunks: Optional[List[Tuple[bool, bytes]]] = None
+        self.cached_dict = None
+        self._dict_changed = False
+
+    @property
+    def mutable(self):
+        return self.cache
+
+    @mutable.setter
+    def mutable(self, v: bool):
+        self.cache = v
+
+    def _decode(self, chunks: Iterable[Tuple[bool, bytes]], master) -> dict:
+        if self._chunks_format not in record_parsers:
+            raise ValueError(f'unrecognized record format {self._chunks_format}')
+        parser = record_parsers[self._chunks_format]()
+        ret = {}
+        for plain in decrypt_chunks(chunks, stream_key(master, self.body_salt)):
+            ret.update(parser.feed(plain))
+        parser.close()
+        return ret
+
+    @instrumented('get_dict')
+    def _get_dict(self, minor=None):
+        if self.cached_dict is not None:
+            return self.cached_dict
+        if self.coded_chunks is None:
+            ret = {}
+        else:
+            ret = self._decode(self.coded_chunks, self._get_master(minor))
+        if self.cache:
+            self.cached_dict = ret
+        return ret
+
+    def load(self, minor=None):
+        return self._get_dict(minor)
+
+    def snapshot(self, minor=None) -> Mapping[str, str]:
+        ret = self._get_dict(minor)
+        if ret is self.cached_dict:
+            ret = dict(ret)
+        return MappingProxyType(ret)
+
+    @classmethod
+    def _read_preamble(cls, src: BytesIO, check_header) -> 'StreamCodedMystic':
+        cls._read_header(src, check_header)
+        self = cls()
+        self._read_slots(src)
+        self._chunks_format = bytes(src.read(1))
+        self.body_salt = bytes(src.read(16))
+        return self
+
+    @classmethod
+    def from_stream(cls, src: BytesIO, check_header=True) -> 'StreamCodedMystic':
+        self = cls._read_preamble(src, check_header)
+        self.coded_chunks = list(read_chunks(src))
+        return self
+
+    @classmethod
+    def from_stream_unlocked(cls, src: BytesIO, minor, check_header=True) -> 'StreamCodedMystic':
+        """
+        read a mystic and decrypt it while reading, so that the encrypted body is never held in memory. The returned
+        mystic is in mutable mode.
+        """
+        self = cls._read_preamble(src, check_header)
+        self.cached_dict = self._decode(read_chunks(src), self._get_master(minor))
+        self.cache = True
+        return self
+
+    def to_stream(self, dst: BytesIO, minor=None):
+        if not self.encrypted_passwords:
+            raise Exception(
+                'this mystic has no passwords set, it will be inaccessible unless at least one passwords is added')
+        dst.write(self.header + b'\n')
+        self._write_slots(dst)
+        if self.cached_dict is None and self.coded_chunks is None:
+            self.cached_dict = {}
+        record_format = self.record_format or self._chunks_format or JSON_RECORDS
+        if self._dict_changed or self.coded_chunks is None or record_format != self._chunks_format:
+            if record_format not in record_dumpers:
+                raise ValueError(f'unrecognized record format {record_format}')
+            master = self._get_master(minor)
+            d = self.cached_dict
+            if d is None:
+                # only the record format changed
+                d = self._decode(self.coded_chunks, master)
+            # the chunks are written as they are encrypted, and not kept
+            self.body_salt = os.urandom(16)
+            dst.write(record_format + self.body_salt)
+            encryptor = ChunkEncryptor(dst, stream_key(master, self.body_salt), self.chunk_size)
+            for record in record_dumpers[record_format](d.items()):
+                encryptor.write(record)
+            encryptor.close()
+            # the chunks are not kept, so the pairs are kept in their place
+            self.cached_dict = d
+            self._chunks_format = record_format
+            self.coded_chunks = None
+            self._dict_changed = False
+        else:
+            dst.write(self._chunks_format + self.body_salt)
+            for last, chunk in self.coded_chunks:
+                dst.write(b'\1' if last else b'\0')
+                _write_token(dst, chunk)
+        self._changed = False
+
+    def __getitem__(self, item, minor=None):
+        return self._get_dict(minor)[item]
+
+    def __contains__(self, key):
+        return key in self._get_dict()
+
+    def __setitem__(self, key, value, minor=None):
+        self._get_dict(minor)[key] = value
+        self._dict_changed = self._changed = True
+
+    def __delitem__(self, key, minor=None):
+        del self._get_dict(minor)[key]
+        self._dict_changed = self._changed = True
+
+    def __len__(self):
+        return len(self._get_dict())
+
+    def __iter__(self):
+        return iter(self._get_dict())
+
+    def keys(self):
+        return self._get_dict().keys()
+
+    def items(self):
+        return self._get_dict().items()
+
+    def values(self):
+        return self._get_dict().values()
+
+    def get(self, *args, minor=None, **kwargs):
+        if minor is None:
+            return super().get(*args, **kwargs)
+        return self.load(minor=minor).get(*args, **kwargs)
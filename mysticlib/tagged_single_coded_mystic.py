@@ -0,0 +1,110 @@
+from typing import List, Optional, Sequence
+from io import BytesIO
+import hmac
+import hashlib
+import os
+
+from mysticlib.single_coded_mystic import SingleCodedMystic
+from mysticlib.__util import *
+from mysticlib.__util import _profile_code, _profile_decode, ITER_LEN, KdfProfile
+
+# how many times cheaper the tag derivation is than the derivation of a slot, by default they cost the same
+DEFAULT_TAG_COST_DIVISOR = 1
+
+
+class TaggedSingleCodedMystic(SingleCodedMystic):
+    """
+    A single coded mystic where every password slot carries a one-byte tag, so that a password is only tried against
+    the slots whose tag it matches. The tag is an HMAC of the slot's salt, keyed by a derivation of the password (the
+    tag derivation), so opening the mystic takes the tag derivation and about one slot derivation, rather than one
+    slot derivation per password.
+    The tags do let a guess be checked offline: a wrong guess is rejected by the tag derivation alone 255 times out of
+    256, so guessing costs about one tag derivation per guess. The tag derivation is the slot derivation divided by
+    tag_cost_divisor (the format option, e.g. scmt:16), by default it costs the same, so guessing is as expensive as
+    for an untagged mystic. A divisor of d makes opening the mystic cheaper, and guessing about d times cheaper.
+    format:
+    <header><newline>
+    <tag salt (16 bytes)><tag kdf profile (2 bytes of flags and 8 bytes of iterations, or 4 bytes of scrypt profile)>
+    <number_of_passwords (1 byte)><tag of pass1(1 byte)><len of pass1(1 byte)><pass1><tag of pass2(1 byte)>...
+    <enc_json_dict>
+    # note, last line does NOT have newline terminator
+    """
+    header = b'!myst_single_coded_tagged'
+    format = 'scmt'
+
+    def __init__(self):
+        super().__init__()
+        self.tag_salt = os.urandom(16)
+        self.tag_cost_divisor = DEFAULT_TAG_COST_DIVISOR
+        # the KDF profile of the tag derivation, set from the slot KDF when the first password is added
+        self.tag_kdf: Optional[KdfProfile] = None
+        self.slot_tags: List[int] = []
+
+    def set_format_options(self, options: str):
+        """
+        options: the tag cost divisor
+        """
+        try:
+            divisor = int(options)
+        except ValueError as e:
+            raise ValueError(f'tag cost divisor must be a number, got {options}') from e
+        if divisor <= 0:
+            raise ValueError(f'tag cost divisor must be positive, got {divisor}')
+        self.tag_cost_divisor = divisor
+
+    def _default_tag_kdf(self) -> KdfProfile:
+        slot_kdf = self.kdf or DEFAULT_ITER
+        if isinstance(slot_kdf, ScryptProfile):
+            # scrypt's cost is a power of two, so the divisor is rounded down to a power of two
+            return slot_kdf._replace(n_log2=max(slot_kdf.n_log2 - (self.tag_cost_divisor.bit_length() - 1), 1))
+        return max(slot_kdf // self.tag_cost_divisor, 1)
+
+    def _tag_key(self, minor):
+        if self.tag_kdf is None:
+            self.tag_kdf = self._default_tag_kdf()
+        return derive_key(minor, self.tag_salt, self.tag_kdf)
+
+    @staticmethod
+    def _slot_tag(tag_key, ep) -> int:
+        salt, _, _ = parse_envelope(ep)
+        return hmac.new(tag_key, salt, hashlib.sha256).digest()[0]
+
+    def _slot_candidates(self, minor) -> Sequence[int]:
+        tag_key = self._tag_key(minor)
+        return [i for (i, (ep, tag)) in enumerate(zip(self.encrypted_passwords, self.slot_tags))
+                if self._slot_tag(tag_key, ep) == tag]
+
+    def _add_slot(self, master, new_password):
+        super()._add_slot(master, new_password)
+        self.slot_tags.append(self._slot_tag(self._tag_key(new_password), self.encrypted_passwords[-1]))
+
+    def _del_slot(self, index):
+        super()._del_slot(index)
+        del self.slot_tags[index]
+
+    def _read_slots(self, src: BytesIO):
+        self.tag_salt = bytes(src.read(16))
+        flags = src.read(2)
+        profile = src.read(ITER_LEN if flags[1] == 1 else 4)
+        self.tag_kdf, _ = _profile_decode(flags[1], memoryview(bytes(profile)))
+        num_of_passwords = int(src.read(1)[0])
+        self.encrypted_passwords = []
+        self.slot_tags = []
+        for _ in range(num_of_passwords):
+            tag, l = src.read(2)
+            ep = bytes(src.read(l))
+            self.slot_tags.append(tag)
+            self.encrypted_passwords.append(ep)
+        self._read_cipher()
+
+    def _write_slots(self, dst: BytesIO):
+        if len(self.encrypted_passwords) >= 256:
+            raise Exception('too many passwords in singe coded mystic')
+        dst.write(self.tag_salt)
+        dst.write(_profile_code(self.tag_kdf))
+        dst.write(bytes([len(self.encrypted_passwords)]))
+        for ep, tag in zip(self.encrypted_passwords, self.slot_tags):
+            if len(ep) > 255:
+                raise Exception(f'password too long: {ep}')
+            dst.write(bytes([tag, len(ep)]))
+            dst.write(ep)
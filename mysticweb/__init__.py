@@ -1,5 +1,6 @@
 from mysticweb.app import app
 import mysticweb.routes
+import mysticweb.api
 from mysticweb.__data import __version__, __author__
 try:
     from mysticweb.secrets import __secret_key__
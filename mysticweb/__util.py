@@ -1,20 +1,7 @@
-from typing import Tuple, Union
-
-from socket import timeout
-from urllib.request import urlopen
 from urllib.parse import urlparse
 import re
 import itertools as it
 
-URL_LOAD_TIMEOUT = 10
-
-
-def download_page(url) -> Tuple[bool, Union[bytes, Exception]]:
-    try:
-        return True, urlopen(url, timeout=URL_LOAD_TIMEOUT).read()
-    except (timeout, ValueError) as e:
-        return False, e
-
 
 def fuzzy_in(needle: str, haystack: str) -> bool:
     """
@@ -74,7 +61,7 @@ def is_local(url):
     return False
 
 
-__all__ = ['download_page', 'fuzzy_in', 'pass_strength', 'is_local']
+__all__ = ['fuzzy_in', 'pass_strength', 'is_local']
 
 if __name__ == '__main__':
     import doctest
@@ -0,0 +1,172 @@
+"""
+admission control for unlocking mystics. Unlocking is bounded CPU work (a key derivation per password slot), so the
+password slots are tried on a small process pool, and the number of unlocks that are running or waiting for the pool is
+capped, so that excess unlocks are turned away instead of tying up the server's workers. Only the slots are sent to the
+pool, parsing and decryption stay in the request's thread. Clients that enter bad passwords repeatedly
+are made to wait before trying again. Concurrent identical unlocks are coalesced into one.
+"""
+from typing import Callable, ContextManager, Dict, Hashable, Optional, Tuple
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from threading import Lock
+import hashlib
+import hmac
+import os
+import time
+
+from mysticweb.exceptions import Overloaded, BackedOff
+
+# passwords are only kept in flight keys as a keyed hash, under a key that never leaves the process
+_FLIGHT_KEY = os.urandom(32)
+
+
+def flight_key(raw_source, password: Optional[str], pre_load_filter: Optional[str]) -> Hashable:
+    """
+    the key of an unlock for coalescing, unlocks with the same key have the same result
+    """
+    password_hash = hmac.new(_FLIGHT_KEY, (password or '').encode('utf-8'), hashlib.sha256).digest()
+    return hashlib.sha256(raw_source).digest(), password_hash, pre_load_filter or None
+
+
+class SingleFlight:
+    """
+    coalesces concurrent calls with the same key, only the first call runs, and any calls with the same key that are
+    made while it runs wait for it and share its result (or exception)
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flights: Dict[Hashable, Future] = {}
+
+    def __len__(self):
+        return len(self._flights)
+
+    def do(self, key: Hashable, func, *args, on_coalesce=None):
+        """
+        call func with args, unless a call with the same key is already running. on_coalesce is called (with no
+        arguments) when the call joins a running one.
+        """
+        with self._lock:
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+        if not leader:
+            if on_coalesce:
+                on_coalesce()
+            return future.result()
+        try:
+            ret = func(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(ret)
+            return ret
+        finally:
+            with self._lock:
+                del self._flights[key]
+
+
+class UnlockPool:
+    """
+    a process pool to try password slots on (set as the mystics' slot_executor), at most workers + queue_depth unlocks
+    are admitted at once, any more raise Overloaded. If workers is 0, there is no pool, and slots are tried in the
+    unlocking thread.
+    """
+
+    def __init__(self, workers=2, queue_depth=8, retry_after=5):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+        self._lock = Lock()
+        self._admitted = 0
+        # created on first use, so that every process of a pre-forking server gets its own pool
+        self._executor: Optional[Executor] = None
+        # called for a context manager that is entered while an admitted unlock runs (coalesced unlocks don't call run,
+        # so they are not tracked)
+        self.tracker: Optional[Callable[[], ContextManager]] = None
+
+    @property
+    def executor(self) -> Optional[Executor]:
+        if not self.workers:
+            return None
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers)
+            return self._executor
+
+    @property
+    def admitted(self):
+        return self._admitted
+
+    def run(self, func, *args):
+        """
+        call func (in the calling thread) once the call is admitted, func should do its key derivation on the executor
+        """
+        with self._lock:
+            if self._admitted >= self.workers + self.queue_depth:
+                raise Overloaded(self.retry_after)
+            self._admitted += 1
+        try:
+            with (self.tracker() if self.tracker else nullcontext()):
+                return func(*args)
+        finally:
+            with self._lock:
+                self._admitted -= 1
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
+
+
+class Backoff:
+    """
+    tracks bad passwords by client. After free_attempts consecutive failures, a client must wait before every attempt,
+    starting at base seconds and doubling with every failure, up to max_delay. Up to max_clients are tracked, the
+    least recently failing clients are forgotten first.
+    """
+
+    def __init__(self, free_attempts=3, base=1, max_delay=300, max_clients=10_000):
+        self.free_attempts = free_attempts
+        self.base = base
+        self.max_delay = max_delay
+        self.max_clients = max_clients
+        self._lock = Lock()
+        # maps clients to their consecutive failures and the time they may try again
+        self._clients: 'OrderedDict[str, Tuple[int, float]]' = OrderedDict()
+
+    def check(self, client):
+        """
+        raise BackedOff if the client must wait before trying again
+        """
+        with self._lock:
+            entry = self._clients.get(client)
+        if entry is None:
+            return
+        _, retry_at = entry
+        wait = retry_at - time.monotonic()
+        if wait > 0:
+            raise BackedOff(int(wait) + 1)
+
+    def failed(self, client):
+        with self._lock:
+            failures, _ = self._clients.pop(client, (0, 0))
+            failures += 1
+            if failures > self.free_attempts:
+                delay = min(self.base * 2 ** (failures - self.free_attempts - 1), self.max_delay)
+            else:
+                delay = 0
+            self._clients[client] = (failures, time.monotonic() + delay)
+            while len(self._clients) > self.max_clients:
+                self._clients.popitem(last=False)
+
+    def succeeded(self, client):
+        with self._lock:
+            self._clients.pop(client, None)
+
+
+__all__ = ['flight_key', 'SingleFlight', 'UnlockPool', 'Backoff']
@@ -0,0 +1,107 @@
+"""
+a JSON API for automation clients. Every request either carries the mystic itself (with the same form fields as the
+main page, and the password), or the token of a session, created with /api/session (in the X-Mystic-Session header,
+or the session cookie). Requests that carry the mystic derive its key every time, clients that make more than a few
+requests should use a session.
+"""
+from typing import List, Mapping
+import bisect
+import json
+
+from flask import request, jsonify, abort, Response, stream_with_context
+
+from mysticweb.app import app
+from mysticweb.exceptions import DumpError
+from mysticweb.routes import SESSION_COOKIE, sessions_enabled, session_cache, read_source, unlock
+from mysticweb.__util import fuzzy_in
+
+SESSION_HEADER = 'X-Mystic-Session'
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def api_pairs() -> Mapping[str, str]:
+    """
+    get the pairs the request refers to, either from its session, or by unlocking the mystic it carries
+    """
+    token = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    if token and sessions_enabled():
+        pairs = session_cache().get(token)
+        if pairs is None:
+            raise DumpError('the session has expired, please create a new one')
+        return pairs
+    if request.method != 'POST':
+        raise DumpError('the mystic must be posted, or a session must be used')
+    return unlock(read_source(), request.form.get('password'), request.values.get('pre_load_filter'))
+
+
+def matching_keys(pairs: Mapping[str, str], pre_load_filter, cursor) -> List[str]:
+    """
+    get the keys that match the filter, in order, and after the cursor (the last key of the previous page)
+    """
+    if pre_load_filter:
+        keys = sorted(k for k in pairs if fuzzy_in(pre_load_filter, k))
+    else:
+        keys = sorted(pairs)
+    if cursor:
+        keys = keys[bisect.bisect_right(keys, cursor):]
+    return keys
+
+
+@app.route('/api/keys', methods=['POST', 'GET'])
+def api_keys():
+    """
+    list the keys of the mystic in pages, or as a stream of json lines if stream is set. The values are not
+    decrypted, use /api/value to get them.
+    """
+    try:
+        limit = int(request.values.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError as e:
+        raise DumpError from e
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise DumpError(f'limit must be between 1 and {MAX_PAGE_SIZE}')
+    keys = matching_keys(api_pairs(), request.values.get('pre_load_filter'), request.values.get('cursor'))
+
+    if request.values.get('stream'):
+        def lines():
+            for k in keys:
+                yield json.dumps(k) + '\n'
+
+        return Response(stream_with_context(lines()), mimetype='application/x-ndjson')
+
+    page = keys[:limit]
+    cursor = page[-1] if len(keys) > limit else None
+    return jsonify(keys=page, cursor=cursor)
+
+
+@app.route('/api/value', methods=['POST', 'GET'])
+def api_value():
+    key = request.values.get('key')
+    if key is None:
+        raise DumpError('a key must be specified')
+    pairs = api_pairs()
+    if key not in pairs:
+        return jsonify(error=f'key not found: {key}'), 404
+    return jsonify(key=key, value=str(pairs[key]))
+
+
+@app.route('/api/session', methods=['POST'])
+def api_session():
+    """
+    unlock the posted mystic and keep it in a new session
+    """
+    if not sessions_enabled():
+        abort(404)
+    pairs = dict(unlock(read_source(), request.form.get('password')))
+    token = session_cache().create(pairs)
+    if token is None:
+        raise DumpError('the mystic is too large to keep unlocked on the server')
+    return jsonify(session=token, size=len(pairs))
+
+
+@app.route('/api/session', methods=['DELETE'])
+def api_end_session():
+    token = request.headers.get(SESSION_HEADER) or request.cookies.get(SESSION_COOKIE)
+    if token and sessions_enabled():
+        session_cache().drop(token)
+    return '', 204
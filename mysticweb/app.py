@@ -1,4 +1,56 @@
+from io import BytesIO
+import os
+
 import flask
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+
+class UploadBuffer(BytesIO):
+    def close(self):
+        # the mystic read from the upload might still hold views of it when the request is closed, the memory is then
+        # released along with the views
+        try:
+            super().close()
+        except BufferError:
+            pass
+
+
+class Request(flask.Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        # small uploads are held in a plain BytesIO (rather than a spooled temporary file), so that the mystic can be
+        # read from the upload without copying it
+        if total_content_length is not None and total_content_length <= app.config['UPLOAD_MEMORY_BYTES']:
+            return UploadBuffer()
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
 
 app = flask.Flask('mysticweb')
-app.config['MAX_CONTENT_PATH'] = 1_000*1_000*1 # 1 meg
\ No newline at end of file
+app.request_class = Request
+app.config['MAX_CONTENT_PATH'] = 1_000*1_000*1 # 1 meg
+# whether to collect metrics and serve them at /metrics (to local clients only)
+app.config['METRICS_ENABLED'] = os.environ.get('MYSTICWEB_METRICS', '') == '1'
+# whether clients may keep their unlocked mystic on the server between requests, and the limits of such sessions
+app.config['SESSIONS_ENABLED'] = os.environ.get('MYSTICWEB_SESSIONS', '') == '1'
+app.config['SESSION_IDLE_SECONDS'] = 5 * 60
+# uploads up to this size are held in memory, larger ones are spooled to a temporary file
+app.config['UPLOAD_MEMORY_BYTES'] = 4 * 2 ** 20
+app.config['SESSION_MAX_BYTES'] = 64 * 2 ** 20
+# password slots are tried on a pool of worker processes (0 to try them in the request's thread), at most
+# UNLOCK_QUEUE_DEPTH more unlocks may wait for the pool, any more are answered with 503. The pool and the queue
+# together should be smaller than the server's threads, so that some threads are always free for requests that don't
+# unlock.
+app.config['UNLOCK_WORKERS'] = int(os.environ.get('MYSTICWEB_UNLOCK_WORKERS', 2))
+app.config['UNLOCK_QUEUE_DEPTH'] = int(os.environ.get('MYSTICWEB_UNLOCK_QUEUE_DEPTH', 4))
+app.config['UNLOCK_RETRY_AFTER'] = 5
+# limits of downloading mystics from urls, unchanged mystics are re-validated from a cache of FETCH_CACHE_BYTES
+app.config['FETCH_TIMEOUT'] = 10
+app.config['FETCH_MAX_BYTES'] = 16 * 2 ** 20
+app.config['FETCH_CACHE_BYTES'] = 64 * 2 ** 20
+# the number of proxies in front of the app that append to X-Forwarded-For (0 if clients connect directly). Clients are
+# told apart by their address, so while this is unset, clients can't be told apart from their proxy and bad passwords
+# are not tracked.
+app.config['PROXY_HOPS'] = int(os.environ['MYSTICWEB_PROXY_HOPS']) if 'MYSTICWEB_PROXY_HOPS' in os.environ else None
+if app.config['PROXY_HOPS']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_HOPS'])
+# clients that enter more bad passwords than this in a row must wait (exponentially longer) before trying again
+app.config['BAD_PASSWORD_FREE_ATTEMPTS'] = 3
\ No newline at end of file
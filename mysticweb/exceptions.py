@@ -1,2 +1,22 @@
 class DumpError(Exception):
     pass
+
+
+class Overloaded(Exception):
+    """
+    too many unlocks are running or waiting, the client should retry after retry_after seconds
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f'the server is busy, try again in {retry_after} seconds')
+        self.retry_after = retry_after
+
+
+class BackedOff(Exception):
+    """
+    the client entered too many bad passwords, and must wait retry_after seconds before trying again
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f'too many bad passwords were entered, try again in {retry_after} seconds')
+        self.retry_after = retry_after
@@ -0,0 +1,194 @@
+"""
+downloading mystics from urls. Connections are kept alive and re-used for every host, downloads are capped in size
+(and read in chunks, so that an oversized download is cut off without holding all of it), and downloaded mystics are
+cached in memory, and re-validated with ETag/If-Modified-Since, so that an unchanged mystic is not downloaded again.
+Since mystics are encrypted, the cache only holds cyphertext. The cache and connections are per process.
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+from collections import OrderedDict
+from http.client import HTTPConnection, HTTPSConnection, HTTPException, HTTPResponse
+from threading import Lock
+from urllib.parse import urlsplit, urljoin
+import socket
+import time
+
+READ_CHUNK_SIZE = 64 * 1024
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+# an observer is called with the outcome of every fetch (ok, not_modified, timeout, too_large, or error) and the
+# seconds it took
+Observer = Callable[[str, float], None]
+
+
+class FetchError(Exception):
+    pass
+
+
+class FetchTimeout(FetchError):
+    pass
+
+
+class TooLarge(FetchError):
+    pass
+
+
+class Fetcher:
+    """
+    downloads urls over pooled connections, keeping up to max_idle idle connections per host. Downloads larger than
+    max_bytes raise TooLarge, and up to cache_bytes of downloads are cached (the least recently used are dropped first).
+    """
+
+    def __init__(self, timeout=10, max_bytes=16 * 2 ** 20, cache_bytes=64 * 2 ** 20, max_idle=4, max_redirects=5):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.cache_bytes = cache_bytes
+        self.max_idle = max_idle
+        self.max_redirects = max_redirects
+        self.observer: Optional[Observer] = None
+        self._lock = Lock()
+        self._idle: Dict[Tuple[str, str], List[HTTPConnection]] = {}
+        # maps urls to their validators (etag and last-modified) and their content, in order of use
+        self._cache: 'OrderedDict[str, Tuple[Optional[str], Optional[str], bytes]]' = OrderedDict()
+        self._cached_bytes = 0
+
+    def _new_connection(self, scheme, netloc) -> HTTPConnection:
+        conn_type = HTTPSConnection if scheme == 'https' else HTTPConnection
+        return conn_type(netloc, timeout=self.timeout)
+
+    def _idle_connection(self, scheme, netloc) -> Optional[HTTPConnection]:
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            return idle.pop() if idle else None
+
+    def _release(self, scheme, netloc, conn: HTTPConnection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, netloc), [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _cached(self, url):
+        with self._lock:
+            ret = self._cache.get(url)
+            if ret is not None:
+                self._cache.move_to_end(url)
+            return ret
+
+    def _store(self, url, etag, last_modified, content: bytes):
+        with self._lock:
+            old = self._cache.pop(url, None)
+            if old is not None:
+                self._cached_bytes -= len(old[2])
+            if len(content) > self.cache_bytes:
+                return
+            self._cache[url] = (etag, last_modified, content)
+            self._cached_bytes += len(content)
+            while self._cached_bytes > self.cache_bytes:
+                _, (_, _, dropped) = self._cache.popitem(last=False)
+                self._cached_bytes -= len(dropped)
+
+    def _read(self, response: HTTPResponse) -> bytes:
+        length = response.getheader('Content-Length')
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            raise TooLarge(f'the mystic is larger than {self.max_bytes} bytes')
+        ret = bytearray()
+        while True:
+            chunk = response.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return bytes(ret)
+            ret += chunk
+            if len(ret) > self.max_bytes:
+                raise TooLarge(f'the mystic is larger than {self.max_bytes} bytes')
+
+    def _request(self, scheme, netloc, path, headers) -> Tuple[HTTPResponse, HTTPConnection]:
+        conn = self._idle_connection(scheme, netloc)
+        if conn is not None:
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn.getresponse(), conn
+            except (ConnectionError, HTTPException):
+                # the server closed the idle connection, try again over a new one
+                conn.close()
+        conn = self._new_connection(scheme, netloc)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn.getresponse(), conn
+        except BaseException:
+            conn.close()
+            raise
+
+    def _fetch(self, url) -> Tuple[str, bytes]:
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            if parts.scheme not in ('http', 'https') or not parts.netloc:
+                raise FetchError(f'only http and https urls can be loaded, got {url!r}')
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            headers = {}
+            cached = self._cached(url)
+            if cached is not None:
+                etag, last_modified, _ = cached
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+
+            response, conn = self._request(parts.scheme, parts.netloc, path, headers)
+            status = response.status
+            try:
+                if status == 304 and cached is not None:
+                    response.read()
+                    outcome, content = 'not_modified', cached[2]
+                elif status in REDIRECT_STATUSES and response.getheader('Location'):
+                    response.read()
+                    outcome, content = None, None
+                    url = urljoin(url, response.getheader('Location'))
+                elif status == 200:
+                    content = self._read(response)
+                    outcome = 'ok'
+                    etag = response.getheader('ETag')
+                    last_modified = response.getheader('Last-Modified')
+                    if etag or last_modified:
+                        self._store(url, etag, last_modified, content)
+                else:
+                    raise FetchError(f'the server responded with {status} {response.reason}')
+            except BaseException:
+                conn.close()
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._release(parts.scheme, parts.netloc, conn)
+            if outcome is not None:
+                return outcome, content
+        raise FetchError(f'too many redirects (more than {self.max_redirects})')
+
+    def fetch(self, url: str) -> bytes:
+        start = time.perf_counter()
+        outcome = 'error'
+        try:
+            outcome, ret = self._fetch(url)
+            return ret
+        except TooLarge:
+            outcome = 'too_large'
+            raise
+        except socket.timeout as e:
+            outcome = 'timeout'
+            raise FetchTimeout(f'the download took longer than {self.timeout} seconds') from e
+        except (OSError, HTTPException) as e:
+            raise FetchError(f'the download failed: {e}') from e
+        finally:
+            if self.observer:
+                self.observer(outcome, time.perf_counter() - start)
+
+    def close(self):
+        with self._lock:
+            idle = [c for conns in self._idle.values() for c in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+
+__all__ = ['Fetcher', 'FetchError', 'FetchTimeout', 'TooLarge']
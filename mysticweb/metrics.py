@@ -0,0 +1,151 @@
+"""
+minimal prometheus-style metrics, rendered in the prometheus text format. The metrics are per process, every worker
+of a multi-process server exposes its own.
+"""
+from typing import Dict, List, Sequence, Tuple
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from threading import Lock
+import bisect
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+_registry: List['_Metric'] = []
+
+
+def _label_str(names: Sequence[str], values: Tuple[str, ...], extra='') -> str:
+    pairs = [f'{n}="{v}"' for (n, v) in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Metric(ABC):
+    kind: str
+
+    def __init__(self, name: str, help_: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self._lock = Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[n]) for n in self.labels)
+
+    @abstractmethod
+    def samples(self) -> List[str]:
+        pass
+
+    def render(self) -> str:
+        return '\n'.join([f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}'] + self.samples())
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [f'{self.name}{_label_str(self.labels, k)} {v}' for (k, v) in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """
+        count the body of a with statement while it runs
+        """
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets)
+        # for every label values, the count of every bucket (and of +Inf), and the sum
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, (None, 0))
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+            counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        ret = []
+        with self._lock:
+            values = sorted((k, (list(c), s)) for (k, (c, s)) in self._values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                ret.append(f'{self.name}_bucket{_label_str(self.labels, key, le)} {cumulative}')
+            ret.append(f'{self.name}_sum{_label_str(self.labels, key)} {total}')
+            ret.append(f'{self.name}_count{_label_str(self.labels, key)} {cumulative}')
+        return ret
+
+
+def render() -> str:
+    return '\n'.join(m.render() for m in _registry) + '\n'
+
+
+requests_total = Counter('mysticweb_requests_total', 'requests handled', ('endpoint', 'status'))
+request_seconds = Histogram('mysticweb_request_seconds', 'request latency', ('endpoint',))
+phase_seconds = Histogram('mysticweb_phase_seconds', 'time spent in every phase of loading a mystic', ('phase',))
+kdf_in_flight = Gauge('mysticweb_kdf_in_flight', 'unlocks (key derivations) currently running')
+bad_passwords_total = Counter('mysticweb_bad_passwords_total', 'unlocks that failed due to a bad password')
+unlocks_coalesced_total = Counter('mysticweb_unlocks_coalesced_total',
+                                  'unlocks that shared the result of an identical unlock that was already running')
+fetch_seconds = Histogram('mysticweb_fetch_seconds', 'url downloads, by outcome (ok, not_modified, timeout, too_large,'
+                                                   ' or error)', ('outcome',))
+source_bytes = Histogram('mysticweb_source_bytes', 'size of the loaded mystics', ('source_kind',), SIZE_BUCKETS)
+
+
+def mysticlib_sink(name, seconds, size):
+    """
+    a mysticlib instrumentation sink, that records the key derivations as a phase
+    """
+    if name == 'derive_key':
+        phase_seconds.observe(seconds, phase='kdf')
+
+
+__all__ = ['Counter', 'Gauge', 'Histogram', 'render', 'requests_total', 'request_seconds', 'phase_seconds',
+           'kdf_in_flight', 'bad_passwords_total', 'unlocks_coalesced_total', 'fetch_seconds', 'source_bytes',
+           'mysticlib_sink']
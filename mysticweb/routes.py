@@ -1,15 +1,35 @@
+from typing import Mapping
 from io import BytesIO
+from contextlib import contextmanager, nullcontext
+import time
 
-from flask import render_template, request, redirect, send_from_directory, after_this_request, g
+from cryptography.fernet import InvalidToken
+from markupsafe import escape
+from flask import render_template, request, redirect, send_from_directory, after_this_request, g, abort, Response, \
+    jsonify, stream_template, stream_with_context
 
 from mysticlib import Mystic, BadKey
+from mysticlib.instrumentation import get_sink, set_sink
 
 from mysticweb.app import app
-from mysticweb.exceptions import DumpError
+from mysticweb.exceptions import DumpError, Overloaded, BackedOff
+from mysticweb.sessions import SessionCache
+from mysticweb.fetch import Fetcher, FetchError
+from mysticweb.admission import UnlockPool, Backoff, SingleFlight, flight_key
+from mysticweb import metrics
 from mysticweb.__util import *
 from mysticweb.__data import *
 
 git_path = "http://github.com/bentheiii/mystic"
+# the least number of characters to send in every chunk of a streamed page
+STREAM_CHUNK_SIZE = 16 * 1024
+SESSION_COOKIE = 'mystic_session'
+
+_session_cache = None
+_unlock_pool = None
+_backoff = None
+_unlock_flights = SingleFlight()
+_fetcher = None
 
 
 def add_warning(warning):
@@ -19,8 +39,68 @@ def add_warning(warning):
         g.warnings = [warning]
 
 
+def metrics_enabled():
+    return app.config.get('METRICS_ENABLED', False)
+
+
+def sessions_enabled():
+    return app.config.get('SESSIONS_ENABLED', False)
+
+
+def session_cache() -> SessionCache:
+    global _session_cache
+    if _session_cache is None:
+        _session_cache = SessionCache(app.config['SESSION_IDLE_SECONDS'], app.config['SESSION_MAX_BYTES'])
+    return _session_cache
+
+
+def unlock_pool() -> UnlockPool:
+    global _unlock_pool
+    if _unlock_pool is None:
+        _unlock_pool = UnlockPool(app.config['UNLOCK_WORKERS'], app.config['UNLOCK_QUEUE_DEPTH'],
+                                  app.config['UNLOCK_RETRY_AFTER'])
+        _unlock_pool.tracker = track_unlock
+    return _unlock_pool
+
+
+def backoff() -> Backoff:
+    global _backoff
+    if _backoff is None:
+        _backoff = Backoff(app.config['BAD_PASSWORD_FREE_ATTEMPTS'])
+    return _backoff
+
+
+def fetcher() -> Fetcher:
+    global _fetcher
+    if _fetcher is None:
+        _fetcher = Fetcher(app.config['FETCH_TIMEOUT'], app.config['FETCH_MAX_BYTES'], app.config['FETCH_CACHE_BYTES'])
+        _fetcher.observer = record_fetch
+    return _fetcher
+
+
+def record_fetch(outcome, seconds):
+    if metrics_enabled():
+        metrics.fetch_seconds.observe(seconds, outcome=outcome)
+
+
+def track_unlock():
+    if not metrics_enabled():
+        return nullcontext()
+    return metrics.kdf_in_flight.track()
+
+
+def phase(name):
+    if not metrics_enabled():
+        return nullcontext()
+    return metrics.phase_seconds.time(phase=name)
+
+
 @app.before_request
 def startup():
+    g.start_time = time.perf_counter()
+    if metrics_enabled() and get_sink() is None:
+        set_sink(metrics.mysticlib_sink)
+    g.sessions_enabled = sessions_enabled()
     g.__version__ = __version__
     g.__author__ = __author__
     if not request.is_secure and not is_local(request.url):
@@ -28,6 +108,22 @@ def startup():
                     " Do not enter your password or mystic here unless you know what you're doing!")
 
 
+@app.after_request
+def record_request(response):
+    if metrics_enabled() and request.endpoint != 'metrics_page':
+        metrics.requests_total.inc(endpoint=request.endpoint, status=response.status_code)
+        metrics.request_seconds.observe(time.perf_counter() - g.start_time, endpoint=request.endpoint)
+    return response
+
+
+@app.route('/metrics')
+def metrics_page():
+    # is_local only checks the host the client asked for, so the client's address is checked as well
+    if not (metrics_enabled() and is_local(request.url) and request.remote_addr in ('127.0.0.1', '::1')):
+        abort(404)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 @app.route('/favicon.ico')
 def favicon():
     return send_from_directory(app.static_folder,
@@ -38,30 +134,158 @@ def favicon():
 def error(e):
     while e.__cause__:
         e = e.__cause__
+    if request.path.startswith('/api/'):
+        return jsonify(error=f'{type(e).__name__}: {e.args[0]}'), 400
     return render_template('error.html', error_string=f'{type(e).__name__}: {e.args[0]}'), 400
 
 
-def process_input(raw_source, password, pre_load_filter, check_weak=True):
-    stream = BytesIO(raw_source)
+@app.errorhandler(Overloaded)
+@app.errorhandler(BackedOff)
+def retry_later(e):
+    status = 503 if isinstance(e, Overloaded) else 429
+    if request.path.startswith('/api/'):
+        response = jsonify(error=e.args[0])
+    else:
+        response = Response(render_template('error.html', error_string=e.args[0]))
+    response.status_code = status
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+
+def keep_session(pairs):
+    """
+    keep the pairs in a new session, and give its token to the client
+    """
+    token = session_cache().create(pairs)
+    if token is None:
+        add_warning('the mystic is too large to keep unlocked on the server')
+        return False
+
+    @after_this_request
+    def set_session_cookie(response):
+        response.set_cookie(SESSION_COOKIE, token, max_age=app.config['SESSION_IDLE_SECONDS'], httponly=True,
+                            secure=request.is_secure, samesite='Strict')
+        return response
+
+    return True
+
+
+def render_dump(results, session=False):
+    """
+    render the dump page as a stream, results can be a lazy iterable of pairs, that is consumed as the page is sent
+    """
+
+    def chunks():
+        with phase('render'):
+            buffer = []
+            size = 0
+            try:
+                for chunk in stream_template('dump.html', results=results, session=session):
+                    buffer.append(chunk)
+                    size += len(chunk)
+                    if size >= STREAM_CHUNK_SIZE:
+                        yield ''.join(buffer)
+                        buffer.clear()
+                        size = 0
+            except (InvalidToken, ValueError) as e:
+                # a value that can't be decrypted is only found once the page has started, so the status can't be
+                # changed, the error is shown at the end of the page instead (the values are inside a script)
+                buffer.append(f'</script><p><span style="background-color: lightcoral">ERROR: the mystic could not'
+                              f' be read to the end ({escape(type(e).__name__)}: {escape(e)})</span></p>')
+            yield ''.join(buffer)
+
+    return Response(stream_with_context(chunks()))
+
+
+def read_source():
+    """
+    read the raw mystic from the request's form, either downloaded from a url or uploaded as a file
+    """
+    source_kind = request.form.get('source_kind')
+    if source_kind == 'url':
+        try:
+            with phase('download'):
+                raw_source = fetcher().fetch(request.form.get('url') or '')
+        except FetchError as e:
+            raise DumpError from e
+    elif source_kind == 'file':
+        file = request.files.get('file')
+        try:
+            if isinstance(file.stream, BytesIO):
+                # small uploads are held in memory (see UPLOAD_MEMORY_BYTES), read them without copying
+                raw_source = file.stream.getbuffer()
+            else:
+                raw_source = file.read()
+        except Exception as e:
+            raise DumpError from e
+    else:
+        raise DumpError('the source kind must be valid')
+    if metrics_enabled():
+        metrics.source_bytes.observe(len(raw_source), source_kind=source_kind)
+    return raw_source
+
+
+def parse_source(raw_source) -> Mystic:
     try:
-        mystic = Mystic.from_stream(stream)
-    except (ValueError, EOFError) as e:
+        with phase('parse'):
+            return Mystic.from_buffer(raw_source)
+    except (ValueError, EOFError, IndexError) as e:
         raise DumpError from e
-    mystic.password_callback = lambda x: password
+
+
+@contextmanager
+def unlocking():
+    """
+    time the body of a with statement as the unlock phase, and report a bad password as a DumpError. Clients that
+    entered too many bad passwords are turned away before the body runs.
+    """
+    # remote_addr is the client's address only if the proxies in front of the app are known (see PROXY_HOPS)
+    limiter = backoff() if app.config.get('PROXY_HOPS') is not None else None
+    client = request.remote_addr
+    if limiter:
+        limiter.check(client)
     try:
-        try:
-            mystic.mutable = True
-        except Exception:
-            pass
-
-        if pre_load_filter:
-            d = ((k, str(v)) for (k, v) in mystic.items() if
-                 fuzzy_in(pre_load_filter, k))
-        else:
-            d = ((k, str(v)) for (k, v) in mystic.items())
-        d = list(d)
+        with phase('unlock'):
+            yield
     except BadKey:
+        if limiter:
+            limiter.failed(client)
+        if metrics_enabled():
+            metrics.bad_passwords_total.inc()
         raise DumpError('a bad password was entered')
+    if limiter:
+        limiter.succeeded(client)
+
+
+def unlock(raw_source, password, pre_load_filter=None) -> Mapping[str, str]:
+    """
+    unlock the mystic and get a snapshot of it, values are only decrypted as they are read. The password slots are tried
+    on the unlock pool, everything else runs in the request's thread.
+    """
+    mystic = parse_source(raw_source)
+    mystic.password_callback = lambda x: password
+    pool = unlock_pool()
+    mystic.slot_executor = pool.executor
+    # identical unlocks that run at the same time are coalesced, only the first one takes up the pool
+    key = flight_key(raw_source, password, pre_load_filter)
+    on_coalesce = metrics.unlocks_coalesced_total.inc if metrics_enabled() else None
+    with unlocking():
+        return _unlock_flights.do(key, pool.run, mystic.snapshot, on_coalesce=on_coalesce)
+
+
+def process_input(raw_source, password, pre_load_filter, check_weak=True, keep=False):
+    snapshot = unlock(raw_source, password, pre_load_filter)
+    if keep:
+        # the session keeps all the pairs, so that they can be filtered differently later
+        snapshot = dict(snapshot)
+
+    # filter the keys before reading any value, so that formats with separately encrypted values only decrypt
+    # the values that are displayed. The values are decrypted lazily, as the page is rendered.
+    if pre_load_filter:
+        d = ((k, str(snapshot[k])) for k in snapshot if
+             fuzzy_in(pre_load_filter, k))
+    else:
+        d = ((k, str(v)) for (k, v) in snapshot.items())
 
     if check_weak:
         p_str = pass_strength(password)
@@ -69,7 +293,8 @@ def process_input(raw_source, password, pre_load_filter, check_weak=True):
         if p_str is not None:
             add_warning(f'your password has been rated as {p_str}, consider changing it!')
 
-    return render_template('dump.html', results=d)
+    session = keep and keep_session(snapshot)
+    return render_dump(d, session)
 
 
 @app.route('/', methods=['POST', 'GET'])
@@ -78,9 +303,8 @@ def main():
 
     if request.method == 'POST':
         if request.form.get('source_kind') == 'url':
-            url = request.form.get('url')
             if request.form.get('url_remember'):
-                rem_url = url
+                rem_url = request.form.get('url')
             else:
                 rem_url = ''
 
@@ -90,24 +314,44 @@ def main():
                     response.set_cookie('url_rem', rem_url)
                     return response
 
-            success, raw_source = download_page(url)
-            if not success:
-                raise DumpError from raw_source
-        elif request.form.get('source_kind') == 'file':
-            file = request.files.get('file')
-            try:
-                raw_source = file.read()
-            except Exception as e:
-                raise DumpError from e
-        else:
-            raise DumpError('the source kind must be valid')
+        raw_source = read_source()
         password = request.form.get('password')
         pre_load_filter = request.form.get('pre_load_filter')
-        return process_input(raw_source, password, pre_load_filter)
+        keep = sessions_enabled() and bool(request.form.get('keep_session'))
+        return process_input(raw_source, password, pre_load_filter, keep=keep)
 
     return render_template('input.html', url=c_url)
 
 
+@app.route('/session', methods=['POST', 'GET'])
+def session_view():
+    """
+    view the pairs of the client's session, with a (possibly different) filter
+    """
+    if not sessions_enabled():
+        abort(404)
+    token = request.cookies.get(SESSION_COOKIE)
+    pairs = session_cache().get(token) if token else None
+    if pairs is None:
+        raise DumpError('the session has expired, please load the mystic again')
+    pre_load_filter = request.values.get('pre_load_filter')
+    if pre_load_filter:
+        d = ((k, v) for (k, v) in pairs.items() if fuzzy_in(pre_load_filter, k))
+    else:
+        d = pairs.items()
+    return render_dump(d, True)
+
+
+@app.route('/session/end', methods=['POST', 'GET'])
+def end_session():
+    token = request.cookies.get(SESSION_COOKIE)
+    if token:
+        session_cache().drop(token)
+    response = redirect('/')
+    response.delete_cookie(SESSION_COOKIE)
+    return response
+
+
 @app.route('/about')
 def about():
     return render_template('about.html')
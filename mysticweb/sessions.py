@@ -0,0 +1,97 @@
+"""
+an in-memory cache of unlocked mystics, so that follow-up requests don't download, parse, and derive keys again.
+Every session's pairs are encrypted under a random key that is only given to the client, as part of the session's
+token, so the server alone can't read them back. The cache is per process, a server with multiple workers needs sticky
+sessions for it to be effective.
+"""
+from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+from threading import Lock
+import base64
+import os
+import secrets
+import time
+
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from mysticlib.records import encode_binary_records, decode_binary_records
+
+NONCE_LEN = 12
+# the memory every session takes beside its cyphertext, roughly
+SESSION_OVERHEAD = 256
+
+
+class SessionCache:
+    """
+    sessions are dropped after idle seconds without being used, and the least recently used sessions are dropped when
+    the sessions take more than max_bytes
+    """
+
+    def __init__(self, idle=300, max_bytes=64 * 2 ** 20):
+        self.idle = idle
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        # maps session ids to their cyphertext and last use time, in order of use
+        self._sessions: 'OrderedDict[str, Tuple[bytes, float]]' = OrderedDict()
+        self._bytes = 0
+
+    def _drop(self, session_id):
+        cypher, _ = self._sessions.pop(session_id)
+        self._bytes -= len(cypher) + SESSION_OVERHEAD
+
+    def _expire(self, now):
+        while self._sessions:
+            session_id, (_, last_used) = next(iter(self._sessions.items()))
+            if now - last_used < self.idle and self._bytes <= self.max_bytes:
+                break
+            self._drop(session_id)
+
+    def create(self, pairs: Dict[str, str]) -> Optional[str]:
+        """
+        store the pairs, and return the token of the session, or None if the pairs are too large to store
+        """
+        key = AESGCM.generate_key(bit_length=256)
+        nonce = os.urandom(NONCE_LEN)
+        cypher = nonce + AESGCM(key).encrypt(nonce, encode_binary_records(pairs.items()), None)
+        if len(cypher) + SESSION_OVERHEAD > self.max_bytes:
+            return None
+        session_id = secrets.token_urlsafe(16)
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[session_id] = (cypher, now)
+            self._bytes += len(cypher) + SESSION_OVERHEAD
+            self._expire(now)
+        return session_id + '.' + str(base64.urlsafe_b64encode(key), 'ascii')
+
+    def get(self, token: str) -> Optional[Dict[str, str]]:
+        """
+        get the pairs of a session, or None if the session doesn't exist (or expired)
+        """
+        session_id, _, key = token.partition('.')
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            entry = self._sessions.get(session_id)
+            if entry is None:
+                return None
+            cypher, _ = entry
+            self._sessions[session_id] = (cypher, now)
+            self._sessions.move_to_end(session_id)
+        try:
+            key = base64.urlsafe_b64decode(key)
+            return decode_binary_records(AESGCM(key).decrypt(cypher[:NONCE_LEN], cypher[NONCE_LEN:], None))
+        except (ValueError, InvalidTag):
+            return None
+
+    def drop(self, token: str):
+        session_id, _, _ = token.partition('.')
+        with self._lock:
+            if session_id in self._sessions:
+                self._drop(session_id)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+__all__ = ['SessionCache']
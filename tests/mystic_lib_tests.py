@@ -2,9 +2,20 @@ from io import BytesIO
 import unittest
 import random
 import itertools as it
+import time
+import tempfile
+import mmap
+import asyncio
 
-from mysticlib.__util import enc, dec, DEFAULT_ITER
-from mysticlib import SingleCodedMystic, Mystic
+from cryptography.fernet import InvalidToken
+
+from mysticlib.__util import enc, dec, seal, unseal, derive_key, parse_envelope, calibrate_kdf, ScryptProfile, \
+    DEFAULT_ITER, MIN_ITER, ZLIB, LZMA, AES_GCM, CHACHA20_POLY1305
+from mysticlib.instrumentation import Counters, set_sink
+from mysticlib.records import encode_binary_records, iter_binary_records, BinaryRecordParser
+from mysticlib import SingleCodedMystic, TaggedSingleCodedMystic, EntryCodedMystic, DoubleCodedMystic, \
+    IndexedEntryCodedMystic, ShardedMystic, JournaledMystic, StreamCodedMystic, Mystic, BadKey, AsyncMystic, \
+    JSON_RECORDS, BINARY_RECORDS
 
 SKIP_SLOW_TESTS = True
 
@@ -31,6 +42,166 @@ class EncTests(unittest.TestCase):
                 dec_str = str(de, 'utf-8')
                 self.assertEqual(pt, dec_str)
 
+    def test_compression(self):
+        key = derive_key('abcd', b'\0' * 16, 1000)
+        pt = 'https://example.com/login ' * 1000
+        plain = enc(pt, None, 1000, b'\0' * 16, key=key)
+        for compression in (ZLIB, LZMA):
+            cypher = enc(pt, None, 1000, b'\0' * 16, key=key, compression=compression)
+            self.assertLess(len(cypher), len(plain) / 10)
+            self.assertEqual(str(dec(cypher, None, key=key), 'utf-8'), pt)
+            sealed = seal(pt, key, compression)
+            self.assertEqual(str(unseal(sealed, key), 'utf-8'), pt)
+        # uncompressed tokens are unchanged, so older files still read
+        self.assertEqual(str(dec(plain, None, key=key), 'utf-8'), pt)
+        self.assertEqual(str(unseal(seal(pt, key), key), 'utf-8'), pt)
+        with self.assertRaises(ValueError):
+            enc(pt, None, 1000, b'\0' * 16, key=key, compression=b'?')
+
+    def test_ciphers(self):
+        key = derive_key('abcd', b'\0' * 16, 1000)
+        other_key = derive_key('efgh', b'\0' * 16, 1000)
+        fernet = enc('hello', None, 1000, b'\0' * 16, key=key)
+        for cipher in (AES_GCM, CHACHA20_POLY1305):
+            cypher = enc('hello', None, 1000, b'\0' * 16, key=key, cipher=cipher)
+            self.assertLess(len(cypher), len(fernet))
+            self.assertEqual(dec(cypher, None, key=key), b'hello')
+            with self.assertRaises(InvalidToken):
+                dec(cypher, None, key=other_key)
+            sealed = seal('hello' * 100, key, ZLIB, cipher)
+            self.assertEqual(unseal(sealed, key), b'hello' * 100)
+
+    def test_cipher_mystic(self):
+        for mystic_type in (SingleCodedMystic, TaggedSingleCodedMystic, EntryCodedMystic, DoubleCodedMystic,
+                            IndexedEntryCodedMystic, ShardedMystic, JournaledMystic):
+            myst = mystic_type()
+            myst.password_callback = lambda *args: 'abcd'
+            myst.mutable = True
+            myst.cipher = AES_GCM
+            myst.add_password(new_password='abcd')
+            myst['one'] = '1'
+            self.assertLess(len(myst.encrypted_passwords[0]), 128)
+            buffer = BytesIO()
+            myst.to_stream(buffer)
+            buffer.seek(0)
+            loaded = Mystic.from_stream(buffer)
+            self.assertEqual(loaded.get('one', minor='abcd'), '1')
+            with self.assertRaises(BadKey):
+                loaded.get('one', minor='efgh')
+            # a loaded mystic keeps its cipher
+            self.assertEqual(loaded.cipher, AES_GCM)
+
+    def test_kdf_profiles(self):
+        profile = ScryptProfile(10, 8, 1)
+        cypher = enc('hello', 'abcd', profile)
+        salt, parsed, _ = parse_envelope(cypher)
+        self.assertEqual(parsed, profile)
+        self.assertEqual(dec(cypher, 'abcd'), b'hello')
+        with self.assertRaises(InvalidToken):
+            dec(cypher, 'efgh')
+        self.assertNotEqual(derive_key('abcd', salt, profile), derive_key('abcd', salt, DEFAULT_ITER))
+        with self.assertRaises(ValueError):
+            dec(enc('hello', 'abcd', profile).replace(bytes(profile), bytes(ScryptProfile(30, 8, 1))), 'abcd')
+
+    def test_calibration(self):
+        profile = calibrate_kdf(0.05)
+        if isinstance(profile, ScryptProfile):
+            self.assertGreaterEqual(profile.n_log2, 14)
+        else:
+            self.assertGreaterEqual(profile, MIN_ITER)
+        self.assertIsInstance(calibrate_kdf(0.05, allow_scrypt=False), int)
+        scm = SingleCodedMystic()
+        scm.kdf = ScryptProfile(10)
+        scm.password_callback = lambda *args: 'abcd'
+        scm.mutable = True
+        scm.add_password(new_password='abcd')
+        scm['one'] = '1'
+        buffer = BytesIO()
+        scm.to_stream(buffer)
+        buffer.seek(0)
+        self.assertEqual(Mystic.from_stream(buffer).get('one', minor='abcd'), '1')
+
+    def test_body_kdf(self):
+        # the body is encrypted under the random master key, so only the slots pay for the calibrated derivation
+        scm = SingleCodedMystic()
+        scm.kdf = ScryptProfile(10)
+        scm.password_callback = lambda *args: 'abcd'
+        scm.mutable = True
+        scm.add_password(new_password='abcd')
+        scm['one'] = '1'
+        buffer = BytesIO()
+        scm.to_stream(buffer)
+        _, body_profile, _ = parse_envelope(scm.coded_dict)
+        self.assertNotEqual(body_profile, DEFAULT_ITER)
+        self.assertLess(body_profile, MIN_ITER)
+        loaded = Mystic.from_buffer(buffer.getvalue())
+        counters = Counters()
+        previous = set_sink(counters)
+        try:
+            self.assertEqual(loaded.get('one', minor='abcd'), '1')
+        finally:
+            set_sink(previous)
+        # the slot's derivation, and a single iteration for the body
+        self.assertEqual(counters.counters['derive_key'][0], 2)
+
+    def test_compressed_mystic(self):
+        for mystic_type in (SingleCodedMystic, JournaledMystic):
+            myst = mystic_type()
+            myst.password_callback = lambda *args: 'abcd'
+            myst.mutable = True
+            myst.compression = ZLIB
+            myst.add_password(new_password='abcd')
+            for i in range(100):
+                myst[f'https://example.com/{i}'] = f'user{i}@example.com'
+            buffer = BytesIO()
+            myst.to_stream(buffer)
+            myst['extra'] = 'value'
+            if not myst.append_to_stream(buffer):
+                buffer = BytesIO()
+                myst.to_stream(buffer)
+            buffer.seek(0)
+            loaded = Mystic.from_stream(buffer)
+            self.assertEqual(loaded.get('extra', minor='abcd'), 'value')
+            self.assertEqual(loaded.get('https://example.com/7', minor='abcd'), 'user7@example.com')
+
+    def test_loaded_options(self):
+        # a mystic that is saved again keeps its compression and cipher
+        scm = SingleCodedMystic()
+        scm.password_callback = lambda *args: 'abcd'
+        scm.mutable = True
+        scm.compression = LZMA
+        scm.cipher = AES_GCM
+        scm.add_password(new_password='abcd')
+        scm['one'] = '1'
+        buffer = BytesIO()
+        scm.to_stream(buffer)
+        loaded = Mystic.from_buffer(buffer.getvalue())
+        self.assertEqual((loaded.compression, loaded.cipher), (LZMA, AES_GCM))
+        loaded.password_callback = lambda *args: 'abcd'
+        loaded.mutable = True
+        loaded['two'] = '2'
+        buffer = BytesIO()
+        loaded.to_stream(buffer)
+        _, _, token = parse_envelope(loaded.coded_dict)
+        self.assertEqual(bytes(token[:3]), b'\0c' + LZMA)
+        self.assertEqual(bytes(token[3:6]), b'\0a' + AES_GCM)
+        # changing the compression alone re-encrypts the dict
+        loaded = Mystic.from_buffer(buffer.getvalue())
+        loaded.password_callback = lambda *args: 'abcd'
+        loaded.compression = None
+        loaded.to_stream(BytesIO())
+        _, _, token = parse_envelope(loaded.coded_dict)
+        self.assertEqual(bytes(token[:3]), b'\0a' + AES_GCM)
+        self.assertEqual(loaded['two'], '2')
+        # an uncompressed fernet mystic stays that way
+        plain = SingleCodedMystic()
+        plain.password_callback = lambda *args: 'abcd'
+        plain.add_password(new_password='abcd')
+        buffer = BytesIO()
+        plain.to_stream(buffer)
+        loaded = Mystic.from_buffer(buffer.getvalue())
+        self.assertEqual((loaded.compression, loaded.cipher), (None, None))
+
 
 class SCMTests(unittest.TestCase):
     @staticmethod
@@ -100,3 +271,764 @@ class SCMTests(unittest.TestCase):
         last.password_callback = self.pass_callback
         d = last.load()
         self.assertEqual(d, {'two':'2','three':'3','hi':'shalom'})
+
+
+class KeyCacheTests(unittest.TestCase):
+    def make_loaded(self):
+        scm = SingleCodedMystic()
+        scm.password_callback = lambda *args: 'abcd'
+        scm.mutable = True
+        scm.add_password(new_password='abcd')
+        scm['one'] = '1'
+        buffer = BytesIO()
+        scm.to_stream(buffer)
+        buffer.seek(0)
+        loaded = SingleCodedMystic.from_stream(buffer)
+        self.prompts = 0
+
+        def callback(*args):
+            self.prompts += 1
+            return 'abcd'
+
+        loaded.password_callback = callback
+        return loaded
+
+    def test_no_cache(self):
+        loaded = self.make_loaded()
+        self.assertEqual(loaded['one'], '1')
+        self.assertEqual(loaded['one'], '1')
+        self.assertEqual(self.prompts, 2)
+
+    def test_cache_and_lock(self):
+        loaded = self.make_loaded()
+        loaded.enable_key_cache()
+        self.assertEqual(loaded['one'], '1')
+        self.assertEqual(loaded['one'], '1')
+        self.assertIn('one', loaded)
+        self.assertEqual(self.prompts, 1)
+        loaded.lock()
+        self.assertEqual(loaded['one'], '1')
+        self.assertEqual(self.prompts, 2)
+
+    def test_cache_expiry(self):
+        loaded = self.make_loaded()
+        loaded.enable_key_cache(ttl=None, idle=0.05)
+        self.assertEqual(loaded['one'], '1')
+        time.sleep(0.1)
+        self.assertFalse(loaded.key_cache.unlocked)
+        self.assertEqual(loaded['one'], '1')
+        self.assertEqual(self.prompts, 2)
+
+    def test_cache_commit(self):
+        loaded = self.make_loaded()
+        loaded.enable_key_cache()
+        loaded.mutable = True
+        loaded['two'] = '2'
+        buffer = BytesIO()
+        loaded.to_stream(buffer)
+        self.assertEqual(self.prompts, 1)
+        buffer.seek(0)
+        reloaded = SingleCodedMystic.from_stream(buffer)
+        self.assertEqual(reloaded.get('two', minor='abcd'), '2')
+
+
+class SnapshotTests(unittest.TestCase):
+    def test_one_unlock(self):
+        scm = SingleCodedMystic()
+        scm.password_callback = lambda *args: 'abcd'
+        scm.mutable = True
+        scm.add_password(new_password='abcd')
+        for i in range(20):
+            scm[str(i)] = str(i * i)
+        buffer = BytesIO()
+        scm.to_stream(buffer)
+        buffer.seek(0)
+        loaded = SingleCodedMystic.from_stream(buffer)
+        prompts = []
+        loaded.password_callback = lambda *args: prompts.append(args) or 'abcd'
+
+        self.assertEqual(dict(loaded.items()), {str(i): str(i * i) for i in range(20)})
+        self.assertEqual(len(prompts), 1)
+
+        snapshot = loaded.snapshot()
+        self.assertEqual(len(prompts), 2)
+        self.assertEqual(snapshot['3'], '9')
+        self.assertEqual(sorted(snapshot.keys(), key=int), [str(i) for i in range(20)])
+        self.assertEqual(len(prompts), 2)
+        with self.assertRaises(TypeError):
+            snapshot['3'] = '4'
+
+    def test_mutable_snapshot_is_a_copy(self):
+        scm = SingleCodedMystic()
+        scm.password_callback = lambda *args: 'abcd'
+        scm.mutable = True
+        scm.add_password(new_password='abcd')
+        scm['one'] = '1'
+        snapshot = scm.snapshot()
+        scm['one'] = '2'
+        self.assertEqual(snapshot['one'], '1')
+
+
+class SlotTests(unittest.TestCase):
+    passwords = ['a', 'b', 'c', 'd']
+
+    def make(self):
+        scm = SingleCodedMystic()
+        scm.mutable = True
+        scm.add_password(new_password=self.passwords[0])
+        for prev, pw in zip(self.passwords, self.passwords[1:]):
+            scm.add_password(prev, pw)
+        scm.password_callback = lambda *args: 'a'
+        scm['one'] = '1'
+        return scm
+
+    def test_any_slot(self):
+        scm = self.make()
+        for pw in self.passwords:
+            self.assertEqual(scm._get_master(pw), scm._get_master('a'))
+        with self.assertRaises(BadKey):
+            scm._get_master('e')
+
+    def test_del_password(self):
+        scm = self.make()
+        scm.del_password('c')
+        self.assertEqual(len(scm.encrypted_passwords), 3)
+        with self.assertRaises(BadKey):
+            scm._get_master('c')
+        with self.assertRaises(BadKey):
+            scm.del_password('c')
+        self.assertEqual(scm._get_master('d'), scm._get_master('b'))
+
+
+class TaggedSlotTests(SlotTests):
+    def make(self):
+        scm = TaggedSingleCodedMystic()
+        scm.mutable = True
+        scm.add_password(new_password=self.passwords[0])
+        for prev, pw in zip(self.passwords, self.passwords[1:]):
+            scm.add_password(prev, pw)
+        scm.password_callback = lambda *args: 'a'
+        scm['one'] = '1'
+        return scm
+
+    def test_candidates(self):
+        scm = self.make()
+        for i, pw in enumerate(self.passwords):
+            self.assertIn(i, scm._slot_candidates(pw))
+
+    def test_round_trip(self):
+        scm = self.make()
+        buffer = BytesIO()
+        scm.to_stream(buffer)
+        buffer.seek(0)
+        loaded = Mystic.from_stream(buffer)
+        self.assertIsInstance(loaded, TaggedSingleCodedMystic)
+        self.assertEqual(loaded.slot_tags, scm.slot_tags)
+        for pw in self.passwords:
+            self.assertEqual(loaded.get('one', minor=pw), '1')
+        self.assertEqual(loaded.tag_kdf, DEFAULT_ITER)
+
+    def test_tag_cost(self):
+        scm = Mystic.new_from_format('scmt:16')
+        scm.password_callback = lambda *args: 'a'
+        scm.add_password(new_password='a')
+        self.assertEqual(scm.tag_kdf, DEFAULT_ITER // 16)
+        scrypt = Mystic.new_from_format('scmt:16')
+        scrypt.kdf = ScryptProfile(14)
+        scrypt.password_callback = lambda *args: 'a'
+        scrypt.mutable = True
+        scrypt.add_password(new_password='a')
+        scrypt['one'] = '1'
+        buffer = BytesIO()
+        scrypt.to_stream(buffer)
+        buffer.seek(0)
+        loaded = Mystic.from_stream(buffer)
+        self.assertEqual(loaded.tag_kdf, ScryptProfile(10))
+        self.assertEqual(loaded.get('one', minor='a'), '1')
+        with self.assertRaises(ValueError):
+            Mystic.new_from_format('scmt:0')
+
+
+class ECMTests(unittest.TestCase):
+    mystic_type = EntryCodedMystic
+
+    def make(self):
+        ecm = self.mystic_type()
+        ecm.password_callback = lambda *args: 'abcd'
+        ecm.mutable = True
+        ecm.add_password(new_password='abcd')
+        ecm.add_password('abcd', 'efgh')
+        ecm['one'] = '1'
+        ecm['two'] = '2'
+        ecm['three'] = 'שלוש'
+        buffer = BytesIO()
+        ecm.to_stream(buffer)
+        buffer.seek(0)
+        return buffer
+
+    def test_make_and_load(self):
+        loaded = Mystic.from_stream(self.make())
+        self.assertIsInstance(loaded, self.mystic_type)
+        loaded.password_callback = lambda *args: 'efgh'
+        self.assertEqual(len(loaded), 3)
+        self.assertEqual(loaded['three'], 'שלוש')
+        self.assertIn('two', loaded)
+        self.assertNotIn('four', loaded)
+        self.assertIsNone(loaded._index)
+        self.assertEqual(dict(loaded.snapshot()), {'one': '1', 'two': '2', 'three': 'שלוש'})
+        self.assertFalse(loaded.changed())
+
+    def test_edit(self):
+        loaded = Mystic.from_stream(self.make())
+        loaded.password_callback = lambda *args: 'abcd'
+        loaded.mutable = True
+        loaded['hi'] = 'shalom'
+        del loaded['two']
+        loaded['three'] = '3'
+        buffer = BytesIO()
+        loaded.to_stream(buffer)
+        buffer.seek(0)
+        last = Mystic.from_stream(buffer)
+        self.assertEqual(last.get('hi', minor='efgh'), 'shalom')
+        self.assertIsNone(last.get('two', minor='efgh'))
+        last.password_callback = lambda *args: 'abcd'
+        self.assertEqual(dict(last.items()), {'one': '1', 'three': '3', 'hi': 'shalom'})
+
+    def test_untouched_entries(self):
+        loaded = Mystic.from_stream(self.make())
+        loaded.password_callback = lambda *args: 'abcd'
+        loaded.mutable = True
+        untouched = loaded.coded_entries[0]
+        loaded['hi'] = 'shalom'
+        loaded.to_stream(BytesIO())
+        self.assertIn(untouched, loaded.coded_entries)
+
+
+class ECMIntegrityTests(unittest.TestCase):
+    mystic_type = EntryCodedMystic
+
+    def tampered(self, tamper):
+        ecm = self.mystic_type()
+        ecm.password_callback = lambda *args: 'abcd'
+        ecm.add_password(new_password='abcd')
+        ecm['one'] = '1'
+        ecm['two'] = '2'
+        ecm['three'] = '3'
+        buffer = BytesIO()
+        ecm.to_stream(buffer)
+        buffer.seek(0)
+        loaded = Mystic.from_stream(buffer)
+        tamper(loaded.coded_entries)
+        # save the tampered entries along with the original manifest
+        buffer = BytesIO()
+        loaded.to_stream(buffer)
+        buffer.seek(0)
+        ret = Mystic.from_stream(buffer)
+        ret.password_callback = lambda *args: 'abcd'
+        return ret
+
+    def test_intact(self):
+        loaded = self.tampered(lambda entries: None)
+        self.assertEqual(dict(loaded.snapshot()), {'one': '1', 'two': '2', 'three': '3'})
+
+    def test_dropped_entry(self):
+        loaded = self.tampered(lambda entries: entries.pop())
+        with self.assertRaises(ValueError):
+            loaded.get('one')
+
+    def test_replaced_entries(self):
+        def tamper(entries):
+            entries[0], entries[1] = entries[1], entries[0]
+
+        loaded = self.tampered(tamper)
+        with self.assertRaises(ValueError):
+            loaded.get('one')
+
+    def test_swapped_values(self):
+        def tamper(entries):
+            (k0, v0), (k1, v1) = entries[:2]
+            entries[:2] = [(k0, v1), (k1, v0)]
+
+        loaded = self.tampered(tamper)
+        # even past the manifest, a value can't be read under another key
+        loaded._verified = True
+        with self.assertRaises(ValueError):
+            loaded['one']
+        with self.assertRaises(ValueError):
+            dict(loaded.snapshot())
+
+
+class IECMIntegrityTests(ECMIntegrityTests):
+    mystic_type = IndexedEntryCodedMystic
+
+
+class DCMTests(ECMTests):
+    mystic_type = DoubleCodedMystic
+
+    def test_untouched_entries(self):
+        loaded = Mystic.from_stream(self.make())
+        loaded.password_callback = lambda *args: 'abcd'
+        loaded.mutable = True
+        untouched = loaded.coded_values
+        loaded['hi'] = 'shalom'
+        loaded.to_stream(BytesIO())
+        self.assertTrue(loaded.coded_values.startswith(untouched))
+
+    def test_swapped_values(self):
+        loaded = Mystic.from_stream(self.make())
+        loaded.password_callback = lambda *args: 'abcd'
+        # 'one' and 'two' have values of the same length, swap them in place
+        index = loaded._get_index(loaded._get_master())
+        (o1, l1, _), (o2, l2, _) = index['one'], index['two']
+        self.assertEqual(l1, l2)
+        values = bytearray(loaded.coded_values)
+        values[o1:o1 + l1], values[o2:o2 + l2] = values[o2:o2 + l2], values[o1:o1 + l1]
+        loaded.coded_values = bytes(values)
+        with self.assertRaises(ValueError):
+            loaded['one']
+        with self.assertRaises(ValueError):
+            dict(loaded.snapshot())
+
+    def test_rolled_back_value(self):
+        old = Mystic.from_stream(self.make())
+        old.password_callback = lambda *args: 'abcd'
+        old.mutable = True
+        old_token = old._token(old._get_index(old._get_master())['one'], old.coded_values)
+        old['one'] = '9'
+        buffer = BytesIO()
+        old.to_stream(buffer)
+        buffer.seek(0)
+        loaded = Mystic.from_stream(buffer)
+        loaded.password_callback = lambda *args: 'abcd'
+        self.assertEqual(loaded['one'], '9')
+        # put the older value of the same key back in place
+        offset, length, _ = loaded._get_index(loaded._get_master())['one']
+        self.assertEqual(length, len(old_token))
+        values = bytearray(loaded.coded_values)
+        values[offset:offset + length] = old_token
+        loaded.coded_values = bytes(values)
+        with self.assertRaises(ValueError):
+            loaded['one']
+
+    def test_keys_only_decrypt_index(self):
+        loaded = Mystic.from_stream(self.make())
+        loaded.password_callback = lambda *args: 'abcd'
+        loaded.coded_values = b'\0' * len(loaded.coded_values)
+        self.assertEqual(set(loaded.keys()), {'one', 'two', 'three'})
+        self.assertEqual(set(loaded.snapshot()), {'one', 'two', 'three'})
+
+
+class IECMTests(ECMTests):
+    mystic_type = IndexedEntryCodedMystic
+
+    def test_lookup_decrypts_one_key(self):
+        loaded = Mystic.from_stream(self.make())
+        loaded.password_callback = lambda *args: 'abcd'
+        target = loaded.coded_entries[1]
+        # check the entries against the manifest first, since garbling them is caught by the check
+        loaded._unlock_master()
+        # garble the other keys (but not their tags), a lookup must not touch them
+        for i, (ek, ev) in enumerate(loaded.coded_entries):
+            if i != 1:
+                garbled = b'g' * len(ek)
+                loaded._entry_tags[garbled] = loaded._entry_tags.pop(ek)
+                loaded.coded_entries[i] = (garbled, ev)
+        key = str(unseal(target[0], loaded._get_master()), 'utf-8')
+        self.assertIn(key, loaded)
+        self.assertEqual(loaded.get(key, minor='efgh'), {'one': '1', 'two': '2', 'three': 'שלוש'}[key])
+        self.assertNotIn('four', loaded)
+
+
+class ShardTests(unittest.TestCase):
+    def make(self, n=200):
+        shm = Mystic.new_from_format('shm:8')
+        shm.password_callback = lambda *args: 'abcd'
+        shm.mutable = True
+        shm.add_password(new_password='abcd')
+        for i in range(n):
+            shm[f'key {i}'] = f'value {i}'
+        buffer = BytesIO()
+        shm.to_stream(buffer)
+        buffer.seek(0)
+        return buffer
+
+    def test_round_trip(self):
+        loaded = Mystic.from_stream(self.make())
+        self.assertIsInstance(loaded, ShardedMystic)
+        self.assertEqual(len(loaded.coded_buckets), 8)
+        loaded.password_callback = lambda *args: 'abcd'
+        self.assertEqual(len(loaded), 200)
+        self.assertEqual(loaded['key 17'], 'value 17')
+        self.assertNotIn('key 200', loaded)
+        self.assertEqual(dict(loaded.items()), {f'key {i}': f'value {i}' for i in range(200)})
+
+    def test_one_bucket_per_change(self):
+        loaded = Mystic.from_stream(self.make())
+        loaded.password_callback = lambda *args: 'abcd'
+        before = list(loaded.coded_buckets)
+        loaded['key 3'] = 'three'
+        del loaded['key 4']
+        loaded['new'] = 'new'
+        buffer = BytesIO()
+        loaded.to_stream(buffer)
+        self.assertGreaterEqual(sum(a == b for (a, b) in zip(before, loaded.coded_buckets)), 8 - 3)
+        buffer.seek(0)
+        loaded = Mystic.from_stream(buffer)
+        self.assertEqual(loaded.get('key 3', minor='abcd'), 'three')
+        self.assertIsNone(loaded.get('key 4', minor='abcd'))
+        loaded.password_callback = lambda *args: 'abcd'
+        self.assertEqual(len(loaded), 200)
+        self.assertEqual(len(list(loaded)), 200)
+
+    def test_truncated(self):
+        data = self.make(50).getvalue()
+        loaded = Mystic.from_stream(BytesIO(data))
+        # drop the last bucket
+        truncated = data[:-len(loaded.coded_buckets[-1]) - 4]
+        loaded = Mystic.from_stream(BytesIO(truncated))
+        loaded.password_callback = lambda *args: 'abcd'
+        with self.assertRaises(ValueError):
+            len(loaded)
+        with self.assertRaises(ValueError):
+            dict(loaded.items())
+        # cut in the middle of the last bucket
+        with self.assertRaises(EOFError):
+            Mystic.from_stream(BytesIO(data[:-10]))
+
+    def test_swapped_and_rolled_back(self):
+        old = Mystic.from_stream(self.make(50))
+        old.password_callback = lambda *args: 'abcd'
+        old.mutable = True
+        changed = old._bucket_of(old._get_master(), 'key 0')
+        old_bucket = old.coded_buckets[changed]
+        old['key 0'] = 'changed'
+        buffer = BytesIO()
+        old.to_stream(buffer)
+
+        def tampered(tamper):
+            loaded = Mystic.from_buffer(buffer.getvalue())
+            loaded.password_callback = lambda *args: 'abcd'
+            tamper(loaded.coded_buckets)
+            return loaded
+
+        def swap(buckets):
+            other = (changed + 1) % len(buckets)
+            buckets[changed], buckets[other] = buckets[other], buckets[changed]
+
+        def roll_back(buckets):
+            buckets[changed] = old_bucket
+
+        for tamper in (swap, roll_back):
+            with self.assertRaises(ValueError):
+                tampered(tamper)['key 0']
+        self.assertEqual(tampered(lambda buckets: None)['key 0'], 'changed')
+
+    def test_format_options(self):
+        with self.assertRaises(ValueError):
+            Mystic.new_from_format('shm:zero')
+        with self.assertRaises(ValueError):
+            Mystic.new_from_format('scm:8')
+
+
+class JournalTests(unittest.TestCase):
+    def make(self):
+        jcm = JournaledMystic()
+        jcm.password_callback = lambda *args: 'abcd'
+        jcm.mutable = True
+        jcm.add_password(new_password='abcd')
+        for i in range(100):
+            jcm[str(i)] = str(i) * 10
+        buffer = BytesIO()
+        jcm.to_stream(buffer)
+        return jcm, buffer
+
+    def reload(self, buffer):
+        buffer.seek(0)
+        ret = Mystic.from_stream(buffer)
+        ret.password_callback = lambda *args: 'abcd'
+        ret.mutable = True
+        return ret
+
+    def test_append(self):
+        jcm, buffer = self.make()
+        jcm.scrub_overwritten = False
+        size = len(buffer.getvalue())
+        jcm['5'] = 'five'
+        del jcm['6']
+        self.assertTrue(jcm.append_to_stream(buffer))
+        self.assertFalse(jcm.changed())
+        self.assertLess(len(buffer.getvalue()) - size, 200)
+        loaded = self.reload(buffer)
+        self.assertIsInstance(loaded, JournaledMystic)
+        self.assertEqual(loaded['5'], 'five')
+        self.assertNotIn('6', loaded)
+        self.assertEqual(len(loaded), 99)
+        loaded['new'] = 'seven'
+        self.assertTrue(loaded.append_to_stream(buffer))
+        self.assertEqual(self.reload(buffer)['new'], 'seven')
+
+    def test_scrub_overwritten(self):
+        for change in ('overwrite', 'delete'):
+            jcm, buffer = self.make()
+            jcm['new'] = 'value'
+            self.assertTrue(jcm.append_to_stream(buffer))
+            if change == 'overwrite':
+                jcm['new'] = 'other'
+            else:
+                del jcm['new']
+            # the old value is still in the journal, so the change is not appended
+            self.assertFalse(jcm.append_to_stream(buffer))
+            buffer = BytesIO()
+            jcm.to_stream(buffer)
+            self.assertFalse(jcm.coded_journal)
+            loaded = self.reload(buffer)
+            self.assertEqual(loaded.get('new'), 'other' if change == 'overwrite' else None)
+            loaded['newer'] = 'value'
+            self.assertTrue(loaded.append_to_stream(buffer))
+
+    def test_set_decodes_once(self):
+        _, buffer = self.make()
+        loaded = self.reload(buffer)
+        loaded.mutable = False
+        calls = []
+        for action in (loaded.load, lambda: loaded.__setitem__('5', 'five')):
+            counters = Counters()
+            previous = set_sink(counters)
+            try:
+                action()
+            finally:
+                set_sink(previous)
+            calls.append(counters.counters['dec'][0])
+        # setting a value decrypts the vault as often as loading it
+        self.assertEqual(calls[0], calls[1])
+
+    def test_stale_stream(self):
+        jcm, buffer = self.make()
+        jcm['new'] = 'five'
+        other = BytesIO()
+        jcm.to_stream(other)
+        jcm['newer'] = 'six'
+        self.assertFalse(jcm.append_to_stream(buffer))
+        self.assertTrue(jcm.append_to_stream(other))
+        self.assertEqual(self.reload(other)['new'], 'five')
+
+    def test_slots_changed(self):
+        jcm, buffer = self.make()
+        jcm.add_password('abcd', 'efgh')
+        self.assertFalse(jcm.append_to_stream(buffer))
+
+    def test_compaction(self):
+        jcm, buffer = self.make()
+        jcm.compact_ratio = 0.01
+        jcm['5'] = 'five'
+        self.assertFalse(jcm.append_to_stream(buffer))
+        self.assertTrue(jcm.coded_journal)
+        buffer = BytesIO()
+        jcm.to_stream(buffer)
+        self.assertFalse(jcm.coded_journal)
+        self.assertEqual(self.reload(buffer)['5'], 'five')
+
+
+class StreamTests(unittest.TestCase):
+    def make(self, n=2000):
+        stm = StreamCodedMystic()
+        stm.chunk_size = 1024
+        stm.password_callback = lambda *args: 'abcd'
+        stm.mutable = True
+        stm.add_password(new_password='abcd')
+        for i in range(n):
+            stm[f'key {i}'] = f'value\n{i} שלום'
+        buffer = BytesIO()
+        stm.to_stream(buffer)
+        buffer.seek(0)
+        return buffer
+
+    def test_round_trip(self):
+        buffer = self.make()
+        loaded_source = buffer.getvalue()
+        loaded = Mystic.from_stream(buffer)
+        self.assertIsInstance(loaded, StreamCodedMystic)
+        self.assertGreater(len(loaded.coded_chunks), 10)
+        self.assertEqual(loaded.get('key 1500', minor='abcd'), 'value\n1500 שלום')
+        loaded.password_callback = lambda *args: 'abcd'
+        self.assertEqual(len(loaded), 2000)
+        rewritten = BytesIO()
+        loaded.to_stream(rewritten)
+        # an unchanged mystic is written without being re-encrypted
+        self.assertEqual(rewritten.getvalue()[-1000:], loaded_source[-1000:])
+
+    def test_unlocked_read(self):
+        buffer = self.make()
+        buffer.readline()
+        loaded = StreamCodedMystic.from_stream_unlocked(buffer, 'abcd', check_header=False)
+        self.assertIsNone(loaded.coded_chunks)
+        self.assertEqual(loaded['key 3'], 'value\n3 שלום')
+        loaded['key 3'] = 'three'
+        rewritten = BytesIO()
+        loaded.to_stream(rewritten, 'abcd')
+        rewritten.seek(0)
+        self.assertEqual(Mystic.from_stream(rewritten).get('key 3', minor='abcd'), 'three')
+
+    def test_truncated(self):
+        buffer = self.make()
+        loaded = Mystic.from_stream(buffer)
+        loaded.coded_chunks[-1] = (False, loaded.coded_chunks[-1][1])
+        with self.assertRaises(ValueError):
+            loaded.load('abcd')
+        truncated = BytesIO(buffer.getvalue()[:-100])
+        with self.assertRaises(EOFError):
+            Mystic.from_stream(truncated)
+
+
+class RecordTests(unittest.TestCase):
+    pairs = [('', ''), ('one', '1'), ('line\nbreak', 'שלום\n'), ('emoji \U0001F600', 'x' * 1000)] \
+            + [(f'key {i}', f'value {i}') for i in range(3000)]
+
+    def test_binary_round_trip(self):
+        encoded = encode_binary_records(self.pairs, block_len=100)
+        self.assertEqual(list(iter_binary_records(encoded)), self.pairs)
+        self.assertEqual([k for (k, v) in iter_binary_records(encoded, values=False)], [k for (k, v) in self.pairs])
+        parser = BinaryRecordParser()
+        parsed = []
+        for i in range(0, len(encoded), 777):
+            parsed.extend(parser.feed(encoded[i:i + 777]))
+        parser.close()
+        self.assertEqual(parsed, self.pairs)
+
+    def test_binary_truncated(self):
+        encoded = encode_binary_records(self.pairs, block_len=100)
+        with self.assertRaises(ValueError):
+            list(iter_binary_records(encoded[:-1]))
+        # records before the truncated block are still read
+        self.assertEqual(next(iter_binary_records(encoded[:-1])), self.pairs[0])
+        parser = BinaryRecordParser()
+        parser.feed(encoded[:-1])
+        with self.assertRaises(ValueError):
+            parser.close()
+
+    def test_single_coded_format(self):
+        scm = SingleCodedMystic()
+        scm.password_callback = lambda *args: 'abcd'
+        scm.mutable = True
+        scm.record_format = BINARY_RECORDS
+        scm.add_password(new_password='abcd')
+        scm.update(dict(self.pairs))
+        buffer = BytesIO()
+        scm.to_stream(buffer)
+        buffer.seek(0)
+        loaded = Mystic.from_stream(buffer)
+        self.assertEqual(dict(loaded.load('abcd')), dict(self.pairs))
+        self.assertEqual(loaded._payload_format, BINARY_RECORDS)
+        # saving keeps the format the mystic was read in, unless told otherwise
+        loaded.password_callback = lambda *args: 'abcd'
+        loaded.record_format = JSON_RECORDS
+        converted = BytesIO()
+        loaded.to_stream(converted)
+        converted.seek(0)
+        converted = Mystic.from_stream(converted)
+        self.assertEqual(dict(converted.load('abcd')), dict(self.pairs))
+        self.assertEqual(converted._payload_format, JSON_RECORDS)
+
+    def test_stream_coded_format(self):
+        stm = StreamCodedMystic()
+        stm.chunk_size = 1024
+        stm.password_callback = lambda *args: 'abcd'
+        stm.mutable = True
+        stm.record_format = BINARY_RECORDS
+        stm.add_password(new_password='abcd')
+        stm.update(dict(self.pairs))
+        buffer = BytesIO()
+        stm.to_stream(buffer)
+        buffer.seek(0)
+        loaded = Mystic.from_stream(buffer)
+        self.assertEqual(loaded._chunks_format, BINARY_RECORDS)
+        self.assertEqual(dict(loaded.load('abcd')), dict(self.pairs))
+
+
+class InstrumentationTests(unittest.TestCase):
+    def test_counters(self):
+        counters = Counters()
+        previous = set_sink(counters)
+        try:
+            scm = SingleCodedMystic()
+            scm.password_callback = lambda *args: 'abcd'
+            scm.mutable = True
+            scm.add_password(new_password='abcd')
+            scm['one'] = '1'
+            buffer = BytesIO()
+            scm.to_stream(buffer)
+            buffer.seek(0)
+            self.assertIn('commit', counters.counters)
+            counters.clear()
+            Mystic.from_stream(buffer).get('one', minor='abcd')
+        finally:
+            set_sink(previous)
+        calls, _, size = counters.counters['dec']
+        self.assertEqual(calls, 2)  # the slot and the dict
+        self.assertGreater(size, 0)
+        self.assertIn('derive_key', counters.counters)
+        self.assertIn('derive_key', counters.report())
+        before = dict(counters.counters)
+        SingleCodedMystic().snapshot()
+        self.assertEqual(counters.counters, before)
+
+
+class AsyncTests(unittest.TestCase):
+    def test_concurrent(self):
+        async def run():
+            mystics = []
+            for i in range(4):
+                myst = AsyncMystic(SingleCodedMystic())
+                myst.mystic.mutable = True
+                await myst.aadd_password(new_password=f'pass {i}')
+                await myst.aset('key', str(i), minor=f'pass {i}')
+                mystics.append(myst)
+            buffers = [BytesIO() for _ in mystics]
+            await asyncio.gather(*(m.ato_stream(b, f'pass {i}') for (i, (m, b)) in enumerate(zip(mystics, buffers))))
+            for b in buffers:
+                b.seek(0)
+            loaded = await asyncio.gather(*(AsyncMystic.afrom_stream(b) for b in buffers))
+            values = await asyncio.gather(*(m.aget('key', minor=f'pass {i}') for (i, m) in enumerate(loaded)))
+            self.assertEqual(values, ['0', '1', '2', '3'])
+            self.assertEqual(await loaded[2].aload('pass 2'), {'key': '2'})
+            with self.assertRaises(BadKey):
+                await loaded[0].aget('key', minor='pass 1')
+
+        asyncio.run(run())
+
+
+class BufferTests(unittest.TestCase):
+    def make(self, mystic_type):
+        myst = mystic_type()
+        myst.password_callback = lambda *args: 'abcd'
+        myst.mutable = True
+        myst.add_password(new_password='abcd')
+        myst['one'] = '1'
+        myst['three'] = 'שלוש'
+        buffer = BytesIO()
+        myst.to_stream(buffer)
+        return buffer.getvalue()
+
+    def test_from_buffer(self):
+        for mystic_type in Mystic.formats.values():
+            with self.subTest(mystic_type.__name__):
+                raw = self.make(mystic_type)
+                for buffer in (raw, memoryview(raw), bytearray(raw)):
+                    loaded = Mystic.from_buffer(buffer)
+                    self.assertIsInstance(loaded, mystic_type)
+                    loaded.password_callback = lambda *args: 'abcd'
+                    self.assertEqual(dict(loaded.snapshot()), {'one': '1', 'three': 'שלוש'})
+                    loaded.mutable = True
+                    loaded['two'] = '2'
+                    rewritten = BytesIO()
+                    loaded.to_stream(rewritten)
+                    rewritten.seek(0)
+                    self.assertEqual(Mystic.from_stream(rewritten).get('two', minor='abcd'), '2')
+
+    def test_mmap(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(self.make(SingleCodedMystic))
+            f.flush()
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            loaded = Mystic.from_buffer(buffer)
+            self.assertEqual(loaded.get('three', minor='abcd'), 'שלוש')
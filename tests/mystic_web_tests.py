@@ -0,0 +1,548 @@
+from io import BytesIO
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import unittest
+import threading
+import time
+
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from mysticlib import EntryCodedMystic, DoubleCodedMystic, Mystic, BadKey
+from mysticlib.instrumentation import Counters, set_sink
+from mysticweb import app
+from mysticweb.fetch import Fetcher, FetchError, FetchTimeout, TooLarge
+from mysticweb.admission import Backoff, SingleFlight, UnlockPool
+from mysticweb.sessions import SessionCache
+from mysticweb.exceptions import BackedOff, Overloaded
+from mysticweb import metrics
+import mysticweb.routes as routes
+
+# unlock in the test's process
+app.config['UNLOCK_WORKERS'] = 0
+
+PASSWORD = 'correct horse battery staple'
+
+
+def make_vault(pairs=(('one', 'uno'), ('two', 'dos'))):
+    mystic = EntryCodedMystic()
+    mystic.add_password(None, PASSWORD)
+    mystic.password_callback = lambda x: PASSWORD
+    # keep the decrypted keys while building the vault, so every pair doesn't decrypt all the keys before it
+    mystic.mutable = True
+    for k, v in pairs:
+        mystic[k] = v
+    dst = BytesIO()
+    mystic.to_stream(dst)
+    return dst.getvalue()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    etag = '"v1"'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_body(self, body, headers=(), length=True):
+        self.send_response(200)
+        for header in headers:
+            self.send_header(*header)
+        if length:
+            self.send_header('Content-Length', str(len(body)))
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        self.server.connections.add(self.client_address)
+        if self.path == '/vault':
+            if self.headers.get('If-None-Match') == self.etag:
+                self.send_response(304)
+                self.send_header('ETag', self.etag)
+                self.end_headers()
+            else:
+                self.send_body(self.server.vault, [('ETag', self.etag)])
+        elif self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/vault')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif self.path == '/big':
+            self.send_body(b'\0' * 10_000)
+        elif self.path == '/big-unsized':
+            self.send_body(b'\0' * 10_000, length=False)
+            self.close_connection = True
+        elif self.path == '/slow':
+            time.sleep(0.5)
+            self.send_body(b'late')
+        else:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+
+class StandInServerMixin:
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.server.daemon_threads = True
+        cls.server.vault = make_vault()
+        cls.thread = Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.base = f'http://127.0.0.1:{cls.server.server_address[1]}'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.connections = set()
+
+
+class FetchTests(StandInServerMixin, unittest.TestCase):
+    def test_conditional(self):
+        fetcher = Fetcher()
+        outcomes = []
+        fetcher.observer = lambda outcome, seconds: outcomes.append(outcome)
+        self.assertEqual(fetcher.fetch(self.base + '/vault'), self.server.vault)
+        self.assertEqual(fetcher.fetch(self.base + '/vault'), self.server.vault)
+        self.assertEqual(self.server.requests, [('/vault', None), ('/vault', StandInHandler.etag)])
+        self.assertEqual(outcomes, ['ok', 'not_modified'])
+
+    def test_keep_alive(self):
+        fetcher = Fetcher()
+        for _ in range(3):
+            fetcher.fetch(self.base + '/vault')
+        fetcher.fetch(self.base + '/redirect')
+        self.assertEqual(len(self.server.requests), 5)
+        self.assertEqual(len(self.server.connections), 1)
+        fetcher.close()
+
+    def test_too_large(self):
+        fetcher = Fetcher(max_bytes=1_000)
+        outcomes = []
+        fetcher.observer = lambda outcome, seconds: outcomes.append(outcome)
+        with self.assertRaises(TooLarge):
+            fetcher.fetch(self.base + '/big')
+        with self.assertRaises(TooLarge):
+            fetcher.fetch(self.base + '/big-unsized')
+        self.assertEqual(outcomes, ['too_large', 'too_large'])
+        # the connections cut off mid-body are not re-used
+        self.assertEqual(fetcher.fetch(self.base + '/vault'), self.server.vault)
+
+    def test_timeout(self):
+        fetcher = Fetcher(timeout=0.1)
+        outcomes = []
+        fetcher.observer = lambda outcome, seconds: outcomes.append(outcome)
+        with self.assertRaises(FetchTimeout):
+            fetcher.fetch(self.base + '/slow')
+        self.assertEqual(outcomes, ['timeout'])
+
+    def test_errors(self):
+        fetcher = Fetcher()
+        with self.assertRaises(FetchError):
+            fetcher.fetch(self.base + '/missing')
+        with self.assertRaises(FetchError):
+            fetcher.fetch('file:///etc/passwd')
+
+
+class WebTests(StandInServerMixin, unittest.TestCase):
+    def test_url_reload(self):
+        client = app.test_client()
+        for _ in range(2):
+            response = client.post('/', data={'source_kind': 'url', 'url': self.base + '/vault',
+                                              'password': PASSWORD})
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'"dos"', response.data)
+        self.assertEqual([p for (p, _) in self.server.requests], ['/vault', '/vault'])
+        self.assertEqual(self.server.requests[1][1], StandInHandler.etag)
+
+    def test_api(self):
+        client = app.test_client()
+        data = {'source_kind': 'url', 'url': self.base + '/vault', 'password': PASSWORD}
+        response = client.post('/api/keys', data=dict(data, limit='1'))
+        self.assertEqual(response.json, {'keys': ['one'], 'cursor': 'one'})
+        response = client.post('/api/keys', data=dict(data, cursor='one'))
+        self.assertEqual(response.json, {'keys': ['two'], 'cursor': None})
+        response = client.post('/api/value', data=dict(data, key='two'))
+        self.assertEqual(response.json, {'key': 'two', 'value': 'dos'})
+
+    def test_api_decrypts_on_demand(self):
+        vault = make_vault((f'k{i:02}', f'value{i:02}') for i in range(50))
+        client = app.test_client()
+        counters = Counters()
+        previous = set_sink(counters)
+
+        def post(route, **kwargs):
+            counters.clear()
+            response = client.post(route, data=dict(source_kind='file', file=(BytesIO(vault), 'v.scm'),
+                                                    password=PASSWORD, **kwargs))
+            return response, counters.counters['unseal'][0]
+
+        try:
+            response, unseals = post('/api/keys', limit='5')
+            self.assertEqual(len(response.json['keys']), 5)
+            # only the manifest and the keys are unsealed
+            self.assertEqual(unseals, 51)
+            response, unseals = post('/api/value', key='k07')
+            self.assertEqual(response.json['value'], 'value07')
+            self.assertEqual(unseals, 52)
+        finally:
+            set_sink(previous)
+
+
+class AdmissionTests(unittest.TestCase):
+    def test_backoff(self):
+        backoff = Backoff(free_attempts=2, base=10)
+        for _ in range(2):
+            backoff.check('a')
+            backoff.failed('a')
+        backoff.check('a')
+        backoff.failed('a')
+        with self.assertRaises(BackedOff):
+            backoff.check('a')
+        backoff.check('b')
+        backoff.succeeded('a')
+        backoff.check('a')
+
+    def test_single_flight(self):
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def slow(x):
+            calls.append(x)
+            started.set()
+            release.wait()
+            return x * 2
+
+        results = []
+        leader = Thread(target=lambda: results.append(flights.do('k', slow, 21)))
+        leader.start()
+        started.wait()
+        coalesced = []
+
+        def follow():
+            results.append(flights.do('k', slow, 21, on_coalesce=lambda: coalesced.append(1)))
+
+        followers = [Thread(target=follow) for _ in range(3)]
+        for f in followers:
+            f.start()
+        while len(coalesced) < 3:
+            time.sleep(0.01)
+        release.set()
+        for t in [leader, *followers]:
+            t.join()
+        self.assertEqual(results, [42] * 4)
+        self.assertEqual(calls, [21])
+        self.assertEqual(len(flights), 0)
+
+    def test_unlock_pool(self):
+        pool = UnlockPool(workers=1, queue_depth=0)
+        try:
+            mystic = Mystic.from_buffer(make_vault())
+            mystic.slot_executor = pool.executor
+            mystic.password_callback = lambda x: PASSWORD
+            self.assertEqual(dict(pool.run(mystic.snapshot)), {'one': 'uno', 'two': 'dos'})
+            mystic = Mystic.from_buffer(make_vault())
+            mystic.slot_executor = pool.executor
+            mystic.password_callback = lambda x: 'wrong'
+            with self.assertRaises(BadKey):
+                pool.run(mystic.snapshot)
+            self.assertEqual(pool.admitted, 0)
+        finally:
+            pool.shutdown()
+
+    def test_unlock_pool_overload(self):
+        pool = UnlockPool(workers=0, queue_depth=1, retry_after=7)
+        started = threading.Event()
+        release = threading.Event()
+
+        def blocked():
+            started.set()
+            release.wait()
+
+        thread = Thread(target=pool.run, args=(blocked,))
+        thread.start()
+        started.wait()
+        with self.assertRaises(Overloaded) as cm:
+            pool.run(lambda: None)
+        self.assertEqual(cm.exception.retry_after, 7)
+        release.set()
+        thread.join()
+        self.assertEqual(pool.admitted, 0)
+        pool.run(lambda: None)
+
+
+    def test_unlock_pool_tracker(self):
+        pool = UnlockPool(workers=0, queue_depth=4)
+        gauge = metrics.Gauge('test_in_flight', 'unlocks running in the test')
+        self.addCleanup(metrics._registry.remove, gauge)
+        pool.tracker = gauge.track
+        flights = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        in_flight = []
+
+        def slow():
+            started.set()
+            release.wait()
+            return gauge.samples()
+
+        leader = Thread(target=lambda: in_flight.append(flights.do('k', pool.run, slow)))
+        leader.start()
+        started.wait()
+        coalesced = []
+        followers = [Thread(target=flights.do, args=('k', pool.run, slow),
+                            kwargs={'on_coalesce': lambda: coalesced.append(1)}) for _ in range(3)]
+        for f in followers:
+            f.start()
+        while len(coalesced) < 3:
+            time.sleep(0.01)
+        release.set()
+        for t in [leader, *followers]:
+            t.join()
+        # only the leader ran, the coalesced unlocks were not counted
+        self.assertEqual(in_flight, [['test_in_flight 1']])
+        self.assertEqual(gauge.samples(), ['test_in_flight 0'])
+        with self.assertRaises(TypeError):
+            metrics._Metric('abstract', 'metrics must implement samples')
+
+
+class AdmissionWebTests(unittest.TestCase):
+    def setUp(self):
+        self.vault = make_vault()
+        self.wsgi_app = app.wsgi_app
+        self.config = dict(app.config)
+        routes._backoff = None
+        routes._unlock_pool = None
+
+    def tearDown(self):
+        app.wsgi_app = self.wsgi_app
+        app.config.update(self.config)
+        routes._backoff = None
+        routes._unlock_pool = None
+
+    def post(self, client, password=PASSWORD, route='/', **kwargs):
+        response = client.post(route, data={'source_kind': 'file', 'file': (BytesIO(self.vault), 'v.scm'),
+                                            'password': password}, **kwargs)
+        # read streamed responses to the end, so that their request context is released
+        response.get_data()
+        return response
+
+    def test_upload_in_memory(self):
+        data = {'source_kind': 'file', 'file': (BytesIO(self.vault), 'v.scm')}
+        with app.test_request_context('/', method='POST', data=data):
+            self.assertIsInstance(routes.read_source(), memoryview)
+        # larger uploads are spooled to a file, and copied
+        app.config['UPLOAD_MEMORY_BYTES'] = 10
+        data = {'source_kind': 'file', 'file': (BytesIO(self.vault), 'v.scm')}
+        with app.test_request_context('/', method='POST', data=data):
+            raw_source = routes.read_source()
+            self.assertIsInstance(raw_source, bytes)
+            self.assertEqual(raw_source, self.vault)
+        app.config['UPLOAD_MEMORY_BYTES'] = self.config['UPLOAD_MEMORY_BYTES']
+        self.assertEqual(self.post(app.test_client()).status_code, 200)
+
+    def test_overloaded(self):
+        routes._unlock_pool = UnlockPool(workers=0, queue_depth=0, retry_after=3)
+        client = app.test_client()
+        response = self.post(client)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '3')
+        response = self.post(client, route='/api/keys')
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('busy', response.json['error'])
+        self.assertEqual(client.get('/about').status_code, 200)
+
+    def test_backoff_by_forwarded_address(self):
+        app.config['PROXY_HOPS'] = 1
+        app.wsgi_app = ProxyFix(self.wsgi_app, x_for=1)
+        client = app.test_client()
+        attacker = {'X-Forwarded-For': '10.0.0.1'}
+        for _ in range(4):
+            self.assertEqual(self.post(client, 'wrong', headers=attacker).status_code, 400)
+        response = self.post(client, 'wrong', headers=attacker)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+        # other clients behind the same proxy are not affected
+        response = self.post(client, headers={'X-Forwarded-For': '10.0.0.2'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_backoff_needs_proxy_hops(self):
+        app.config['PROXY_HOPS'] = None
+        client = app.test_client()
+        for _ in range(6):
+            self.assertEqual(self.post(client, 'wrong').status_code, 400)
+
+
+def metric_samples():
+    ret = {}
+    for line in metrics.render().splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            ret[name] = float(value)
+    return ret
+
+
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.vault = make_vault()
+        self.config = dict(app.config)
+
+    def tearDown(self):
+        app.config.update(self.config)
+
+    def post(self, client, password=PASSWORD):
+        response = client.post('/', data={'source_kind': 'file', 'file': (BytesIO(self.vault), 'v.scm'),
+                                           'password': password})
+        response.get_data()
+        return response
+
+    def test_disabled(self):
+        app.config['METRICS_ENABLED'] = False
+        self.assertEqual(app.test_client().get('/metrics').status_code, 404)
+
+    def test_local_only(self):
+        app.config['METRICS_ENABLED'] = True
+        client = app.test_client()
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE mysticweb_requests_total counter', response.get_data(as_text=True))
+        self.assertEqual(client.get('/metrics', environ_base={'REMOTE_ADDR': '10.0.0.5'}).status_code, 404)
+        self.assertEqual(client.get('http://example.com/metrics').status_code, 404)
+
+    def test_counted(self):
+        app.config['METRICS_ENABLED'] = True
+        client = app.test_client()
+        before = metric_samples()
+        self.assertEqual(self.post(client).status_code, 200)
+        self.assertEqual(self.post(client, 'wrong').status_code, 400)
+        after = metric_samples()
+
+        def added(name):
+            return after.get(name, 0) - before.get(name, 0)
+
+        self.assertEqual(added('mysticweb_requests_total{endpoint="main",status="200"}'), 1)
+        self.assertEqual(added('mysticweb_requests_total{endpoint="main",status="400"}'), 1)
+        self.assertEqual(added('mysticweb_request_seconds_count{endpoint="main"}'), 2)
+        self.assertEqual(added('mysticweb_bad_passwords_total'), 1)
+        self.assertEqual(added('mysticweb_source_bytes_count{source_kind="file"}'), 2)
+        for name in ('parse', 'unlock'):
+            self.assertEqual(added(f'mysticweb_phase_seconds_count{{phase="{name}"}}'), 2)
+        self.assertEqual(added('mysticweb_phase_seconds_count{phase="render"}'), 1)
+        self.assertEqual(after['mysticweb_kdf_in_flight'], 0)
+        # the metrics page doesn't count itself
+        client.get('/metrics')
+        self.assertEqual(metric_samples().get('mysticweb_requests_total{endpoint="metrics_page",status="200"}'), None)
+
+
+class SessionTests(unittest.TestCase):
+    pairs = {'one': 'uno', 'two': 'dos'}
+
+    def test_round_trip(self):
+        cache = SessionCache()
+        token = cache.create(self.pairs)
+        self.assertEqual(cache.get(token), self.pairs)
+        self.assertEqual(cache.get(token), self.pairs)
+        cache.drop(token)
+        self.assertIsNone(cache.get(token))
+        self.assertEqual(len(cache), 0)
+
+    def test_wrong_key(self):
+        cache = SessionCache()
+        token = cache.create(self.pairs)
+        other = cache.create(self.pairs)
+        session_id, _, _ = token.partition('.')
+        _, _, other_key = other.partition('.')
+        self.assertIsNone(cache.get(session_id + '.' + other_key))
+        self.assertIsNone(cache.get(session_id + '.garbage'))
+        self.assertIsNone(cache.get(session_id))
+        # the session is still readable with its own key
+        self.assertEqual(cache.get(token), self.pairs)
+
+    def test_idle_expiry(self):
+        cache = SessionCache(idle=0.1)
+        token = cache.create(self.pairs)
+        time.sleep(0.05)
+        # using the session keeps it alive
+        self.assertEqual(cache.get(token), self.pairs)
+        time.sleep(0.05)
+        self.assertEqual(cache.get(token), self.pairs)
+        time.sleep(0.15)
+        self.assertIsNone(cache.get(token))
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_eviction(self):
+        probe = SessionCache()
+        probe.create(self.pairs)
+        session_size = probe._bytes
+        cache = SessionCache(max_bytes=2 * session_size)
+        first = cache.create(self.pairs)
+        second = cache.create(self.pairs)
+        cache.get(first)
+        third = cache.create(self.pairs)
+        self.assertEqual(len(cache), 2)
+        # the second session was used least recently
+        self.assertIsNone(cache.get(second))
+        self.assertEqual(cache.get(first), self.pairs)
+        self.assertEqual(cache.get(third), self.pairs)
+        self.assertIsNone(SessionCache(max_bytes=session_size - 1).create(self.pairs))
+
+
+class StreamTests(unittest.TestCase):
+    def post(self, vault):
+        client = app.test_client()
+        return client.post('/', data={'source_kind': 'file', 'file': (BytesIO(vault), 'v.scm'), 'password': PASSWORD},
+                           buffered=False)
+
+    def test_streamed(self):
+        vault = make_vault((f'key{i:04}', 'v' * 500) for i in range(200))
+        response = self.post(vault)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        chunks = list(response.response)
+        response.close()
+        self.assertGreater(len(chunks), 2)
+        # every chunk but the last holds at least STREAM_CHUNK_SIZE characters
+        for chunk in chunks[:-1]:
+            self.assertGreaterEqual(len(chunk), routes.STREAM_CHUNK_SIZE)
+        page = b''.join(chunks)
+        self.assertIn(b'"key0199"', page)
+
+    def test_corrupted_value(self):
+        dcm = DoubleCodedMystic()
+        dcm.add_password(None, PASSWORD)
+        dcm.password_callback = lambda x: PASSWORD
+        dcm.mutable = True
+        for i in range(10):
+            dcm[f'key{i}'] = f'value{i}'
+        buffer = BytesIO()
+        dcm.to_stream(buffer)
+        vault = bytearray(buffer.getvalue())
+        # corrupt the last value, it is only decrypted once the page has started
+        vault[-5] ^= 1
+        response = self.post(bytes(vault))
+        page = response.get_data(as_text=True)
+        response.close()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('"key0"', page)
+        self.assertIn('ERROR: the mystic could not be read to the end', page)
+        self.assertNotIn('"key9"', page)
+
+    def test_escaped(self):
+        plain = self.post(make_vault([('one', 'uno')]))
+        plain_page = plain.get_data(as_text=True)
+        plain.close()
+        response = self.post(make_vault([('</script><script>alert(1)//', '</script><b>x</b>')]))
+        page = response.get_data(as_text=True)
+        response.close()
+        # the pairs add no closing script tags to the page
+        self.assertEqual(page.count('</script>'), plain_page.count('</script>'))
+        self.assertNotIn('<b>x</b>', page)
+        self.assertIn('\\u003c/script\\u003e', page)